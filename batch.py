@@ -0,0 +1,187 @@
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, Iterator, Optional
+
+# Import Files
+from youtube_extraction import FormatSpec, MUX_JOBS, mux, load_video
+from cache import extract_video_id
+from jobs import job_engine
+from storage import remove_job_file
+from media_cache import get_cached_media
+from metrics import STAGE_SECONDS
+from progress import ProgressMessage
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Most videos sent for one playlist or channel link
+BATCH_MAX_VIDEOS = int(os.getenv("BATCH_MAX_VIDEOS", "25"))
+# Videos of one batch in each stage at the same time
+BATCH_RESOLVE_CONCURRENCY = int(os.getenv("BATCH_RESOLVE_CONCURRENCY", "4"))
+BATCH_DOWNLOAD_CONCURRENCY = int(os.getenv("BATCH_DOWNLOAD_CONCURRENCY", "2"))
+BATCH_MUX_CONCURRENCY = int(os.getenv("BATCH_MUX_CONCURRENCY", "2"))
+# Videos started ahead of the one being uploaded, which bounds the disk space a batch holds
+BATCH_WINDOW = int(os.getenv("BATCH_WINDOW", "4"))
+
+
+def _remove_result(future: asyncio.Future):
+    # A download or merge that finished after its batch was cancelled
+    if future.cancelled() or future.exception() is not None:
+        return
+    result = future.result()
+    if isinstance(result, MUX_JOBS):
+        result = result.output_path
+    if result:
+        remove_job_file(result)
+
+
+async def _cleaned_up_on_cancel(coroutine):
+    """Awaits coroutine; if the caller is cancelled meanwhile, it still finishes in its thread and its files are deleted."""
+    future = asyncio.ensure_future(coroutine)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        future.add_done_callback(_remove_result)
+        raise
+
+
+class BatchItem:
+    """One video of a batch and what the pipeline made of it."""
+
+    def __init__(self, index: int, link: str):
+        self.index = index
+        self.link = link
+        self.video_id = extract_video_id(link)
+        self.title: Optional[str] = None
+        # The batch's spec as it comes out for this video (see YoutubeVideo.delivered_spec)
+        self.spec: Optional[FormatSpec] = None
+        # A downloaded file, or the file_id of one Telegram already has
+        self.path: Optional[str] = None
+        self.media_type: Optional[str] = None
+        self.file_id: Optional[str] = None
+
+
+class BatchPipeline:
+    """
+    Delivers the videos of a playlist or channel to one chat, in playlist order.
+
+    Links are pulled lazily from `links` (so pages are only fetched as the batch gets there), at most
+    max_videos of them. Every video goes through resolve -> download -> mux on its own task, each stage
+    bounded by its own semaphore, and downloads also take a job engine slot; so while one video uploads
+    the next ones are downloading and merging. Uploads run one at a time in order through send(item).
+    Only `window` videos are in flight ahead of the upload, which bounds memory and disk.
+    Videos already sent once are taken from the media cache, manifests from the video cache.
+    """
+
+    def __init__(self, links: Iterator[str], spec: FormatSpec, send: Callable[[BatchItem], Awaitable],
+                 progress: Optional[ProgressMessage] = None, max_videos: int = BATCH_MAX_VIDEOS,
+                 resolve_concurrency: int = BATCH_RESOLVE_CONCURRENCY, download_concurrency: int = BATCH_DOWNLOAD_CONCURRENCY,
+                 mux_concurrency: int = BATCH_MUX_CONCURRENCY, window: int = BATCH_WINDOW):
+        self.links = links
+        self.spec = spec
+        self.send = send
+        self.progress = progress
+        self.max_videos = max_videos
+        self.expanded = 0
+        self.sent = 0
+        self.failed = 0
+        self._resolve = asyncio.Semaphore(resolve_concurrency)
+        self._download = asyncio.Semaphore(download_concurrency)
+        self._mux = asyncio.Semaphore(mux_concurrency)
+        self._window = asyncio.Semaphore(window)
+
+    async def run(self) -> tuple[int, int]:
+        """Runs the batch to the end. Returns (videos sent, videos that failed)."""
+        order: asyncio.Queue = asyncio.Queue()
+        expander = asyncio.create_task(self._expand(order))
+        try:
+            await self._deliver(order)
+            return self.sent, self.failed
+        finally:
+            expander.cancel()
+            # Cancelled part way: drop what was prepared but not sent
+            while not order.empty():
+                entry = order.get_nowait()
+                if entry is not None:
+                    self._discard(*entry)
+
+    async def _expand(self, order: asyncio.Queue):
+        try:
+            for index in range(self.max_videos):
+                await self._window.acquire()
+                link = await job_engine.run_network(next, self.links, None)
+                if link is None:
+                    break
+                item = BatchItem(index, link)
+                self.expanded += 1
+                order.put_nowait((item, asyncio.create_task(self._process(item))))
+        except Exception as e:
+            logger.warning(f"Stopped expanding the batch after {self.expanded} videos: {e}")
+        finally:
+            order.put_nowait(None)
+
+    async def _process(self, item: BatchItem):
+        async with self._resolve:
+            video = await job_engine.run_network(load_video, item.link)
+            item.title = video.yt.title
+            item.spec = await job_engine.run_network(video.delivered_spec, self.spec)
+            cached = await job_engine.run_network(get_cached_media, item.video_id, item.spec.label) if item.video_id else None
+        if cached:
+            item.media_type, item.file_id = cached
+            return
+
+        size = await job_engine.run_network(video.estimate_size, item.spec)
+        async with job_engine.global_slot(size):
+            async with self._download:
+                with STAGE_SECONDS.time(stage='download'):
+                    result = await _cleaned_up_on_cancel(job_engine.run_network(video.fetch, item.spec))
+            # The download slot is free again, so the next video downloads while this one merges
+            if isinstance(result, MUX_JOBS):
+                result = await self._merge(result)
+        item.path = result
+
+    async def _merge(self, job) -> Optional[str]:
+        merging = False
+        try:
+            async with self._mux:
+                merging = True
+                with STAGE_SECONDS.time(stage='mux'):
+                    return await _cleaned_up_on_cancel(job_engine.run_mux(mux, job))
+        except asyncio.CancelledError:
+            # Cancelled while waiting for a merge slot: nothing else removes the downloaded streams
+            if not merging:
+                remove_job_file(job.output_path)
+            raise
+
+    async def _deliver(self, order: asyncio.Queue):
+        while (entry := await order.get()) is not None:
+            item, task = entry
+            try:
+                await task
+                if item.path or item.file_id:
+                    with STAGE_SECONDS.time(stage='upload'):
+                        await self.send(item)
+                    self.sent += 1
+                else:
+                    logger.info(f"No {(item.spec or self.spec).label} for batch video {item.index + 1} ({item.link}).")
+                    self.failed += 1
+            except asyncio.CancelledError:
+                self._discard(item, task)
+                raise
+            except Exception as e:
+                logger.error(f"Batch video {item.index + 1} ({item.link}) failed: {e}")
+                self.failed += 1
+            finally:
+                if item.path:
+                    remove_job_file(item.path)
+                    item.path = None
+                self._window.release()
+            if self.progress:
+                self.progress.update('batch', self.sent + self.failed, self.expanded)
+
+    def _discard(self, item: BatchItem, task: asyncio.Task):
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None and item.path:
+            remove_job_file(item.path)
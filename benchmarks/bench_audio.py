@@ -0,0 +1,202 @@
+"""
+Benchmark: the audio pipeline (best source stream, transcoded to a bitrate or target size with tags and
+cover art) against sending YouTube's AAC stream as is.
+
+    python benchmarks/bench_audio.py --minutes 4 60 --codecs aac:96 mp3:128 --target-mb 20 --upload-mbps 20
+
+Real AAC (128k, itag 140) and Opus (160k, itag 251) tracks are generated with FFmpeg and served by
+FakeMediaServer. Every mode resolves, downloads, converts in the mux pool and uploads to FakeBotAPI.
+The report lists bytes uploaded and the time of each stage. Without ffmpeg, --fake-transcode uses
+random sources and a stand-in that only cuts the file to the size the bitrate would give.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import statistics
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import MB, FakeMediaServer, FakeBotAPI, FakeYouTube
+
+SOURCES = {
+    # itag: (encoder, bitrate, extension)
+    140: ('aac', '128k', 'm4a'),
+    251: ('libopus', '160k', 'webm'),
+}
+
+
+def make_sources(workdir: str, seconds: int, fake: bool) -> tuple[dict, bytes]:
+    """Audio content per itag and a cover JPEG for a track of `seconds`."""
+    if fake:
+        rng = random.Random(seconds)
+        files = {itag: rng.randbytes(int(bitrate[:-1]) * 1000 // 8 * seconds) for itag, (_, bitrate, _) in SOURCES.items()}
+        return files, rng.randbytes(30 * 1024)
+
+    import ffmpeg
+    # Pink noise keeps the encoders busy like music does; silence or a sine would compress to nothing
+    noise = ffmpeg.input(f"anoisesrc=color=pink:amplitude=0.3:duration={seconds}", f='lavfi')
+    files = {}
+    for itag, (encoder, bitrate, extension) in SOURCES.items():
+        path = os.path.join(workdir, f"source_{itag}.{extension}")
+        noise.output(path, ac=2, acodec=encoder, audio_bitrate=bitrate).run(overwrite_output=True, quiet=True)
+        with open(path, 'rb') as f:
+            files[itag] = f.read()
+
+    cover_path = os.path.join(workdir, 'cover.jpg')
+    ffmpeg.input("color=c=navy:s=480x360", f='lavfi').output(cover_path, vframes=1).run(overwrite_output=True, quiet=True)
+    with open(cover_path, 'rb') as f:
+        return files, f.read()
+
+
+def upload(url: str, path: str, chat_id: int = 1):
+    """Posts path as sendAudio multipart upload, like the bot does."""
+    boundary = uuid.uuid4().hex
+    with open(path, 'rb') as f:
+        data = f.read()
+    head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"chat_id\"\r\n\r\n{chat_id}\r\n"
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"audio\"; filename=\"{os.path.basename(path)}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n")
+    body = head.encode('utf-8') + data + f"\r\n--{boundary}--\r\n".encode()
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': f"multipart/form-data; boundary={boundary}"})
+    with urllib.request.urlopen(request, timeout=600) as response:
+        response.read()
+
+
+def parse_codec(value: str) -> tuple[str, int]:
+    codec, _, bitrate = value.partition(':')
+    return codec, int(bitrate or 96)
+
+
+async def run_once(spec, link: str, send_url: str) -> dict:
+    from jobs import job_engine
+    from storage import remove_job_file
+    from youtube_extraction import MUX_JOBS, mux, load_video
+
+    timings, started = {}, time.perf_counter()
+    video = await job_engine.run_network(load_video, link)
+    timings['resolve'] = time.perf_counter() - started
+
+    mark = time.perf_counter()
+    result = await job_engine.run_network(video.fetch, spec)
+    timings['download'] = time.perf_counter() - mark
+
+    mark = time.perf_counter()
+    if isinstance(result, MUX_JOBS):
+        result = await job_engine.run_mux(mux, result)
+    timings['transcode'] = time.perf_counter() - mark
+    if not result:
+        raise RuntimeError(f"{spec} produced no file")
+
+    size = os.path.getsize(result)
+    mark = time.perf_counter()
+    await asyncio.to_thread(upload, send_url, result)
+    timings['upload'] = time.perf_counter() - mark
+    timings['total'] = time.perf_counter() - started
+    remove_job_file(result)
+    return {'bytes': size, 'file': os.path.basename(result), **timings}
+
+
+async def run_benchmark(args, modes: list, media_url_for, bot_api: FakeBotAPI) -> list:
+    rows, video_number = [], 0
+    send_url = f"{bot_api.bot_url}bench/sendAudio"
+    for minutes in args.minutes:
+        media_url = media_url_for(minutes)
+        FakeYouTube.server_url = media_url
+        for name, spec in modes:
+            runs = []
+            for _ in range(args.repeat):
+                # A fresh video ID per run, so every run pays for the manifest like a new link would
+                video_number += 1
+                runs.append(await run_once(spec, f"https://youtu.be/bench{video_number:06d}", send_url))
+            row = {'minutes': minutes, 'mode': name, 'bytes': runs[0]['bytes'], 'file': runs[0]['file']}
+            for stage in ('resolve', 'download', 'transcode', 'upload', 'total'):
+                row[stage] = statistics.median(run[stage] for run in runs)
+            rows.append(row)
+    return rows
+
+
+def print_report(rows: list):
+    print(f"{'min':>4} {'mode':<14} {'MB':>8} {'vs copy':>8} | {'download':>9} {'transcode':>9} {'upload':>8} {'total s':>8}")
+    baseline = {}
+    for row in rows:
+        if row['mode'] == 'passthrough':
+            baseline[row['minutes']] = row['bytes']
+        ratio = row['bytes'] / baseline[row['minutes']] if row['minutes'] in baseline else 1
+        print(f"{row['minutes']:>4g} {row['mode']:<14} {row['bytes'] / MB:>8.2f} {ratio:>8.0%} | "
+              f"{row['download']:>9.2f} {row['transcode']:>9.2f} {row['upload']:>8.2f} {row['total']:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--minutes', type=float, nargs='+', default=[4, 60], help="track lengths to test")
+    parser.add_argument('--codecs', type=parse_codec, nargs='+', default=[('aac', 96), ('mp3', 128)], metavar='CODEC:KBPS')
+    parser.add_argument('--target-mb', type=float, help="also test the first codec shrunk to this file size")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stream-mbps', type=float, default=200, help="download bandwidth per stream connection (Mbit/s)")
+    parser.add_argument('--upload-mbps', type=float, default=20, help="upload bandwidth to the Bot API (Mbit/s)")
+    parser.add_argument('--fake-transcode', action='store_true', help="random sources and no FFmpeg (implied when ffmpeg is missing)")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    fake = args.fake_transcode or shutil.which('ffmpeg') is None
+    cwd = os.getcwd()
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = tempfile.mkdtemp(prefix="bench_audio_")
+    os.chdir(workdir)
+    # The stand-in transcode only exists in this process
+    os.environ['JOB_MUX_PROCESSES'] = '0' if fake else os.environ.get('JOB_MUX_PROCESSES', '1')
+
+    import youtube_extraction
+    from youtube_extraction import FormatSpec
+    youtube_extraction.YouTube = FakeYouTube
+    if fake:
+        from load_test import install_fake_mux
+        install_fake_mux()
+
+    modes = [('passthrough', FormatSpec(audio_only=True))]
+    modes += [(f"{codec} {bitrate}k", FormatSpec(audio_only=True, audio_codec=codec, audio_bitrate=bitrate)) for codec, bitrate in args.codecs]
+    if args.target_mb:
+        codec, bitrate = args.codecs[0]
+        modes.append((f"{codec} <={args.target_mb:g}MB", FormatSpec(audio_only=True, audio_codec=codec, audio_bitrate=bitrate,
+                                                                   target_size=int(args.target_mb * MB))))
+
+    servers = []
+    bot_api = FakeBotAPI(0.0, args.upload_mbps * MB / 8).start()
+    servers.append(bot_api)
+
+    def media_url_for(minutes: float) -> str:
+        seconds = int(minutes * 60)
+        files, cover = make_sources(workdir, seconds, fake)
+        media = FakeMediaServer(latency=0.0, bandwidth=args.stream_mbps * MB / 8, media_files=files,
+                                thumbnail=cover, length_seconds=seconds).start()
+        servers.append(media)
+        return media.url
+
+    try:
+        rows = asyncio.run(run_benchmark(args, modes, media_url_for, bot_api))
+    finally:
+        for server in servers:
+            server.stop()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(rows)
+    if fake:
+        print("\n(no FFmpeg: sizes follow the bitrate, transcode times are not measured)")
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump({'fake_transcode': fake, 'results': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,501 @@
+"""
+Local stand-ins for YouTube, the Telegram Bot API and Gemini, used by benchmarks/load_test.py.
+
+Everything runs on 127.0.0.1 in background threads, so a load test needs no network access:
+
+    FakeMediaServer  watch pages, JSON stream manifests, ranged stream bytes and caption XML
+    FakeBotAPI       getMe, sendMessage, sendVideo/sendAudio/sendDocument (multipart uploads) and friends
+    FakeGemini       :generateContent with a configurable latency and error rate
+    FakeYouTube      drop-in for pytubefix.YouTube that reads its metadata from FakeMediaServer
+"""
+import re
+import json
+import time
+import random
+import threading
+import urllib.request
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+MB = 1024 * 1024
+# Stream bytes are slices of one random block, so any range can be served without storing files
+_BLOCK = random.Random(0).randbytes(MB)
+_WRITE_SIZE = 64 * 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = 'application/json', headers: Optional[dict] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_json(self, data, status: int = 200):
+        self._send(status, json.dumps(data).encode('utf-8'))
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+
+class _BackgroundServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, port: int = 0):
+        super().__init__(('127.0.0.1', port), handler)
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+# --- Media server ---
+
+def video_catalog(video_id: str, video_mb: float, length_seconds: int = 600) -> dict:
+    """The manifest every fake video gets: one progressive and two adaptive video streams plus two audio streams."""
+    size = lambda fraction: max(1, int(video_mb * fraction * MB))
+    streams = [
+        {'itag': 18, 'type': 'video', 'subtype': 'mp4', 'resolution': '360p', 'video_codec': 'avc1.42001E', 'audio_codec': 'mp4a.40.2', 'fps': 30, 'progressive': True, 'filesize': size(0.25)},
+        {'itag': 136, 'type': 'video', 'subtype': 'mp4', 'resolution': '720p', 'video_codec': 'avc1.4d401f', 'fps': 30, 'progressive': False, 'filesize': size(0.5)},
+        {'itag': 137, 'type': 'video', 'subtype': 'mp4', 'resolution': '1080p', 'video_codec': 'avc1.640028', 'fps': 30, 'progressive': False, 'filesize': size(1.0)},
+        {'itag': 140, 'type': 'audio', 'subtype': 'mp4', 'abr': '128kbps', 'audio_codec': 'mp4a.40.2', 'progressive': False, 'filesize': size(0.1)},
+        {'itag': 251, 'type': 'audio', 'subtype': 'webm', 'abr': '160kbps', 'audio_codec': 'opus', 'progressive': False, 'filesize': size(0.12)},
+    ]
+    captions = [('en', 'English'), ('a.en', 'English (auto-generated)'), ('de', 'German')]
+    return {
+        'videoId': video_id,
+        'title': f"Load test video {video_id}",
+        'author': "Load Test",
+        'lengthSeconds': length_seconds,
+        'streams': streams,
+        'captions': [{'code': code, 'name': name} for code, name in captions],
+    }
+
+
+def caption_xml(lang_code: str, seconds: int = 600, cue_seconds: float = 2.5) -> str:
+    lines = ['<?xml version="1.0" encoding="utf-8" ?><transcript>']
+    for i in range(int(seconds / cue_seconds)):
+        lines.append(f'<text start="{i * cue_seconds:.2f}" dur="{cue_seconds:.2f}">Line {i} in {lang_code} &amp;amp; more.</text>')
+    lines.append('</transcript>')
+    return '\n'.join(lines)
+
+
+class _MediaHandler(_Handler):
+    server: 'FakeMediaServer'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        server = self.server
+
+        if parts[0] != 'videoplayback':
+            # Page, manifest and caption requests pay the simulated round trip
+            time.sleep(server.latency)
+
+        if parts == ['watch']:
+            video_id = parse_qs(url.query).get('v', [''])[0]
+            title = server.catalog(video_id)['title']
+            self._send(200, f"<html><head><title>{title} - YouTube</title></head><body></body></html>".encode(), 'text/html')
+        elif len(parts) == 2 and parts[0] == 'player':
+            self._send_json(server.catalog(parts[1]))
+        elif len(parts) == 2 and parts[0] == 'thumbnail' and server.thumbnail:
+            self._send(200, server.thumbnail, 'image/jpeg')
+        elif len(parts) == 3 and parts[0] == 'timedtext':
+            self._send(200, caption_xml(parts[2]).encode('utf-8'), 'text/xml')
+        elif len(parts) == 3 and parts[0] == 'videoplayback':
+            self._stream(parts[1], int(parts[2]))
+        else:
+            self._send_json({'error': 'not found'}, 404)
+
+    do_HEAD = do_GET
+
+    def _stream(self, video_id: str, itag: int):
+        server = self.server
+        stream = next((s for s in server.catalog(video_id)['streams'] if s['itag'] == itag), None)
+        if stream is None:
+            self._send_json({'error': 'unknown itag'}, 404)
+            return
+
+        size = stream['filesize']
+        start, end, status = 0, size - 1, 200
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', f"{stream['type']}/{stream['subtype']}")
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+
+        # Each connection is throttled on its own, like a CDN edge
+        content = server.media_files.get(itag)
+        offset = start
+        while offset <= end:
+            if content is not None:
+                length = min(_WRITE_SIZE, end - offset + 1)
+                self.wfile.write(content[offset:offset + length])
+            else:
+                block_offset = offset % MB
+                length = min(_WRITE_SIZE, end - offset + 1, MB - block_offset)
+                self.wfile.write(_BLOCK[block_offset:block_offset + length])
+            offset += length
+            server.count('bytes_served', length)
+            if server.bandwidth:
+                time.sleep(length / server.bandwidth)
+
+
+class FakeMediaServer(_BackgroundServer):
+    """
+    Serves /watch?v=ID, /player/ID (manifest), /videoplayback/ID/ITAG (ranged bytes), /timedtext/ID/LANG
+    and /thumbnail/ID.jpg. Any 11 character ID is a valid video; its manifest comes from video_catalog().
+    `latency` is added to every metadata request, `bandwidth` (bytes/s) caps each stream connection.
+    `media_files` maps itags to real content (e.g. encoded audio) served instead of random bytes.
+    """
+
+    def __init__(self, video_mb: float = 8, latency: float = 0.05, bandwidth: Optional[float] = None,
+                 media_files: Optional[dict] = None, thumbnail: Optional[bytes] = None, length_seconds: int = 600):
+        super().__init__(_MediaHandler)
+        self.video_mb = video_mb
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.media_files = media_files or {}
+        self.thumbnail = thumbnail
+        self.length_seconds = length_seconds
+        self.stats = {'bytes_served': 0}
+        self._catalogs = {}
+
+    def catalog(self, video_id: str) -> dict:
+        with self.lock:
+            if video_id not in self._catalogs:
+                catalog = video_catalog(video_id, self.video_mb, self.length_seconds)
+                for stream in catalog['streams']:
+                    if stream['itag'] in self.media_files:
+                        stream['filesize'] = len(self.media_files[stream['itag']])
+                self._catalogs[video_id] = catalog
+            return self._catalogs[video_id]
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+
+# --- pytubefix stand-ins ---
+
+def _get(url: str) -> bytes:
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return response.read()
+
+
+class FakeStream:
+    """The Stream attributes the bot reads, built from a FakeMediaServer manifest entry."""
+
+    def __init__(self, data: dict, video_id: str, title: str, server_url: str):
+        self.itag = data['itag']
+        self.type = data['type']
+        self.subtype = data['subtype']
+        self.mime_type = f"{self.type}/{self.subtype}"
+        self.resolution = data.get('resolution')
+        self.video_codec = data.get('video_codec')
+        self.audio_codec = data.get('audio_codec')
+        self.abr = data.get('abr')
+        self.fps = data.get('fps')
+        self.filesize = data['filesize']
+        self.is_progressive = data['progressive']
+        self.is_adaptive = not self.is_progressive
+        self.includes_video_track = self.type == 'video'
+        self.includes_audio_track = self.type == 'audio' or self.is_progressive
+        self.title = title
+        self.url = f"{server_url}/videoplayback/{video_id}/{self.itag}"
+
+    @property
+    def default_filename(self) -> str:
+        return f"{self.title}.{self.subtype}"
+
+
+class FakeStreamQuery:
+    def __init__(self, streams: list):
+        self.fmt_streams = streams
+
+    def filter(self, type=None, progressive=None, adaptive=None, only_video=None, only_audio=None,
+               file_extension=None, subtype=None, res=None, resolution=None, **kwargs):
+        streams = self.fmt_streams
+        checks = [
+            (type, lambda s: s.type == type),
+            (progressive, lambda s: s.is_progressive),
+            (adaptive, lambda s: s.is_adaptive),
+            (only_video, lambda s: s.includes_video_track and not s.includes_audio_track),
+            (only_audio, lambda s: s.includes_audio_track and not s.includes_video_track),
+            (file_extension or subtype, lambda s: s.subtype == (file_extension or subtype)),
+            (res or resolution, lambda s: s.resolution == (res or resolution)),
+        ]
+        for value, check in checks:
+            if value:
+                streams = [s for s in streams if check(s)]
+        return FakeStreamQuery(streams)
+
+    def get_by_itag(self, itag: int):
+        return next((s for s in self.fmt_streams if s.itag == itag), None)
+
+    def first(self):
+        return self.fmt_streams[0] if self.fmt_streams else None
+
+    def __iter__(self):
+        return iter(self.fmt_streams)
+
+    def __len__(self) -> int:
+        return len(self.fmt_streams)
+
+    def __getitem__(self, index):
+        return self.fmt_streams[index]
+
+
+class FakeCaption:
+    def __init__(self, code: str, name: str, url: str):
+        self.code = code
+        self.name = name
+        self.url = url
+
+    @property
+    def xml_captions(self) -> str:
+        return _get(self.url).decode('utf-8')
+
+
+class FakeCaptionQuery:
+    def __init__(self, captions: list):
+        self._captions = {caption.code: caption for caption in captions}
+
+    def get_by_language_code(self, lang_code: str):
+        return self._captions.get(lang_code)
+
+    def __getitem__(self, lang_code: str):
+        return self._captions[lang_code]
+
+    def __iter__(self):
+        return iter(self._captions.values())
+
+    def __len__(self) -> int:
+        return len(self._captions)
+
+
+class FakeYouTube:
+    """
+    Replacement for pytubefix.YouTube. Like the real class, the watch page and manifest are
+    fetched lazily on first use. Set FakeYouTube.server_url to the FakeMediaServer's url first.
+    """
+    server_url = None
+
+    def __init__(self, url: str, *args, **kwargs):
+        match = re.search(r'(?:v=|youtu\.be/|shorts/|embed/)([\w-]{11})', url)
+        self.video_id = match.group(1) if match else url[-11:]
+        self.watch_url = url
+        self._title = None
+        self._manifest = None
+
+    @property
+    def title(self) -> str:
+        if self._title is None:
+            page = _get(f"{self.server_url}/watch?v={self.video_id}").decode('utf-8')
+            self._title = re.search(r'<title>(.*?) - YouTube</title>', page).group(1)
+        return self._title
+
+    @property
+    def manifest(self) -> dict:
+        if self._manifest is None:
+            self._manifest = json.loads(_get(f"{self.server_url}/player/{self.video_id}"))
+        return self._manifest
+
+    @property
+    def author(self) -> str:
+        return self.manifest['author']
+
+    @property
+    def length(self) -> int:
+        return self.manifest['lengthSeconds']
+
+    @property
+    def thumbnail_url(self) -> str:
+        return f"{self.server_url}/thumbnail/{self.video_id}.jpg"
+
+    @property
+    def streams(self) -> FakeStreamQuery:
+        return FakeStreamQuery([FakeStream(s, self.video_id, self.title, self.server_url) for s in self.manifest['streams']])
+
+    @property
+    def captions(self) -> FakeCaptionQuery:
+        return FakeCaptionQuery([
+            FakeCaption(c['code'], c['name'], f"{self.server_url}/timedtext/{self.video_id}/{c['code']}")
+            for c in self.manifest['captions']
+        ])
+
+
+# --- Telegram Bot API ---
+
+_MEDIA_FIELDS = {'sendVideo': 'video', 'sendAudio': 'audio', 'sendDocument': 'document'}
+
+
+class _BotAPIHandler(_Handler):
+    server: 'FakeBotAPI'
+
+    def do_POST(self):
+        match = re.match(r'^/bot[^/]+/(\w+)$', self.path)
+        if not match:
+            self._send_json({'ok': False, 'error_code': 404, 'description': 'Not Found'}, 404)
+            return
+
+        method = match.group(1)
+        started = time.perf_counter()
+        body = self._read_body()
+        params, uploads = self._parse(body)
+        server = self.server
+
+        # Simulate Telegram ingesting the upload
+        uploaded = sum(len(data) for data in uploads.values())
+        if uploaded and server.upload_bandwidth:
+            time.sleep(uploaded / server.upload_bandwidth)
+        time.sleep(server.latency)
+
+        result = server.answer(method, params, uploads)
+        server.record(method, len(body), uploaded, time.perf_counter() - started)
+        self._send_json({'ok': True, 'result': result})
+
+    def _parse(self, body: bytes) -> tuple[dict, dict]:
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            message = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+            params, uploads = {}, {}
+            for part in message.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                data = part.get_payload(decode=True) or b''
+                if part.get_filename():
+                    uploads[name] = data
+                else:
+                    params[name] = data.decode('utf-8')
+            return params, uploads
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}'), {}
+        return {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}, {}
+
+
+class FakeBotAPI(_BackgroundServer):
+    """
+    Minimal Telegram Bot API at {url}/bot<token>/<method>. Uploads get a fresh file_id that later
+    requests may send again. Every chat's delivered media and texts are kept for checking outcomes.
+    """
+
+    def __init__(self, latency: float = 0.02, upload_bandwidth: Optional[float] = None, port: int = 0):
+        super().__init__(_BotAPIHandler, port)
+        self.latency = latency
+        self.upload_bandwidth = upload_bandwidth
+        self.calls = {}
+        self.chats = {}
+        self._message_id = 0
+        self._file_id = 0
+
+    @property
+    def bot_url(self) -> str:
+        return f"{self.url}/bot"
+
+    def record(self, method: str, request_bytes: int, uploaded: int, seconds: float):
+        with self.lock:
+            entry = self.calls.setdefault(method, {'count': 0, 'request_bytes': 0, 'uploaded_bytes': 0, 'seconds': 0.0})
+            entry['count'] += 1
+            entry['request_bytes'] += request_bytes
+            entry['uploaded_bytes'] += uploaded
+            entry['seconds'] += seconds
+
+    def delivered(self, chat_id: int) -> list:
+        """(kind, value) of everything sent to chat_id: ('text', text) or ('video'|'audio'|'document', file_id)."""
+        with self.lock:
+            return list(self.chats.get(chat_id, []))
+
+    def answer(self, method: str, params: dict, uploads: dict):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': "Load Test", 'username': "load_test_bot",
+                    'can_join_groups': False, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+        if 'chat_id' not in params:
+            return True
+
+        chat_id = int(params['chat_id'])
+        if method == 'deleteMessage':
+            return True
+        with self.lock:
+            self._message_id += 1
+            message = {'message_id': self._message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}
+            kind = _MEDIA_FIELDS.get(method)
+            if kind:
+                if kind in uploads:
+                    self._file_id += 1
+                    file_id, size = f"fake-{kind}-{self._file_id}", len(uploads[kind])
+                else:
+                    file_id, size = params.get(kind), None
+                message[kind] = {'file_id': file_id, 'file_unique_id': file_id, 'file_size': size}
+                if kind in ('video', 'audio'):
+                    message[kind]['duration'] = 600
+                if kind == 'video':
+                    message[kind].update(width=1920, height=1080)
+                message['caption'] = params.get('caption', '')
+                self.chats.setdefault(chat_id, []).append((kind, file_id))
+            else:
+                message['text'] = params.get('text', '')
+                # Progress edits change an existing message, they aren't deliveries
+                if method != 'editMessageText':
+                    self.chats.setdefault(chat_id, []).append(('text', message['text']))
+        return message
+
+
+# --- Gemini ---
+
+class _GeminiHandler(_Handler):
+    server: 'FakeGemini'
+
+    def do_POST(self):
+        self._read_body()
+        server = self.server
+        time.sleep(server.latency)
+        with server.lock:
+            server.requests += 1
+        if server.error_rate and random.random() < server.error_rate:
+            self._send_json({'error': {'code': 503, 'message': 'overloaded'}}, 503)
+            return
+        self._send_json({'candidates': [{'content': {'role': 'model', 'parts': [{'text': "این یک پاسخ آزمایشی است."}]}}]})
+
+
+class FakeGemini(_BackgroundServer):
+    """Answers every generateContent call after `latency` seconds, failing `error_rate` of them with 503."""
+
+    def __init__(self, latency: float = 0.3, error_rate: float = 0.0):
+        super().__init__(_GeminiHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"{self.url}/v1beta/models/"
@@ -0,0 +1,430 @@
+"""
+Offline end-to-end load test: replays simulated users through the real bot handlers while YouTube,
+the Telegram Bot API and Gemini are served by the local stand-ins in benchmarks/fakes.py.
+
+    python benchmarks/load_test.py --users 40 --mix chat=4,audio=3,subtitles=2,1080p=1
+    python benchmarks/load_test.py --users 20 --json result.json --max-p95 download=5 --max-p95 total=20
+
+Each user sends a video link and then presses the buttons of its scenario, exactly like a chat would.
+The report lists throughput, p50/p95/p99 latency per scenario and per stage (resolve, download, mux,
+upload, chat, ...), bytes moved and peak RSS / scratch disk usage. --max-p95 and --max-errors make the
+script exit with status 1, so it can guard against regressions in CI.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import resource
+import tempfile
+import threading
+import logging
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import MB, FakeMediaServer, FakeBotAPI, FakeGemini, FakeYouTube
+
+# Buttons each scenario presses after sending the link
+SCENARIOS = {
+    'chat': ["سلام! امروز چه خبر؟"],
+    'audio': ["🔊 Audio"],
+    'subtitles': ["🈯 Subtitle", "🈯 English"],
+    '360p': ["🎥 Video", "🎥 360 P"],
+    '720p': ["🎥 Video", "🎥 720 P"],
+    '1080p': ["🎥 Video", "🎥 1080 P"],
+}
+# Scenarios that must end with a file in the chat
+MEDIA_SCENARIOS = {'audio', 'subtitles', '360p', '720p', '1080p'}
+# Replies the handlers send when a request failed
+ERROR_REPLY_PREFIXES = ("❌", "خطایی")
+
+# Blocking calls timed as stages, by the name of the function handed to the job engine
+STAGE_NAMES = {
+    'load_video': 'resolve',
+    'fetch': 'download',
+    'estimate_size': 'resolve',
+    'get_cues': 'captions',
+    'build_subtitle_bundle': 'subtitle_build',
+    'get_cached_media': 'cache_lookup',
+    'store_media': 'cache_store',
+    'mux': 'mux',
+}
+
+
+class Recorder:
+    """Collects latency samples per name."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.samples[name].append(seconds)
+
+    def timed(self, name: str, func):
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - started)
+        return wrapper
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def summarize(values: list) -> dict:
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else 0.0,
+    }
+
+
+class DiskSampler(threading.Thread):
+    """Polls the size of the scratch directories and keeps the peak."""
+
+    def __init__(self, paths: list, interval: float = 0.05):
+        super().__init__(name="disk-sampler", daemon=True)
+        self.paths = paths
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, sum(_tree_size(path) for path in self.paths))
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _tree_size(path: str) -> int:
+    total = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        total += _tree_size(entry.path)
+                    else:
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return total
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"Unknown scenario {name!r}, choose from {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def parse_threshold(text: str) -> tuple:
+    name, _, seconds = text.partition('=')
+    if not seconds:
+        raise argparse.ArgumentTypeError("Use NAME=SECONDS, e.g. download=5")
+    return name, float(seconds)
+
+
+def make_update(bot, update_id: int, user_id: int, text: str):
+    from telegram import Update
+    data = {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"},
+            'text': text,
+        },
+    }
+    return Update.de_json(data, bot)
+
+
+def install_probes(recorder: Recorder):
+    """Wraps the job engine, chat agent and reply methods so every stage is timed without touching bot code."""
+    import handler
+    from jobs import job_engine
+    from telegram import Message
+
+    def stage_of(func) -> str:
+        return STAGE_NAMES.get(getattr(func, '__name__', ''), getattr(func, '__name__', 'other'))
+
+    for method_name in ('run_network', 'run_mux'):
+        original = getattr(job_engine, method_name)
+
+        def probe(func, *args, _original=original):
+            return recorder.timed(stage_of(func), _original)(func, *args)
+        setattr(job_engine, method_name, probe)
+
+    handler.generate_response = recorder.timed('chat', handler.generate_response)
+
+    # Sending a file_id again is cheap, a fresh upload is what we want to watch
+    for method_name, field in (('reply_video', 'video'), ('reply_audio', 'audio'), ('reply_document', 'document')):
+        original = getattr(Message, method_name)
+
+        async def probe(self, *args, _original=original, _field=field, **kwargs):
+            media = kwargs.get(_field, args[0] if args else None)
+            name = 'resend' if isinstance(media, str) and not os.path.exists(media) else 'upload'
+            return await recorder.timed(name, _original)(self, *args, **kwargs)
+        setattr(Message, method_name, probe)
+
+
+def install_fake_mux():
+    """
+    Stands in for FFmpeg when it is not installed: the 'merged' file is the two inputs concatenated and
+    a 'transcoded' audio file is the start of its source, cut to the size the bitrate would give.
+    """
+    import youtube_extraction
+
+    def merge_av(job):
+        with open(job.output_path, 'wb') as output:
+            for path in (job.video_path, job.audio_path):
+                with open(path, 'rb') as source:
+                    shutil.copyfileobj(source, output)
+                os.remove(path)
+        return job.output_path
+
+    def transcode_audio(job):
+        size = os.path.getsize(job.input_path)
+        if job.encoder != 'copy' and job.duration:
+            size = min(size, job.bitrate * 1000 // 8 * job.duration)
+        with open(job.input_path, 'rb') as source, open(job.output_path, 'wb') as output:
+            output.write(source.read(size))
+        for path in (job.input_path, job.cover_path):
+            if path and os.path.exists(path):
+                os.remove(path)
+        return job.output_path
+
+    youtube_extraction.merge_av = merge_av
+    youtube_extraction.transcode_audio = transcode_audio
+
+
+async def run_user(app, bot_api: FakeBotAPI, recorder: Recorder, user_id: int, scenario: str,
+                   video_id: str, delay: float, update_ids, crashed_users: set) -> dict:
+    await asyncio.sleep(delay)
+    steps = [f"https://youtu.be/{video_id}"] if scenario != 'chat' else []
+    steps += SCENARIOS[scenario]
+
+    started = time.perf_counter()
+    for text in steps:
+        await app.process_update(make_update(app.bot, next(update_ids), user_id, text))
+    elapsed = time.perf_counter() - started
+    recorder.add(f"scenario:{scenario}", elapsed)
+
+    delivered = bot_api.delivered(user_id)
+    if scenario in MEDIA_SCENARIOS:
+        ok = any(kind != 'text' for kind, _ in delivered)
+    else:
+        ok = any(kind == 'text' and value.startswith("🤖") for kind, value in delivered)
+    # A file followed by an error reply, or a handler exception, still fails the user
+    if user_id in crashed_users or any(kind == 'text' and value.startswith(ERROR_REPLY_PREFIXES) for kind, value in delivered):
+        ok = False
+    return {'user_id': user_id, 'scenario': scenario, 'video_id': video_id, 'seconds': elapsed, 'ok': ok}
+
+
+async def run_load(args, media: FakeMediaServer, bot_api: FakeBotAPI, recorder: Recorder) -> dict:
+    import itertools
+    from main import build_application, shutdown
+    from database import init_db
+    from media_cache import init_media_cache, media_cache_stats
+
+    init_db()
+    init_media_cache()
+    install_probes(recorder)
+
+    app = build_application("123456:LOADTEST", base_url=bot_api.bot_url)
+    crashed_users = set()
+
+    async def record_crash(update, context):
+        if update is not None and update.effective_user:
+            crashed_users.add(update.effective_user.id)
+
+    app.add_error_handler(record_crash)
+    await app.initialize()
+
+    rng = random.Random(args.seed)
+    names, weights = zip(*args.mix.items())
+    video_ids = [f"loadtest{i:03d}" for i in range(args.videos)]
+    update_ids = itertools.count(1)
+    users = [(1000 + i, rng.choices(names, weights)[0], rng.choice(video_ids), rng.uniform(0, args.ramp))
+             for i in range(args.users)]
+
+    sampler = DiskSampler([os.path.abspath('videos'), os.path.abspath('audios')])
+    sampler.start()
+    started = time.perf_counter()
+    try:
+        results = await asyncio.gather(*(
+            run_user(app, bot_api, recorder, user_id, scenario, video_id, delay, update_ids, crashed_users)
+            for user_id, scenario, video_id, delay in users
+        ))
+    finally:
+        wall = time.perf_counter() - started
+        sampler.stop()
+        await app.shutdown()
+        await shutdown(app)
+
+    return {'results': results, 'wall': wall, 'peak_disk': sampler.peak, 'media_cache': media_cache_stats()}
+
+
+def build_report(args, load: dict, media: FakeMediaServer, bot_api: FakeBotAPI, gemini: FakeGemini, recorder: Recorder) -> dict:
+    results = load['results']
+    ok = [r for r in results if r['ok']]
+    usage_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+
+    scenarios = {name[len('scenario:'):]: summarize(values) for name, values in recorder.samples.items() if name.startswith('scenario:')}
+    stages = {name: summarize(values) for name, values in recorder.samples.items() if ':' not in name}
+    scenarios['total'] = summarize([r['seconds'] for r in results])
+    for name in scenarios:
+        if name != 'total':
+            scenarios[name]['errors'] = sum(1 for r in results if r['scenario'] == name and not r['ok'])
+
+    uploaded = sum(entry['uploaded_bytes'] for entry in bot_api.calls.values())
+    return {
+        'config': {key: value for key, value in vars(args).items() if key not in ('json', 'max_p95')},
+        'wall_seconds': load['wall'],
+        'users': len(results),
+        'completed': len(ok),
+        'errors': len(results) - len(ok),
+        'throughput_per_second': len(ok) / load['wall'] if load['wall'] else 0.0,
+        'scenarios': scenarios,
+        'stages': stages,
+        'bytes_downloaded': media.stats['bytes_served'],
+        'bytes_uploaded': uploaded,
+        'bot_api_calls': {method: entry['count'] for method, entry in bot_api.calls.items()},
+        'gemini_requests': gemini.requests,
+        'media_cache': load['media_cache'],
+        'peak_rss_bytes': usage_self * unit,
+        'peak_child_rss_bytes': usage_children * unit,
+        'peak_disk_bytes': load['peak_disk'],
+    }
+
+
+def print_report(report: dict):
+    def table(title: str, rows: dict):
+        print(f"\n{title:<22} {'count':>6} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'max s':>8} {'errors':>7}")
+        for name, row in sorted(rows.items()):
+            print(f"{name:<22} {row['count']:>6} {row['p50']:>8.3f} {row['p95']:>8.3f} {row['p99']:>8.3f} {row['max']:>8.3f} {row.get('errors', ''):>7}")
+
+    print(f"users {report['users']}, completed {report['completed']}, errors {report['errors']} "
+          f"in {report['wall_seconds']:.2f}s -> {report['throughput_per_second']:.2f} users/s")
+    table("scenario", report['scenarios'])
+    table("stage", report['stages'])
+    print(f"\ndownloaded {report['bytes_downloaded'] / MB:.1f} MB, uploaded {report['bytes_uploaded'] / MB:.1f} MB, "
+          f"gemini requests {report['gemini_requests']}, media cache hit rate {report['media_cache']['hit_rate']:.0%}")
+    print(f"peak RSS {report['peak_rss_bytes'] / MB:.1f} MB (children {report['peak_child_rss_bytes'] / MB:.1f} MB), "
+          f"peak scratch disk {report['peak_disk_bytes'] / MB:.1f} MB")
+
+
+def check_thresholds(report: dict, max_p95: list, max_errors) -> list:
+    failures = []
+    for name, limit in max_p95:
+        row = report['stages'].get(name) or report['scenarios'].get(name)
+        if row is None:
+            failures.append(f"no samples for {name}")
+        elif row['p95'] > limit:
+            failures.append(f"p95 of {name} is {row['p95']:.3f}s, limit {limit:.3f}s")
+    if max_errors is not None and report['errors'] > max_errors:
+        failures.append(f"{report['errors']} failed users, limit {max_errors}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20, help="simulated users, each runs one scenario")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix("chat=4,audio=3,subtitles=2,1080p=1"),
+                        help=f"weighted scenario mix, scenarios: {', '.join(SCENARIOS)}")
+    parser.add_argument('--videos', type=int, default=5, help="distinct videos the users pick from (fewer = more cache hits)")
+    parser.add_argument('--ramp', type=float, default=2.0, help="seconds over which users arrive")
+    parser.add_argument('--video-mb', type=float, default=8, help="size of the 1080p stream, other streams scale from it")
+    parser.add_argument('--stream-mbps', type=float, default=200, help="bandwidth per stream connection, 0 = unlimited")
+    parser.add_argument('--upload-mbps', type=float, default=400, help="Telegram upload bandwidth per request, 0 = unlimited")
+    parser.add_argument('--latency', type=float, default=0.05, help="round trip of metadata and Bot API requests")
+    parser.add_argument('--gemini-latency', type=float, default=0.3)
+    parser.add_argument('--gemini-error-rate', type=float, default=0.0)
+    parser.add_argument('--fake-mux', action='store_true', help="concatenate instead of running FFmpeg (implied when ffmpeg is missing)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="also write the report to this file")
+    parser.add_argument('--max-p95', type=parse_threshold, action='append', default=[], metavar='NAME=SECONDS',
+                        help="fail if the p95 of a stage or scenario exceeds SECONDS")
+    parser.add_argument('--max-errors', type=int, help="fail if more users than this did not get their answer")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    media = FakeMediaServer(args.video_mb, args.latency, args.stream_mbps * MB / 8 or None).start()
+    bot_api = FakeBotAPI(args.latency, args.upload_mbps * MB / 8 or None).start()
+    gemini = FakeGemini(args.gemini_latency, args.gemini_error_rate).start()
+    FakeYouTube.server_url = media.url
+
+    # Scratch files and the SQLite databases stay out of the working tree
+    cwd = os.getcwd()
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = tempfile.mkdtemp(prefix="load_test_")
+    os.chdir(workdir)
+    fake_mux = args.fake_mux or shutil.which('ffmpeg') is None
+    os.environ.update({
+        'GEMINI_API_KEY': 'load-test',
+        'GEMINI_BASE_URL': gemini.base_url,
+        'GEMINI_REQUESTS_PER_MINUTE': os.environ.get('GEMINI_REQUESTS_PER_MINUTE', '100000'),
+        # The stand-in merge only exists in this process
+        'JOB_MUX_PROCESSES': '0' if fake_mux else os.environ.get('JOB_MUX_PROCESSES', '1'),
+    })
+
+    import youtube_extraction
+    youtube_extraction.YouTube = FakeYouTube
+    if fake_mux:
+        install_fake_mux()
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    recorder = Recorder()
+    try:
+        load = asyncio.run(run_load(args, media, bot_api, recorder))
+        report = build_report(args, load, media, bot_api, gemini, recorder)
+        report['config']['fake_mux'] = fake_mux
+    finally:
+        for server in (media, bot_api, gemini):
+            server.stop()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(report)
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    failures = check_thresholds(report, args.max_p95, args.max_errors)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Posts synthetic Telegram updates to a running bot in webhook mode, to try the listener without Telegram.
+
+    # Terminal 1: the bot, replying to a local stand-in instead of api.telegram.org
+    BOT_MODE=webhook WEBHOOK_URL=http://127.0.0.1:8443 WEBHOOK_SECRET=test BOT_API_BASE_URL=http://127.0.0.1:8081/bot python main.py
+    # Terminal 2: the stand-in Bot API and the updates
+    python benchmarks/post_updates.py --url http://127.0.0.1:8443/telegram --secret test --bot-api-port 8081 --chats 20 --messages 5
+
+Every chat sends its messages back to back from its own thread, so the bot sees many chats at once.
+With --bot-api-port the replies are collected by the stand-in and counted per chat.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import urllib.request
+from urllib.error import HTTPError, URLError
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeBotAPI
+
+
+def make_update(update_id: int, chat_id: int, text: str) -> dict:
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f"user{chat_id}"},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def post(url: str, secret: str, update: dict) -> tuple[int, float]:
+    headers = {'Content-Type': 'application/json'}
+    if secret:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+    request = urllib.request.Request(url, data=json.dumps(update).encode('utf-8'), headers=headers)
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            status = response.status
+    except HTTPError as e:
+        status = e.code
+    except URLError:
+        status = 0
+    return status, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', required=True, help="webhook URL of the bot, WEBHOOK_URL + '/' + WEBHOOK_PATH")
+    parser.add_argument('--secret', help="WEBHOOK_SECRET of the bot")
+    parser.add_argument('--chats', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=5, help="messages per chat")
+    parser.add_argument('--text', default="/help", help="text of every message")
+    parser.add_argument('--bot-api-port', type=int, help="serve a stand-in Bot API on this port and count the replies")
+    parser.add_argument('--wait', type=float, default=5, help="seconds to wait for replies")
+    args = parser.parse_args()
+
+    bot_api = FakeBotAPI(latency=0, port=args.bot_api_port).start() if args.bot_api_port else None
+
+    def run_chat(index: int) -> list:
+        chat_id = 1000 + index
+        return [post(args.url, args.secret, make_update(index * args.messages + n + 1, chat_id, args.text))
+                for n in range(args.messages)]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.chats) as pool:
+        results = [r for chat in pool.map(run_chat, range(args.chats)) for r in chat]
+    elapsed = time.perf_counter() - started
+
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    latencies = sorted(seconds for _, seconds in results)
+    print(f"posted {len(results)} updates in {elapsed:.2f}s, statuses {statuses}")
+    print(f"post latency p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms")
+
+    if bot_api:
+        time.sleep(args.wait)
+        replies = [len(bot_api.delivered(1000 + index)) for index in range(args.chats)]
+        print(f"replies per chat: min {min(replies)}, max {max(replies)}, total {sum(replies)}")
+        bot_api.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import re
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+from urllib.parse import urlparse, parse_qs
+
+# A YouTube video ID is always 11 characters from the URL-safe base64 alphabet
+VIDEO_ID_RE = re.compile(r'^[0-9A-Za-z_-]{11}$')
+YOUTUBE_HOSTS = {'youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com', 'youtube-nocookie.com', 'www.youtube-nocookie.com'}
+PATH_PREFIXES = ('shorts', 'embed', 'live', 'v', 'e')
+CHANNEL_PREFIXES = ('channel', 'c', 'user')
+PLAYLIST_ID_RE = re.compile(r'^[0-9A-Za-z_-]{10,64}$')
+
+
+def extract_video_id(url: str) -> Optional[str]:
+    """
+    Returns the canonical video ID for any YouTube URL shape, or None.
+    Handles youtu.be/<id>, watch?v=<id>, /shorts/<id>, /embed/<id> and /live/<id> on www, m. and music. hosts.
+    """
+    url = url.strip()
+    if '://' not in url:
+        url = 'https://' + url
+
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return None
+
+    host = (parsed.hostname or '').lower()
+    parts = [p for p in parsed.path.split('/') if p]
+    candidate = None
+
+    if host == 'youtu.be':
+        candidate = parts[0] if parts else None
+    elif host in YOUTUBE_HOSTS:
+        if parts and parts[0] == 'watch':
+            candidate = parse_qs(parsed.query).get('v', [None])[0]
+        elif len(parts) >= 2 and parts[0] in PATH_PREFIXES:
+            candidate = parts[1]
+
+    if candidate and VIDEO_ID_RE.match(candidate):
+        return candidate
+    return None
+
+
+def extract_batch_link(url: str) -> Optional[tuple[str, str]]:
+    """
+    Returns ('playlist', url) or ('channel', url) with a canonical URL for playlist and channel links, or None.
+    Handles /playlist?list=<id>, /@handle, /channel/<id>, /c/<name> and /user/<name>; a watch link that
+    also carries a list= is a single video.
+    """
+    url = url.strip()
+    if '://' not in url:
+        url = 'https://' + url
+
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return None
+
+    if (parsed.hostname or '').lower() not in YOUTUBE_HOSTS:
+        return None
+    parts = [p for p in parsed.path.split('/') if p]
+    if not parts:
+        return None
+
+    if parts[0] == 'playlist':
+        playlist_id = parse_qs(parsed.query).get('list', [None])[0]
+        if playlist_id and PLAYLIST_ID_RE.match(playlist_id):
+            return 'playlist', f"https://www.youtube.com/playlist?list={playlist_id}"
+    elif parts[0].startswith('@') and len(parts[0]) > 1:
+        return 'channel', f"https://www.youtube.com/{parts[0]}"
+    elif parts[0] in CHANNEL_PREFIXES and len(parts) >= 2:
+        return 'channel', f"https://www.youtube.com/{parts[0]}/{parts[1]}"
+    return None
+
+
+def canonical_url(video_id: str) -> str:
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+
+class TTLCache:
+    """
+    A thread-safe, size-bounded LRU cache whose entries also expire after ttl seconds.
+    Keeps hit/miss counters so callers can report cache efficiency.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 1800.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return entry[1] if entry is not None else default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses, 'hit_rate': round(self.hit_rate, 3)}
@@ -1,11 +1,18 @@
 import os
-import requests
-import json
 import time
+import random
+import asyncio
 import logging
+from typing import Optional
+
+import httpx
 
 # Import Files
 from prompts import system_prompt
+from ratelimit import TokenBucket
+from cache import TTLCache
+from chat_memory import ConversationStore, normalize_prompt
+from metrics import registry, GEMINI_SECONDS, GEMINI_RETRIES
 
 
 # Configure logging
@@ -14,60 +21,174 @@ logger = logging.getLogger(__name__)
 
 # --- Configuration ---
 GEMINI_MODEL = "gemini-2.5-flash-preview-09-2025"
-API_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/models/"
+API_BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta/models/")
+
+# Size these to the API quota of your Gemini key
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+GEMINI_REQUESTS_PER_MINUTE = float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "60"))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "30"))
+# How long a chat may wait for a free slot before we answer that we're busy
+GEMINI_QUEUE_TIMEOUT = float(os.getenv("GEMINI_QUEUE_TIMEOUT", "20"))
+
+# Conversation memory: token budget per chat, idle eviction and optional SQLite file
+CHAT_HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", "2000"))
+CHAT_HISTORY_MAX_CHATS = int(os.getenv("CHAT_HISTORY_MAX_CHATS", "1000"))
+CHAT_HISTORY_IDLE_TTL = float(os.getenv("CHAT_HISTORY_IDLE_TTL", "3600"))
+CHAT_HISTORY_DB = os.getenv("CHAT_HISTORY_DB") or None
+# Cache for answers to context-free prompts (greetings, one-off translations)
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "500"))
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", "3600"))
+CHAT_CACHE_MAX_PROMPT = 300
 
 # System Instruction to define the agent's persona and rules
 SYSTEM_PROMPT = system_prompt
 
-def generate_response(user_prompt: str) -> str:
+# Status codes worth retrying
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_client: Optional[httpx.AsyncClient] = None
+conversations = ConversationStore(CHAT_HISTORY_TOKENS, CHAT_HISTORY_MAX_CHATS, CHAT_HISTORY_IDLE_TTL, CHAT_HISTORY_DB)
+response_cache = TTLCache(maxsize=CHAT_CACHE_SIZE, ttl=CHAT_CACHE_TTL)
+_concurrency = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+_rate_limiter = TokenBucket(rate=GEMINI_REQUESTS_PER_MINUTE / 60, capacity=GEMINI_MAX_CONCURRENCY)
+registry.register_cache('chat_response', response_cache.stats)
+
+
+def _get_client() -> httpx.AsyncClient:
+    """Returns the shared keep-alive client, creating it on first use inside the running event loop."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=API_BASE_URL,
+            timeout=httpx.Timeout(GEMINI_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_connections=GEMINI_MAX_CONCURRENCY, max_keepalive_connections=GEMINI_MAX_CONCURRENCY, keepalive_expiry=120),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _in_store(func, *args):
+    # With SQLite persistence the conversation store does blocking reads and writes
+    if conversations.persistent:
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
+
+
+async def reset_conversation(chat_id: int):
+    await _in_store(conversations.clear, chat_id)
+
+
+def chat_stats() -> dict:
+    return {'conversations': conversations.stats(), 'response_cache': response_cache.stats()}
+
+
+async def generate_response(user_prompt: str, chat_id: Optional[int] = None) -> str:
+    history = await _in_store(conversations.history, chat_id) if chat_id is not None else []
+
+    # A prompt without earlier context gets the same answer for everyone, so it can be cached
+    cache_key = None
+    if not history and len(user_prompt) <= CHAT_CACHE_MAX_PROMPT:
+        cache_key = normalize_prompt(user_prompt)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            await _in_store(_remember_turn, chat_id, user_prompt, cached)
+            return cached
+
+    contents = [{"role": role, "parts": [{"text": text}]} for role, text in history]
+    contents.append({"role": "user", "parts": [{"text": user_prompt}]})
+
+    text, ok = await _request_gemini(contents)
+    if ok:
+        await _in_store(_remember_turn, chat_id, user_prompt, text)
+        if cache_key:
+            response_cache.set(cache_key, text)
+    return text
+
+
+def _remember_turn(chat_id: Optional[int], user_prompt: str, answer: str):
+    if chat_id is not None:
+        conversations.append(chat_id, 'user', user_prompt)
+        conversations.append(chat_id, 'model', answer)
+
+
+async def _request_gemini(contents: list) -> tuple[str, bool]:
+    """Calls Gemini with retries. Returns (text, ok); on failure text is a message for the user."""
     api_key = os.environ.get("GEMINI_API_KEY")
     if not api_key:
         logger.error("GEMINI_API_KEY environment variable not set.")
-        return "Error: API key not configured."
+        return "Error: API key not configured.", False
 
-    url = f"{API_BASE_URL}{GEMINI_MODEL}:generateContent?key={api_key}"
-    
     # Construct the payload
     payload = {
-        "contents": [
-            {"parts": [{"text": user_prompt}]}
-        ],
+        "contents": contents,
         "systemInstruction": {
             "parts": [{"text": SYSTEM_PROMPT}]
         },
     }
+    # Send the key as a header so it never shows up in request logs
+    headers = {'x-goog-api-key': api_key}
 
     # Exponential Backoff variables
     max_retries = 5
-    initial_delay = 1.0 
+    initial_delay = 1.0
 
     for attempt in range(max_retries):
+        # Wait for a free slot, but answer "busy" instead of queueing forever under load
+        try:
+            await asyncio.wait_for(_concurrency.acquire(), timeout=GEMINI_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Gemini concurrency limit reached, rejecting chat request.")
+            return "الان سرم خیلی شلوغه، چند لحظه دیگه دوباره پیام بده. 🙏", False
+
         try:
-            headers = {'Content-Type': 'application/json'}
-            response = requests.post(url, headers=headers, data=json.dumps(payload))
-            response.raise_for_status() # Raises an HTTPError for bad responses (4xx or 5xx)
+            await _rate_limiter.acquire()
+            started, outcome = time.perf_counter(), 'error'
+            try:
+                response = await _get_client().post(f"{GEMINI_MODEL}:generateContent", json=payload, headers=headers)
+                outcome = str(response.status_code)
+            except httpx.TimeoutException:
+                outcome = 'timeout'
+                raise
+            finally:
+                GEMINI_SECONDS.observe(time.perf_counter() - started, outcome=outcome)
+            response.raise_for_status() # Raises an HTTPStatusError for bad responses (4xx or 5xx)
 
             result = response.json()
-            
+
             # Extract the generated text
             if result.get('candidates') and result['candidates'][0].get('content'):
-                return result['candidates'][0]['content']['parts'][0]['text']
+                return result['candidates'][0]['content']['parts'][0]['text'], True
             else:
                 logger.warning(f"API response missing text content: {result}")
-                return "الان نمیتونم کامل جوابتو بدم، بعدا بهم پیام بده.😓"
-
-        except requests.exceptions.HTTPError as e:
-            if response.status_code in [429, 500, 503] and attempt < max_retries - 1:
-                # Implement exponential backoff for transient errors
-                delay = initial_delay * (2 ** attempt)
-                # Note: We do not log retries as errors, as per instruction
-                time.sleep(delay)
-            else:
-                logger.error(f"API Request failed with status {response.status_code}: {e}")
-                return f"ارور HTTP دارم!!!"
+                return "الان نمیتونم کامل جوابتو بدم، بعدا بهم پیام بده.😓", False
+
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code not in RETRY_STATUS_CODES or attempt == max_retries - 1:
+                logger.error(f"API Request failed with status {e.response.status_code}: {e}")
+                return f"ارور HTTP دارم!!!", False
 
-        except requests.exceptions.RequestException as e:
+        except httpx.TimeoutException as e:
+            if attempt == max_retries - 1:
+                logger.error(f"API Request timed out: {e}")
+                return "فعلا خوابم میاد بعدا باهام چت کن. 😴", False
+
+        except httpx.RequestError as e:
             logger.error(f"Network error during API call: {e}")
-            return "اینترنتم تموم شده لطفا به سازندم خبر بده. 🥲💔"
-            
-    return "فعلا خوابم میاد بعدا باهام چت کن. 😴"
\ No newline at end of file
+            return "اینترنتم تموم شده لطفا به سازندم خبر بده. 🥲💔", False
+
+        finally:
+            _concurrency.release()
+
+        # Exponential backoff with full jitter for transient errors, without blocking the event loop
+        # Note: We do not log retries as errors, as per instruction
+        delay = random.uniform(0, initial_delay * (2 ** attempt))
+        GEMINI_RETRIES.inc()
+        await asyncio.sleep(delay)
+
+    return "فعلا خوابم میاد بعدا باهام چت کن. 😴", False
@@ -0,0 +1,156 @@
+import re
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict, deque
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Rough size of a Gemini token, good enough to keep prompts under budget
+CHARS_PER_TOKEN = 4
+# Rows kept per chat when persistence is enabled
+PERSISTED_TURNS = 50
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def normalize_prompt(text: str) -> str:
+    """Normalizes a prompt for response caching: case, Arabic/Persian letter variants, whitespace and trailing punctuation."""
+    text = text.lower().replace('ي', 'ی').replace('ك', 'ک').replace('‌', ' ')
+    text = re.sub(r'\s+', ' ', text)
+    return text.strip(' .!?؟،,')
+
+
+class ConversationStore:
+    """
+    Per-chat conversation history held in memory.
+
+    Each chat keeps its most recent turns within token_budget, idle chats are dropped after idle_ttl seconds
+    and at most max_chats are kept (least recently active first out). When db_path is set, turns are also
+    written to SQLite so conversations survive restarts.
+    """
+
+    def __init__(self, token_budget: int = 2000, max_chats: int = 1000, idle_ttl: float = 3600.0, db_path: Optional[str] = None):
+        self.token_budget = token_budget
+        self.max_chats = max_chats
+        self.idle_ttl = idle_ttl
+        self.db_path = db_path
+        self._chats: OrderedDict = OrderedDict()  # chat_id -> (last_active, deque of (role, text, tokens))
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self._conn = None
+        if db_path:
+            self._init_db()
+
+    def _init_db(self):
+        try:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_history (
+                    chat_id INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    text TEXT NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_chat ON chat_history (chat_id)")
+            self._conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"SQLite error during chat history initialization: {e}")
+            self._conn = None
+
+    def _load(self, chat_id: int) -> deque:
+        turns = deque()
+        if self._conn is None:
+            return turns
+        try:
+            rows = self._conn.execute(
+                "SELECT role, text FROM chat_history WHERE chat_id = ? ORDER BY rowid DESC LIMIT ?",
+                (chat_id, PERSISTED_TURNS)
+            ).fetchall()
+            for role, text in reversed(rows):
+                turns.append((role, text, estimate_tokens(text)))
+            self._trim(turns)
+        except sqlite3.Error as e:
+            logger.error(f"SQLite error while loading chat history for {chat_id}: {e}")
+        return turns
+
+    def _trim(self, turns: deque):
+        total = sum(t[2] for t in turns)
+        while turns and total > self.token_budget:
+            total -= turns.popleft()[2]
+        # Gemini expects the conversation to start with a user turn
+        while turns and turns[0][0] != 'user':
+            turns.popleft()
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        idle = [chat_id for chat_id, (last_active, _) in self._chats.items() if now - last_active > self.idle_ttl]
+        for chat_id in idle:
+            del self._chats[chat_id]
+        if idle:
+            logger.info(f"Evicted {len(idle)} idle conversations.")
+
+    def _turns(self, chat_id: int) -> deque:
+        entry = self._chats.get(chat_id)
+        turns = entry[1] if entry else self._load(chat_id)
+        self._chats[chat_id] = (time.monotonic(), turns)
+        self._chats.move_to_end(chat_id)
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+        return turns
+
+    @property
+    def persistent(self) -> bool:
+        """Whether calls read or write SQLite (and so belong off the event loop)."""
+        return self._conn is not None
+
+    def history(self, chat_id: int) -> list[tuple[str, str]]:
+        """Returns the (role, text) turns that fit in the token budget, oldest first."""
+        with self._lock:
+            self._sweep()
+            return [(role, text) for role, text, _ in self._turns(chat_id)]
+
+    def append(self, chat_id: int, role: str, text: str):
+        with self._lock:
+            turns = self._turns(chat_id)
+            turns.append((role, text, estimate_tokens(text)))
+            self._trim(turns)
+
+            if self._conn is not None:
+                try:
+                    self._conn.execute("INSERT INTO chat_history (chat_id, role, text) VALUES (?, ?, ?)", (chat_id, role, text))
+                    self._conn.execute("""
+                        DELETE FROM chat_history WHERE chat_id = ? AND rowid NOT IN (
+                            SELECT rowid FROM chat_history WHERE chat_id = ? ORDER BY rowid DESC LIMIT ?
+                        )
+                    """, (chat_id, chat_id, PERSISTED_TURNS))
+                    self._conn.commit()
+                except sqlite3.Error as e:
+                    logger.error(f"SQLite error while saving chat history for {chat_id}: {e}")
+
+    def clear(self, chat_id: int):
+        with self._lock:
+            self._chats.pop(chat_id, None)
+            if self._conn is not None:
+                try:
+                    self._conn.execute("DELETE FROM chat_history WHERE chat_id = ?", (chat_id,))
+                    self._conn.commit()
+                except sqlite3.Error as e:
+                    logger.error(f"SQLite error while clearing chat history for {chat_id}: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'chats': len(self._chats),
+                'turns': sum(len(turns) for _, turns in self._chats.values()),
+                'persistent': self.persistent,
+            }
@@ -1,17 +1,65 @@
+import os
+import csv
+import gzip
+import json
+import queue
+import re
+import shutil
 import sqlite3
+import tempfile
 import logging
+import threading
+from collections import OrderedDict
 from datetime import datetime
-from typing import Optional
+from typing import Iterator, Optional
 
 logger = logging.getLogger(__name__)
 DB_NAME = 'bot_users.db'
 
+# --- Write-behind configuration ---
+# User upserts are queued and written in batches by a background thread
+WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "200"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("DB_WRITE_FLUSH_INTERVAL", "1.0"))
+# Users whose details haven't changed since we last saw them are not written again
+RECENTLY_SEEN_SIZE = int(os.getenv("DB_RECENTLY_SEEN_SIZE", "10000"))
+
+# Pages copied per backup step; writers get the database back between steps
+BACKUP_PAGES_PER_STEP = 256
+EXPORT_FORMATS = ('db', 'csv', 'jsonl')
+USER_COLUMNS = ('user_id', 'first_name', 'last_name', 'username', 'join_time')
+
+_STOP = object()
+_local = threading.local()
+_write_queue: queue.Queue = queue.Queue()
+_writer: Optional[threading.Thread] = None
+_recently_seen: OrderedDict = OrderedDict()
+_seen_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_NAME, timeout=30)
+    # WAL lets readers run while the writer commits; NORMAL sync is safe with WAL and avoids an fsync per commit
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def get_connection() -> sqlite3.Connection:
+    """Returns this thread's long-lived connection to the bot database (one per thread, never closed)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _connect()
+        _local.conn = conn
+    return conn
+
+
 def init_db():
-    """Initializes the SQLite database and creates the users table if it doesn't exist."""
+    """Initializes the SQLite database, creates the users table if it doesn't exist and starts the background writer."""
+    global _writer
     try:
-        conn = sqlite3.connect(DB_NAME)
+        conn = get_connection()
         cursor = conn.cursor()
-        
+
         cursor.execute(f"""
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -22,45 +70,178 @@ def init_db():
             )
         """)
         conn.commit()
-        conn.close()
         logger.info(f"Database {DB_NAME} initialized and 'users' table ensured.")
     except sqlite3.Error as e:
         logger.error(f"SQLite error during initialization: {e}")
 
+    if _writer is None or not _writer.is_alive():
+        _writer = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+        _writer.start()
+
+
 def add_or_update_user(user_id: int, first_name: str, last_name: Optional[str], username: Optional[str]):
+    """Queues an upsert of the user's details. Returns immediately; the background writer stores it."""
+    # Sanitize data (convert None to empty string for database)
+    record = (first_name, last_name or '', username or '')
+
+    with _seen_lock:
+        if _recently_seen.get(user_id) == record:
+            _recently_seen.move_to_end(user_id)
+            return
+        _recently_seen[user_id] = record
+        _recently_seen.move_to_end(user_id)
+        while len(_recently_seen) > RECENTLY_SEEN_SIZE:
+            _recently_seen.popitem(last=False)
+
+    join_time = datetime.now().isoformat()
+    _write_queue.put((user_id, *record, join_time))
+
+
+def _write_batch(conn: sqlite3.Connection, batch: list):
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        # Check if the user already exists
-        cursor.execute("SELECT join_time FROM users WHERE user_id = ?", (user_id,))
-        existing_user = cursor.fetchone()
-
-        # Sanitize data (convert None to empty string for database)
-        last_name_sane = last_name or ''
-        username_sane = username or ''
-
-        if existing_user:
-            # User exists: Update name/username (in case they changed it)
-            cursor.execute("""
-                UPDATE users SET
-                    first_name = ?,
-                    last_name = ?,
-                    username = ?
-                WHERE user_id = ?
-            """, (first_name, last_name_sane, username_sane, user_id))
-            logger.info(f"User {user_id} updated.")
-        else:
-            # User is new: Insert new record with current time
-            join_time = datetime.now().isoformat()
-            cursor.execute("""
-                INSERT INTO users (user_id, first_name, last_name, username, join_time)
-                VALUES (?, ?, ?, ?, ?)
-            """, (user_id, first_name, last_name_sane, username_sane, join_time))
-            logger.info(f"New user {user_id} added at {join_time}.")
-            
+        # New users get their join_time, existing users only get their names refreshed
+        conn.executemany("""
+            INSERT INTO users (user_id, first_name, last_name, username, join_time)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                first_name = excluded.first_name,
+                last_name = excluded.last_name,
+                username = excluded.username
+        """, batch)
         conn.commit()
-        conn.close()
-        
+        logger.info(f"Stored {len(batch)} user record(s).")
     except sqlite3.Error as e:
-        logger.error(f"SQLite error during user data handling for user {user_id}: {e}")
\ No newline at end of file
+        logger.error(f"SQLite error during user data handling for {len(batch)} user(s): {e}")
+        # Forget them so the next /start retries the write
+        with _seen_lock:
+            for row in batch:
+                _recently_seen.pop(row[0], None)
+
+
+def _writer_loop():
+    conn = _connect()
+    stopping = False
+    while not stopping:
+        item = _write_queue.get()
+        if item is _STOP:
+            _write_queue.task_done()
+            break
+
+        # Collect whatever else arrives within the flush interval into the same transaction
+        batch = [item]
+        try:
+            while len(batch) < WRITE_BATCH_SIZE:
+                item = _write_queue.get(timeout=WRITE_FLUSH_INTERVAL)
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+        except queue.Empty:
+            pass
+
+        _write_batch(conn, batch)
+        for _ in range(len(batch) + stopping):
+            _write_queue.task_done()
+    conn.close()
+
+
+def flush_users():
+    """Blocks until every queued user write has been committed."""
+    if _writer is not None and _writer.is_alive():
+        _write_queue.join()
+
+
+def close_db():
+    """Flushes pending writes and stops the background writer."""
+    global _writer
+    if _writer is not None and _writer.is_alive():
+        _write_queue.put(_STOP)
+        _writer.join()
+    _writer = None
+
+
+def snapshot_db(dest_path: str):
+    """Copies a consistent snapshot of the live database to dest_path with the online backup API."""
+    dest = sqlite3.connect(dest_path)
+    try:
+        # Copy in small steps so concurrent writers are never blocked for long
+        get_connection().backup(dest, pages=BACKUP_PAGES_PER_STEP)
+    finally:
+        dest.close()
+
+
+def iter_users(conn: sqlite3.Connection, since: Optional[str] = None) -> Iterator[tuple]:
+    """Yields user rows one at a time (optionally only users who joined at or after `since`)."""
+    query = f"SELECT {', '.join(USER_COLUMNS)} FROM users"
+    params = ()
+    if since:
+        query += " WHERE join_time >= ?"
+        params = (since,)
+    yield from conn.execute(query + " ORDER BY join_time", params)
+
+
+def export_users_file(fmt: str, since: Optional[str] = None) -> str:
+    """
+    Exports the users table as a gzip-compressed SQLite database, CSV or JSONL file and returns its path.
+    Rows are streamed from a snapshot, so the table is never loaded into memory and writers are not blocked.
+    The caller removes the returned file's directory with remove_export().
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    # Make sure queued /start records are part of the export
+    flush_users()
+
+    export_dir = tempfile.mkdtemp(prefix="export_")
+    snapshot_path = os.path.join(export_dir, "snapshot.db")
+    snapshot_db(snapshot_path)
+    suffix = f"_since_{since[:10]}" if since else ""
+    out_path = os.path.join(export_dir, f"users{suffix}.{fmt}.gz")
+
+    snapshot = sqlite3.connect(snapshot_path)
+    try:
+        if fmt == 'db':
+            # A database of its own holding only the users table, so other tables never leave the server
+            users_path = os.path.join(export_dir, "users.db")
+            snapshot.execute("ATTACH DATABASE ? AS export", (users_path,))
+            schema = snapshot.execute(
+                "SELECT sql FROM sqlite_master WHERE tbl_name = 'users' AND sql IS NOT NULL ORDER BY type = 'index'"
+            ).fetchall()
+            for (sql,) in schema:
+                # CREATE TABLE users / CREATE INDEX name ON users -> the same in the attached database
+                snapshot.execute(re.sub(r'^(CREATE (?:UNIQUE )?(?:TABLE|INDEX) (?:IF NOT EXISTS )?)', r'\1export.', sql))
+            query = "INSERT INTO export.users SELECT * FROM users"
+            params = ()
+            if since:
+                query += " WHERE join_time >= ?"
+                params = (since,)
+            snapshot.execute(query, params)
+            snapshot.commit()
+            snapshot.execute("DETACH DATABASE export")
+            try:
+                with open(users_path, 'rb') as src, gzip.open(out_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+            finally:
+                os.remove(users_path)
+
+        elif fmt == 'csv':
+            with gzip.open(out_path, 'wt', encoding='utf-8', newline='') as dst:
+                writer = csv.writer(dst)
+                writer.writerow(USER_COLUMNS)
+                for row in iter_users(snapshot, since):
+                    writer.writerow(row)
+
+        else:
+            with gzip.open(out_path, 'wt', encoding='utf-8') as dst:
+                for row in iter_users(snapshot, since):
+                    dst.write(json.dumps(dict(zip(USER_COLUMNS, row)), ensure_ascii=False) + "\n")
+    finally:
+        snapshot.close()
+        os.remove(snapshot_path)
+
+    logger.info(f"Exported users as {fmt} to {out_path}.")
+    return out_path
+
+
+def remove_export(path: str):
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
@@ -0,0 +1,241 @@
+import os
+import json
+import zlib
+import hashlib
+import logging
+import threading
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Optional
+
+# Import Files
+from metrics import TRANSFER_BYTES
+from ratelimit import BandwidthShaper
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+DOWNLOAD_CONNECTIONS = int(os.getenv("DOWNLOAD_CONNECTIONS", "4"))
+# YouTube throttles single range requests above ~10MB, so stay just below that
+SEGMENT_SIZE = int(os.getenv("DOWNLOAD_SEGMENT_SIZE", str(9 * 1024 * 1024)))
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "30"))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "3"))
+# Total download rate of this process in MB/s over all streams, 0 = unlimited
+DOWNLOAD_MAX_MBPS = float(os.getenv("DOWNLOAD_MAX_MBPS", "0"))
+CHUNK_SIZE = 64 * 1024
+USER_AGENT = "Mozilla/5.0"
+
+
+# Shared by every download thread so concurrent jobs split the configured bandwidth
+bandwidth = BandwidthShaper(DOWNLOAD_MAX_MBPS * 1024 * 1024)
+
+
+class DownloadError(Exception):
+    """Raised when a stream could not be fully downloaded; the partial file is kept for resuming."""
+
+
+def _request(url: str, start: Optional[int] = None, end: Optional[int] = None, timeout: float = DOWNLOAD_TIMEOUT):
+    headers = {'User-Agent': USER_AGENT}
+    if start is not None:
+        headers['Range'] = f"bytes={start}-{end}"
+    return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
+
+
+def content_length(url: str) -> int:
+    """Asks the server for the full size of url with a one-byte range request."""
+    with _request(url, 0, 0) as response:
+        content_range = response.headers.get('Content-Range')
+        if content_range and '/' in content_range:
+            return int(content_range.rsplit('/', 1)[1])
+        return int(response.headers['Content-Length'])
+
+
+class _Segments:
+    """Tracks finished segments and their CRC32 in a JSON sidecar so an interrupted download can resume."""
+
+    def __init__(self, state_path: str, size: int, segment_size: int):
+        self.state_path = state_path
+        self.size = size
+        self.segment_size = segment_size
+        self.done: dict[int, int] = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(state_path):
+            try:
+                with open(state_path) as f:
+                    state = json.load(f)
+                if state['size'] == size and state['segment_size'] == segment_size:
+                    self.done = {int(k): v for k, v in state['done'].items()}
+            except (OSError, ValueError, KeyError):
+                logger.warning(f"Ignoring unreadable download state {state_path}.")
+
+    @property
+    def ranges(self) -> list[tuple[int, int, int]]:
+        """(index, first byte, last byte) of every segment."""
+        return [(i, start, min(start + self.segment_size, self.size) - 1)
+                for i, start in enumerate(range(0, self.size, self.segment_size))]
+
+    def mark_done(self, index: int, crc: int):
+        with self._lock:
+            self.done[index] = crc
+            tmp_path = self.state_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'size': self.size, 'segment_size': self.segment_size, 'done': self.done}, f)
+            os.replace(tmp_path, self.state_path)
+
+
+def _crc_of_range(fd: int, start: int, end: int) -> int:
+    crc, offset = 0, start
+    while offset <= end:
+        chunk = os.pread(fd, min(CHUNK_SIZE, end - offset + 1), offset)
+        if not chunk:
+            break
+        crc = zlib.crc32(chunk, crc)
+        offset += len(chunk)
+    return crc
+
+
+def download_segmented(url: str, dest_path: str, size: Optional[int] = None,
+                       connections: int = DOWNLOAD_CONNECTIONS, segment_size: int = SEGMENT_SIZE,
+                       expected_sha256: Optional[str] = None, retries: int = DOWNLOAD_RETRIES,
+                       on_progress: Optional[Callable[[int, int], None]] = None) -> str:
+    """
+    Downloads url to dest_path over several parallel range requests.
+
+    Data is written into `dest_path.part` and finished segments are recorded with their CRC32 in
+    `dest_path.part.json`. A failed run (or a later call with the same dest_path) resumes from there
+    after re-verifying the recorded segments; a complete dest_path of the right size is kept as it is. The result is checked against the expected length and,
+    if given, its SHA-256 before being renamed to dest_path. on_progress(done_bytes, total_bytes) is
+    called from the download threads.
+    """
+    if size is None:
+        size = content_length(url)
+    # Finished by an earlier attempt whose other streams failed
+    if not expected_sha256 and os.path.exists(dest_path) and os.path.getsize(dest_path) == size:
+        if on_progress:
+            on_progress(size, size)
+        return dest_path
+
+    part_path = dest_path + '.part'
+    segments = _Segments(part_path + '.json', size, segment_size)
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+    progress_lock = threading.Lock()
+    downloaded = [0]
+
+    def report(amount: int):
+        if on_progress:
+            with progress_lock:
+                downloaded[0] += amount
+                on_progress(downloaded[0], size)
+
+    def fetch(index: int, start: int, end: int):
+        crc, offset = 0, start
+        try:
+            with _request(url, start, end) as response:
+                if response.status != 206 and (start, end) != (0, size - 1):
+                    raise DownloadError(f"Server ignored range request (status {response.status}).")
+                while offset <= end:
+                    chunk = response.read(min(CHUNK_SIZE, end - offset + 1))
+                    if not chunk:
+                        break
+                    os.pwrite(fd, chunk, offset)
+                    crc = zlib.crc32(chunk, crc)
+                    offset += len(chunk)
+                    report(len(chunk))
+                    bandwidth.consume(len(chunk))
+            if offset != end + 1:
+                raise DownloadError(f"Segment {index} ended after {offset - start} of {end - start + 1} bytes.")
+        except BaseException:
+            # This segment will be fetched again from its start
+            report(start - offset)
+            raise
+        finally:
+            TRANSFER_BYTES.inc(offset - start, direction='download')
+        segments.mark_done(index, crc)
+
+    try:
+        os.ftruncate(fd, size)
+
+        # Resumed segments are only trusted if their bytes still match the recorded checksum
+        for index, start, end in segments.ranges:
+            if index in segments.done:
+                if _crc_of_range(fd, start, end) == segments.done[index]:
+                    report(end - start + 1)
+                else:
+                    del segments.done[index]
+
+        for attempt in range(retries):
+            missing = [r for r in segments.ranges if r[0] not in segments.done]
+            if not missing:
+                break
+            with ThreadPoolExecutor(max_workers=max(1, min(connections, len(missing))), thread_name_prefix="segment") as pool:
+                futures = [pool.submit(fetch, *r) for r in missing]
+                errors = [f.exception() for f in futures if f.exception()]
+            if errors:
+                logger.warning(f"{len(errors)} segment(s) of {os.path.basename(dest_path)} failed (attempt {attempt + 1}/{retries}): {errors[0]}")
+
+        missing = [r for r in segments.ranges if r[0] not in segments.done]
+        if missing:
+            raise DownloadError(f"{len(missing)} segment(s) still missing after {retries} attempts.")
+
+        # Reassembly checks: total length, then the optional whole-file checksum
+        if os.fstat(fd).st_size != size:
+            raise DownloadError(f"Downloaded file has {os.fstat(fd).st_size} bytes, expected {size}.")
+        if expected_sha256:
+            digest = hashlib.sha256()
+            for offset in range(0, size, CHUNK_SIZE * 16):
+                digest.update(os.pread(fd, CHUNK_SIZE * 16, offset))
+            if digest.hexdigest() != expected_sha256.lower():
+                # The data is wrong somewhere, resuming would only keep the bad bytes
+                if os.path.exists(segments.state_path):
+                    os.remove(segments.state_path)
+                raise DownloadError("SHA-256 mismatch after reassembly.")
+    finally:
+        os.close(fd)
+
+    os.replace(part_path, dest_path)
+    if os.path.exists(segments.state_path):
+        os.remove(segments.state_path)
+    return dest_path
+
+
+def download_stream(stream, output_path: str, filename: Optional[str] = None, **kwargs) -> str:
+    """Segmented replacement for pytubefix's Stream.download(output_path, filename)."""
+    dest_path = os.path.join(output_path, filename or stream.default_filename)
+    return download_segmented(stream.url, dest_path, size=stream.filesize, **kwargs)
+
+
+def iter_segments(url: str, size: Optional[int] = None, segment_size: int = SEGMENT_SIZE,
+                  lookahead: int = 2, retries: int = DOWNLOAD_RETRIES) -> Iterator[bytes]:
+    """
+    Yields the content of url in order, one segment at a time, without touching the disk.
+    Up to `lookahead` following segments are fetched in parallel while the current one is consumed.
+    """
+    if size is None:
+        size = content_length(url)
+
+    def fetch(start: int, end: int) -> bytes:
+        for attempt in range(retries):
+            try:
+                with _request(url, start, end) as response:
+                    data = response.read()
+                TRANSFER_BYTES.inc(len(data), direction='download')
+                bandwidth.consume(len(data))
+                if len(data) == end - start + 1:
+                    return data
+                error = DownloadError(f"Range {start}-{end} returned {len(data)} bytes.")
+            except OSError as e:
+                error = e
+            logger.warning(f"Range {start}-{end} failed (attempt {attempt + 1}/{retries}): {error}")
+        raise DownloadError(f"Range {start}-{end} failed after {retries} attempts: {error}")
+
+    ranges = [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+    with ThreadPoolExecutor(max_workers=max(1, lookahead), thread_name_prefix="segment") as pool:
+        pending = deque()
+        for start, end in ranges:
+            pending.append(pool.submit(fetch, start, end))
+            if len(pending) > lookahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -1,65 +1,349 @@
 import os
+import re
+import math
 import logging
 import docx 
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+import asyncio
+import zipfile
+from io import BytesIO
+from dataclasses import asdict, replace
+from typing import Optional
+from datetime import datetime
+from telegram import Bot, Update, Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes, CallbackContext
 
 # Import Files
-from youtube_extraction import YoutubeVideo
-from database import add_or_update_user
-from chat_agent import generate_response
+from youtube_extraction import FormatSpec, AUDIO_SPEC, MUX_JOBS, TranscodeJob, ClipJob, mux, load_video, parse_clock, format_clock, iter_batch_links
+from cache import TTLCache, extract_video_id, extract_batch_link
+from subtitles import render, paragraphs as subtitle_paragraphs
+from jobs import job_engine, download_flights, JobLimitError, JobRateError, JOBS_REJECTED
+from database import add_or_update_user, export_users_file, remove_export, EXPORT_FORMATS
+from media_cache import get_cached_media, store_media, invalidate_media
+from chat_agent import generate_response, reset_conversation
+from metrics import registry, STAGE_SECONDS, TRANSFER_BYTES, GEMINI_SECONDS, GEMINI_RETRIES
+from task_queue import open_task_queue, QUEUE_MAX_ATTEMPTS
+from storage import StorageFullError, remove_job_file
+from progress import ProgressMessage
+from prefetch import prefetcher
+from batch import BatchPipeline, BatchItem, BATCH_MAX_VIDEOS
 
 logger = logging.getLogger(__name__)
 
 
+# Quality buttons look like "🎥 720 P" or, once the size is known, "🎥 720 P · 48.2 MB"
+QUALITY_BUTTON_RE = re.compile(r'^🎥 (\d+) P(?: · [\d.]+ MB)?$')
+# Batch buttons for a playlist or channel look like "📚 Audio" or "📚 720 P"
+BATCH_BUTTON_RE = re.compile(r'^📚 (?:Audio|(\d+) P)$')
+BATCH_RESOLUTIONS = (360, 720)
+# A time range after the link asks for a clip: "<link> 1:30-2:45" (SS, MM:SS or HH:MM:SS)
+CLOCK = r'\d+(?::\d{1,2}){0,2}(?:\.\d+)?'
+CLIP_RE = re.compile(rf'\s+({CLOCK})\s*-\s*({CLOCK})\s*$')
+
+# Subtitle file formats offered on the subtitle keyboard
+SUBTITLE_FORMAT_BUTTONS = {"📄 Word": 'docx', "⏱ SRT": 'srt', "⏱ VTT": 'vtt'}
+SUBTITLE_FORMAT_NAMES = {'docx': 'Word Document', 'srt': 'SRT', 'vtt': 'WebVTT'}
+ALL_SUBTITLES_BUTTON = "🌐 All languages"
+# Caption tracks fetched at the same time for a multi-language request, and the most one request may ask for
+SUBTITLE_FANOUT = int(os.getenv("SUBTITLE_FANOUT", "4"))
+MAX_SUBTITLE_LANGUAGES = 30
+# Generated subtitle files keyed by (video_id, languages, format)
+subtitle_files = TTLCache(maxsize=64, ttl=3600)
+registry.register_cache('subtitle_file', subtitle_files.stats)
+
+CAPTION = "📥 دانلود سریع" + " | " + "@Aurora_D0wnload_bot"
+
+# Shared queue for worker processes (None: downloads run in this process)
+task_queue = open_task_queue()
+MEDIA_TASK = "media"
+# Progress message of every download running in this process, keyed by (video_id, file_type)
+active_progress: dict[tuple, ProgressMessage] = {}
+
+
+async def reply_media(update: Update, media_type: str, media, caption: str, **kwargs) -> Message:
+    """Sends a local path, file object or Telegram file_id with the reply method matching media_type."""
+    if media_type == "audio":
+        return await update.message.reply_audio(audio=media, caption=caption, **kwargs)
+    if media_type == "video":
+        return await update.message.reply_video(video=media, caption=caption, **kwargs)
+    return await update.message.reply_document(document=media, caption=caption, **kwargs)
+
+
+async def send_media(bot: Bot, chat_id: int, media_type: str, media, caption: str, **kwargs) -> Message:
+    """Like reply_media, for callers without an Update (worker processes)."""
+    if media_type == "audio":
+        return await bot.send_audio(chat_id, audio=media, caption=caption, **kwargs)
+    if media_type == "video":
+        return await bot.send_video(chat_id, video=media, caption=caption, **kwargs)
+    return await bot.send_document(chat_id, document=media, caption=caption, **kwargs)
+
+
+async def delivered_spec(link: str, spec: FormatSpec) -> FormatSpec:
+    """spec as it comes out for this video: transcoded audio gets the bitrate it is really sent at, which names the file."""
+    if not spec.audio_codec:
+        return spec
+    try:
+        video = await job_engine.run_network(load_video, link)
+        return await job_engine.run_network(video.delivered_spec, spec)
+    except Exception as e:
+        # The download fails the same way and reports it
+        logger.warning(f"Could not resolve the audio bitrate for {link}: {e}")
+        return spec
+
+
+async def build_media_file(link: str, spec: FormatSpec, progress: Optional[ProgressMessage] = None) -> Optional[str]:
+    """Downloads (and merges if needed) the file for spec on the job engine. Returns its path, or None if the quality is missing."""
+    video = await job_engine.run_network(load_video, link)
+    on_progress = progress.download_callback() if progress else None
+    with STAGE_SECONDS.time(stage='download'):
+        result = await job_engine.run_network(video.fetch, spec, on_progress)
+    # Adaptive downloads come back as separate streams that still need merging, audio may need converting
+    if isinstance(result, MUX_JOBS):
+        stage = 'clip' if isinstance(result, ClipJob) else 'transcode' if isinstance(result, TranscodeJob) else 'mux'
+        if progress:
+            progress.update(stage)
+        with STAGE_SECONDS.time(stage=stage):
+            result = await job_engine.run_mux(mux, result)
+    return result
+
+
+async def reply_cached_media(update: Update, video_id: str, fmt: str, caption: str) -> bool:
+    """Re-sends a previously delivered file by its file_id. Returns False on a cache miss."""
+    cached = await job_engine.run_network(get_cached_media, video_id, fmt)
+    if not cached:
+        return False
+
+    media_type, file_id = cached
+    try:
+        await reply_media(update, media_type, file_id, caption)
+        logger.info(f"Served {video_id} {fmt} from the media cache.")
+        return True
+    except BadRequest as e:
+        # Telegram no longer accepts this file_id, forget it and fall back to a fresh download
+        logger.warning(f"Cached file_id for {video_id} {fmt} rejected: {e}")
+        await job_engine.run_network(invalidate_media, video_id, fmt)
+        return False
+
+
+async def remember_media(video_id: str, fmt: str, media_type: str, message: Message):
+    """Stores the file_id of a message we just uploaded so the next request can skip the download."""
+    attachment = message.effective_attachment if message else None
+    file_id = getattr(attachment, 'file_id', None)
+    if file_id:
+        await job_engine.run_network(store_media, video_id, fmt, media_type, file_id, getattr(attachment, 'file_size', None))
+
+
+def media_task_key(chat_id: int, video_id: Optional[str], spec: FormatSpec) -> Optional[str]:
+    """Dedupe key of a queued download: pressing the same button again doesn't queue a second one."""
+    return f"{chat_id}:{video_id}:{spec.label}" if video_id else None
+
+
 # Download and send files with guaranteed cleanup
-async def send_and_clean_file(update: Update, context: CallbackContext, download_func, file_type: str):
-    """Handles download, sending, and required file cleanup."""
-    
+async def send_and_clean_file(update: Update, context: CallbackContext, spec: FormatSpec):
+    """Handles download, sending, and required file cleanup through the background job engine."""
     # 1. Retrieve the link from user_data
     link = context.user_data.get('video_link')
     if not link:
         await update.message.reply_text("❌ لطفا اول لینک ویدیو را بفرستید.")
         return
+    spec = await delivered_spec(link, spec)
+    file_type = spec.label
+
+    # 2. Answer instantly if this exact file was already delivered to someone
+    video_id = extract_video_id(link)
+    media_type = "audio" if spec.audio_only else "video"
+    if video_id and await reply_cached_media(update, video_id, file_type, CAPTION):
+        await update.message.reply_text(f"کیفیت {file_type} با موفقت ارسال شد!")
+        return
 
-    # 2. Initialize video object and download
-    path = None 
+    # 3. Pressing the button again, or another user asking for the same file, follows the running download
+    key = (video_id, file_type) if video_id else None
+    progress = active_progress.get(key) if key else None
+    if progress is not None:
+        if not await progress.attach(update.effective_chat.id, update.message.message_id):
+            # This chat already watches the download and gets the file when it's done
+            return
+    else:
+        # 4. Turn away users who started too many downloads recently
+        try:
+            job_engine.admit(update.effective_user.id)
+        except JobRateError as e:
+            await update.message.reply_text(f"❌ تعداد درخواست های شما زیاد است، لطفا {math.ceil(e.retry_after)} ثانیه دیگر دوباره تلاش کنید.")
+            return
+
+        # 5. With a shared queue a worker process downloads and uploads the file
+        if task_queue is not None:
+            task_id = await job_engine.run_network(task_queue.enqueue, MEDIA_TASK, {
+                'chat_id': update.effective_chat.id,
+                'reply_to': update.message.message_id,
+                'link': link,
+                'video_id': video_id,
+                'spec': asdict(spec),
+            }, QUEUE_MAX_ATTEMPTS, media_task_key(update.effective_chat.id, video_id, spec))
+            if task_id is None:
+                await update.message.reply_text(f"⏳ کیفیت {file_type} از قبل در صف دانلود است، به زودی برایتان ارسال میشود...")
+                return
+            await update.message.reply_text(f"⏳ کیفیت {file_type} در صف دانلود قرار گرفت، به زودی برایتان ارسال میشود...")
+            return
+
+    async def download_and_send() -> Optional[str]:
+        """Downloads, uploads to this chat and returns the Telegram file_id (None if the quality is missing)."""
+        path = None
+        progress = ProgressMessage(context.bot, file_type)
+        if key:
+            active_progress[key] = progress
+        async def upload(path: str) -> str:
+            file_size = os.path.getsize(path)
+            TRANSFER_BYTES.inc(file_size, direction='upload')
+            progress.update('upload', total=file_size)
+            with STAGE_SECONDS.time(stage='upload'):
+                message = await reply_media(update, media_type, path, CAPTION)
+            if video_id:
+                await remember_media(video_id, file_type, media_type, message)
+            return message.effective_attachment.file_id
+
+        try:
+            await progress.attach(update.effective_chat.id, update.message.message_id)
+
+            # The file may have been downloaded while the user was choosing
+            if video_id:
+                path = await prefetcher.take(video_id, spec, progress.download_callback())
+                if path:
+                    return await upload(path)
+
+            # The size from the manifest decides the place in the queue, smaller files go first
+            video = await job_engine.run_network(load_video, link)
+            size = await job_engine.run_network(video.estimate_size, spec)
+
+            async def notify_queued(position: int):
+                progress.update('queued', total=size, position=position)
+
+            # The caller's per-user cap was checked before the flight, so users joining it aren't refused for it
+            async with job_engine.global_slot(size, notify_queued):
+                progress.update('download', 0, size)
+                path = await build_media_file(link, spec, progress)
+                if not path:
+                    return None
+                return await upload(path)
+
+        # Ensure file deletion
+        finally:
+            if key and active_progress.get(key) is progress:
+                del active_progress[key]
+            await progress.close()
+            if path and os.path.exists(path):
+                try:
+                    remove_job_file(path)
+                    logger.info(f"Cleaned up file: {path}")
+                except OSError as e:
+                    logger.error(f"Error deleting file {path}: {e}")
+
+    # 6. Download once for everyone asking for the same file at the same time
     try:
-        video = YoutubeVideo(link)
-        await update.message.reply_text(f"⏳ کیفیت {file_type} لطفا منتظر بمانید، در حال دانلود...")
-        
-        path = download_func(video)
-        caption = "📥 دانلود سریع" + " | " + "@Aurora_D0wnload_bot"
-        if path:
-            if file_type == "Audio":
-                await update.message.reply_audio(audio=path, caption=caption)
-            elif file_type.startswith("Video"):
-                await update.message.reply_video(video=path, caption=caption)
-            
-            await update.message.reply_text(f"کیفیت {file_type} با موفقت ارسال شد!")
-        else:
+        async with job_engine.user_job(update.effective_user.id):
+            if key:
+                file_id, shared = await download_flights.do(key, download_and_send)
+            else:
+                file_id, shared = await download_and_send(), False
+
+        if not file_id:
             await update.message.reply_text(f"کیفیت {file_type} برای این ویدیو پیدا نشد...")
+            return
+        if shared:
+            await reply_media(update, media_type, file_id, CAPTION)
+        await update.message.reply_text(f"کیفیت {file_type} با موفقت ارسال شد!")
+
+    except JobLimitError:
+        await update.message.reply_text(f"❌ شما {job_engine.max_per_user} درخواست در حال انجام دارید، لطفا صبر کنید تا تمام شوند.")
+
+    except StorageFullError as e:
+        JOBS_REJECTED.inc(reason='storage')
+        logger.warning(f"Rejected {file_type} for {video_id}: {e}")
+        await update.message.reply_text(f"❌ فضای سرور برای کیفیت {file_type} کافی نیست، لطفا کیفیت پایین تری را انتخاب کنید یا بعدا تلاش کنید.")
 
     except Exception as e:
         logger.error(f"Error during {file_type} processing: {e}", exc_info=True)
         await update.message.reply_text(f"خطایی هنگام پردازش رخ داد، دوباره تلاش کنید.")
 
-    # 3. Ensure file deletion 
-    finally:
-        if path and os.path.exists(path):
+
+async def send_batch(update: Update, context: CallbackContext, spec: FormatSpec):
+    """Sends spec of every video in the playlist or channel the user sent, in playlist order."""
+    batch = context.user_data.get('batch_link')
+    if not batch:
+        await update.message.reply_text("❌ لطفا اول لینک لیست پخش یا کانال را بفرستید.")
+        return
+    kind, url = batch
+
+    try:
+        job_engine.admit(update.effective_user.id)
+    except JobRateError as e:
+        await update.message.reply_text(f"❌ تعداد درخواست های شما زیاد است، لطفا {math.ceil(e.retry_after)} ثانیه دیگر دوباره تلاش کنید.")
+        return
+
+    media_type = "audio" if spec.audio_only else "video"
+    try:
+        # The whole batch counts as one job of the user, its videos take global slots one by one
+        async with job_engine.user_job(update.effective_user.id):
+            title, links = await job_engine.run_network(iter_batch_links, kind, url)
+
+            # With a shared queue every video becomes its own task for the workers, queued in playlist order
+            if task_queue is not None:
+                count = 0
+                for _ in range(BATCH_MAX_VIDEOS):
+                    link = await job_engine.run_network(next, links, None)
+                    if link is None:
+                        break
+                    video_id = extract_video_id(link)
+                    task_id = await job_engine.run_network(task_queue.enqueue, MEDIA_TASK, {
+                        'chat_id': update.effective_chat.id,
+                        'reply_to': update.message.message_id,
+                        'link': link,
+                        'video_id': video_id,
+                        'spec': asdict(spec),
+                    }, QUEUE_MAX_ATTEMPTS, media_task_key(update.effective_chat.id, video_id, spec))
+                    if task_id is not None:
+                        count += 1
+                await update.message.reply_text(f"⏳ {count} ویدیو از {title} در صف دانلود قرار گرفت، به زودی برایتان ارسال میشود...")
+                return
+
+            async def send(item: BatchItem):
+                caption = f"{item.index + 1}. {item.title}\n{CAPTION}"
+                if item.file_id:
+                    await reply_media(update, item.media_type, item.file_id, caption)
+                    return
+                TRANSFER_BYTES.inc(os.path.getsize(item.path), direction='upload')
+                message = await reply_media(update, media_type, item.path, caption)
+                if item.video_id:
+                    await remember_media(item.video_id, item.spec.label, media_type, message)
+
+            progress = ProgressMessage(context.bot, f"{title} ({spec.label})")
+            progress.update('batch')
             try:
-                os.remove(path)
-                logger.info(f"Cleaned up file: {path}")
-            except OSError as e:
-                logger.error(f"Error deleting file {path}: {e}")
+                await progress.attach(update.effective_chat.id, update.message.message_id)
+                sent, failed = await BatchPipeline(links, spec, send, progress).run()
+            finally:
+                await progress.close()
+
+        message = f"📚 {sent} ویدیو از {title} ارسال شد!"
+        if failed:
+            message += f"\n{failed} ویدیو با کیفیت {spec.label} پیدا نشد یا دانلود نشد."
+        await update.message.reply_text(message)
+
+    except JobLimitError:
+        await update.message.reply_text(f"❌ شما {job_engine.max_per_user} درخواست در حال انجام دارید، لطفا صبر کنید تا تمام شوند.")
+
+    except Exception as e:
+        logger.error(f"Error during batch {url}: {e}", exc_info=True)
+        await update.message.reply_text(f"خطایی هنگام پردازش رخ داد، دوباره تلاش کنید.")
 
 
 ### commands
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
-    # 1. Clear context data
+    # 1. Clear context data and the chat agent's memory of this conversation
     context.user_data.clear()
+    await reset_conversation(update.effective_chat.id)
     
     # 2. Database interaction: Add/Update user info
     if user:
@@ -82,9 +366,12 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "😁👋 سلام به ربات دانلود ویدیو یوتوب آرورا خوش آمدید.\n"        
         "فقط کافیه ( لینک ) ویدیو یوتوب برای ربت بفرستید تا ویدیو یا صدا و یا زیر نویس اش رو از یوتوب دانلود کنید.\n\n"
         "🟢 گزینه ها:\n\n"
-        "🎥 ویدیو - 144p - 360p - 720p- 1080p\n"
-        "🈯 زیر نویس - روسی 🇷🇺 - انگلیسی 🇺🇸 (در قالب Word Document)\n"
+        "🎥 ویدیو - همه کیفیت های موجود (144p تا 1080p و بالاتر)\n"
+        "🈯 زیر نویس - همه زبان های موجود ویدیو (Word, SRT, VTT)\n"
+        "🌐 چند زبان با هم: /subs en ru یا /subs all\n"
         "🔊 صدا با کیفیت ترین حالت ممکنه\n"
+        "📚 لیست پخش یا کانال: لینک آن را بفرستید تا ویدیو ها به ترتیب ارسال شوند\n"
+        "✂️ برش: بعد از لینک بازه زمانی را بنویسید، مثال: https://youtu.be/... 1:30-2:45\n"
     )
     await update.message.reply_text(message)
 
@@ -111,7 +398,15 @@ async def link_buttons(update: Update, context: CallbackContext, link: str):
         await update.message.reply_text("❌ لطفا اول لینک ویدیو را بفرستید.")
         return
     
-    video = YoutubeVideo(link)
+    video = await job_engine.run_network(load_video, link)
+    title = video.yt.title
+    clip = context.user_data.get('clip')
+    if clip and video.yt.length and clip[0] >= video.yt.length:
+        context.user_data.pop('clip')
+        await update.message.reply_text(f"❌ این ویدیو فقط {format_clock(video.yt.length)} است، زمان شروع برش از آن بیشتر است.")
+        return
+    if clip:
+        title += f"\n✂️ برش {format_clock(clip[0])} تا {format_clock(min(clip[1], video.yt.length or clip[1]))}"
 
     keyboard = [
         [KeyboardButton("🎥 Video"), KeyboardButton("🔊 Audio")],
@@ -119,17 +414,46 @@ async def link_buttons(update: Update, context: CallbackContext, link: str):
         [KeyboardButton("Go Back")]
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-    await update.message.reply_text(text=f"{video.yt.title}\n\nلینک: {link}", reply_markup=reply_markup)
+    await update.message.reply_text(text=f"{title}\n\nلینک: {link}", reply_markup=reply_markup)
     await update.message.reply_text(text="چه کاری میتونم براتون انجام بدم؟ 😁", reply_markup=reply_markup)
 
 
-async def video_q_buttons(update: Update, context: CallbackContext):
+def quality_button(height: int, size: int) -> str:
+    return f"🎥 {height} P · {size / 1024 ** 2:.1f} MB" if size else f"🎥 {height} P"
+
+
+def with_clip(context: CallbackContext, spec: FormatSpec) -> FormatSpec:
+    """spec limited to the time range sent with the link, if there was one."""
+    clip = context.user_data.get('clip')
+    return replace(spec, clip_start=clip[0], clip_end=clip[1]) if clip else spec
+
+
+async def batch_buttons(update: Update, context: CallbackContext):
+    kind, url = context.user_data['batch_link']
     keyboard = [
-        [KeyboardButton("🎥 144 P"), KeyboardButton("🎥 360 P")],
-        [KeyboardButton("🎥 720 P"), KeyboardButton("🎥 1080 P")],
+        [KeyboardButton("📚 Audio")],
+        [KeyboardButton(f"📚 {height} P") for height in BATCH_RESOLUTIONS],
         [KeyboardButton("Go Back")]
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+    source = "لیست پخش" if kind == 'playlist' else "کانال"
+    await update.message.reply_text(text=f"📚 {source}: {url}\n\nحداکثر {BATCH_MAX_VIDEOS} ویدیو به ترتیب ارسال میشود. با چه فرمتی؟", reply_markup=reply_markup)
+
+
+async def video_q_buttons(update: Update, context: CallbackContext):
+    link = context.user_data.get('video_link')
+    if not link:
+        await update.message.reply_text("❌ لطفا اول لینک ویدیو را بفرستید.")
+        return
+
+    # Offer every resolution the video actually has with its download size, two buttons per row
+    video = await job_engine.run_network(load_video, link)
+    specs = [with_clip(context, FormatSpec(resolution=height)) for height in video.available_resolutions()]
+    sizes = await prefetcher.sizes(link, specs)
+    buttons = [KeyboardButton(quality_button(spec.resolution, sizes.get(spec.label, 0))) for spec in specs]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    keyboard.append([KeyboardButton("Go Back")])
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
     await update.message.reply_text(text="با چه کیفیتی میخواید دانلود کنید؟", reply_markup=reply_markup)
 
 
@@ -141,102 +465,149 @@ async def sub_choose(update: Update, context: CallbackContext):
         await update.message.reply_text("❌ لطفا اول لینک ویدیو را بفرستید.")
         return
 
-    keyboard = [
-        [KeyboardButton("🇺🇸 English"), KeyboardButton("🇷🇺 Russia")],
-        [KeyboardButton("Go Back")]
-    ]
+    # One button per caption track the video actually has
+    video = await job_engine.run_network(load_video, link)
+    tracks = video.caption_tracks()
+    if not tracks:
+        await update.message.reply_text("این ویدیو زیرنویس ندارد.")
+        return
+
+    buttons = {f"🈯 {name}": code for code, name in tracks}
+    context.user_data['subtitle_buttons'] = buttons
+    fmt = context.user_data.get('sub_format', 'docx')
+
+    keyboard = [[KeyboardButton(text) for text in list(buttons)[i:i + 2]] for i in range(0, len(buttons), 2)]
+    if len(buttons) > 1:
+        keyboard.append([KeyboardButton(ALL_SUBTITLES_BUTTON)])
+    keyboard.append([KeyboardButton(button) for button in SUBTITLE_FORMAT_BUTTONS])
+    keyboard.append([KeyboardButton("Go Back")])
 
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-    await update.message.reply_text(text="زیر نویس به چه زبانی باشد؟ (در قالب Word Document)", reply_markup=reply_markup)
+    await update.message.reply_text(text=f"زیر نویس به چه زبانی باشد؟ (در قالب {SUBTITLE_FORMAT_NAMES[fmt]})", reply_markup=reply_markup)
 
 
-async def send_subtitle_docx(update: Update, context: CallbackContext, lang_code: str):
+async def subs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/subs en ru de (or /subs all) sends several subtitle languages of the current video in one file."""
+    if not context.args:
+        await update.message.reply_text("مثال: /subs en ru یا /subs all")
+        return
+    codes = [code.strip().lower() for code in context.args if code.strip()]
+    if codes[:1] == ['all']:
+        codes = None
+    await send_subtitles(update, context, codes)
+
+
+async def set_subtitle_format(update: Update, context: CallbackContext, fmt: str):
+    context.user_data['sub_format'] = fmt
+    await sub_choose(update, context)
+
+
+def build_subtitle_bundle(tracks: list, fmt: str, title: str) -> bytes:
+    """
+    Builds the subtitle file in memory for one or more (code, name, cues) tracks: a Word document with
+    one paragraph per spoken passage and a section per language, or SRT/VTT text (zipped when there are several).
+    """
+    if fmt == 'docx':
+        document = docx.Document()
+        document.add_heading('YouTube Video Subtitles', 0)
+        document.add_paragraph(title)
+        for code, name, cues in tracks:
+            if len(tracks) > 1:
+                document.add_heading(f"{name} ({code})", 1)
+            for paragraph in subtitle_paragraphs(cues):
+                document.add_paragraph(paragraph)
+        buffer = BytesIO()
+        document.save(buffer)
+        return buffer.getvalue()
+
+    if len(tracks) == 1:
+        return render(tracks[0][2], fmt).encode('utf-8')
+
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for code, name, cues in tracks:
+            archive.writestr(f"{code}.{fmt}", render(cues, fmt))
+    return buffer.getvalue()
+
+
+async def fetch_all_cues(video, codes: list) -> list:
+    """Fetches and parses several caption tracks at once, at most SUBTITLE_FANOUT at a time."""
+    limit = asyncio.Semaphore(SUBTITLE_FANOUT)
+
+    async def fetch(code: str):
+        async with limit:
+            return code, await job_engine.run_network(video.get_cues, code)
+
+    return await asyncio.gather(*(fetch(code) for code in codes))
+
+
+async def send_subtitles(update: Update, context: CallbackContext, lang_codes: Optional[list] = None):
+    """Sends the subtitles of lang_codes (every track when None) as one file."""
     link = context.user_data.get('video_link')
     if not link:
         await update.message.reply_text("❌ لطفا اول لینک ویدیو را بفرستید.")
         return
 
-    docx_path = None
-    # Map language codes to display name and the appropriate retrieval function in YoutubeVideo
-    lang_map = {
-        'en': ('انگلیسی', YoutubeVideo.get_pure_subtitles_text), 
-        'ru': ('روسی', YoutubeVideo.get_pure_subtitles_text)
-    }
-    
-    if lang_code not in lang_map:
-        await update.message.reply_text("زبان نامعتبر.")
-        return
-        
-    lang_name, get_caption_func = lang_map[lang_code]
+    fmt = context.user_data.get('sub_format', 'docx')
+    format_name = SUBTITLE_FORMAT_NAMES[fmt]
 
     try:
-        video = YoutubeVideo(link)
-        
-        # Dynamically call the correct subtitle method, passing the required lang_code
-        caption = get_caption_func(video, lang_code)
-        
-        if not caption:
-            await update.message.reply_text(f"زیر نویسی برای زبان {lang_name} یافت نشد.")
+        video = await job_engine.run_network(load_video, link)
+        video_title = video.yt.title
+        tracks = dict(video.caption_tracks())
+
+        # Typed codes are matched case-insensitively, YouTube's have mixed case (pt-BR, zh-Hans)
+        by_lower = {code.lower(): code for code in tracks}
+        codes = list(tracks) if lang_codes is None else [by_lower.get(code.lower()) or by_lower.get(f"a.{code.lower()}", code) for code in lang_codes]
+        codes = codes[:MAX_SUBTITLE_LANGUAGES]
+        unknown = [code for code in codes if code not in tracks and f"a.{code}" not in tracks]
+        if not codes or unknown:
+            await update.message.reply_text(f"زیر نویسی برای زبان {', '.join(unknown) or '-'} یافت نشد.")
+            return
+        lang_name = ', '.join(tracks.get(code) or tracks[f"a.{code}"] for code in codes)
+
+        # Re-send an already uploaded file for this video, these languages and format
+        bundle = len(codes) > 1
+        extension = 'zip' if bundle and fmt != 'docx' else fmt
+        cache_format = f"Subtitle {'+'.join(codes)} {fmt}"
+        if await reply_cached_media(update, video.yt.video_id, cache_format, f"📝 زیرنویس {lang_name} ویدیو در قالب {format_name}"):
+            await update.message.reply_text(f"فایل زیرنویس ({format_name}) با موفقیت ارسال شد.")
             return
 
-        # 1. Create the DOCX file
-        video_title = video.yt.title
+        # 1. Build the file in memory, reusing bytes generated for an earlier request
+        file_key = (video.yt.video_id, tuple(codes), fmt)
+        data = subtitle_files.get(file_key)
+        if data is None:
+            if bundle:
+                await update.message.reply_text(f"⏳ در حال دریافت {len(codes)} زیرنویس، لطفا منتظر بمانید...")
+            with STAGE_SECONDS.time(stage='captions'):
+                fetched = [(code, tracks.get(code) or tracks[f"a.{code}"], cues) for code, cues in await fetch_all_cues(video, codes) if cues]
+            if not fetched:
+                await update.message.reply_text(f"زیر نویسی برای زبان {lang_name} یافت نشد.")
+                return
+
+            await update.message.reply_text(f"⏳ در حال تولید فایل زیرنویس ({format_name})، لطفا منتظر بمانید...")
+            data = await job_engine.run_network(build_subtitle_bundle, fetched, fmt, video_title)
+            subtitle_files.set(file_key, data)
 
         safe_title = "".join(c for c in video_title if c.isalnum() or c in (' ', '_', '-')).strip()
-        filename = f"{safe_title}_{lang_code}_subtitles" 
-        
-        await update.message.reply_text("⏳ در حال تولید فایل Word زیرنویس، لطفا منتظر بمانید...")
-        
-        # Use the new DOCX creation function
-        docx_path = create_subtitle_docx(caption, filename) 
-        
-        if docx_path:
-            # 2. Send the DOCX document
-            with open(docx_path, 'rb') as docx_file:
-                await update.message.reply_document(
-                    document=docx_file,
-                    filename=os.path.basename(docx_path), 
-                    caption=f"📝 زیرنویس {lang_name} ویدیو در قالب Word Document: {video_title}"
-                )
-            await update.message.reply_text("فایل Word زیرنویس با موفقیت ارسال شد.")
-        else:
-            await update.message.reply_text("❌ خطایی هنگام تولید فایل Word رخ داد.")
+        lang_part = 'all' if bundle else codes[0]
+
+        # 2. Upload straight from memory
+        TRANSFER_BYTES.inc(len(data), direction='upload')
+        with STAGE_SECONDS.time(stage='upload'):
+            message = await update.message.reply_document(
+                document=data,
+                filename=f"{safe_title}_{lang_part}_subtitles.{extension}",
+                caption=f"📝 زیرنویس {lang_name} ویدیو در قالب {format_name}: {video_title}"[:1024]
+            )
+        await remember_media(video.yt.video_id, cache_format, "document", message)
+        await update.message.reply_text(f"فایل زیرنویس ({format_name}) با موفقیت ارسال شد.")
 
     except Exception as e:
-        logger.error(f"Error getting {lang_name} subtitles and sending DOCX: {e}", exc_info=True)
+        logger.error(f"Error getting {lang_codes} subtitles and sending {fmt}: {e}", exc_info=True)
         await update.message.reply_text("خطایی هنگام پردازش رخ داد دوباره تلاش کنید.")
 
-    # 3. Clean up the generated DOCX file
-    finally:
-        if docx_path and os.path.exists(docx_path):
-            try:
-                os.remove(docx_path)
-                logger.info(f"Cleaned up DOCX file: {docx_path}")
-            except OSError as e:
-                logger.error(f"Error deleting DOCX file {docx_path}: {e}")
-
-
-def create_subtitle_docx(text_content: str, filename: str) -> str:    
-    document = docx.Document()
-    document.add_heading('YouTube Video Subtitles', 0)
-    
-    try:
-        paragraph = text_content.replace(".", ".\n").replace("\n.\n", "")
-        document.add_paragraph(paragraph)
-        base_name, _ = os.path.splitext(filename)
-        docx_filename = f"{base_name}.docx"
-        filepath = os.path.join("videos", docx_filename)
-
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        document.save(filepath)
-        
-        logger.info(f"Successfully created DOCX file: {filepath}")
-        return filepath
-    
-    except Exception as e:
-        logger.error(f"Failed to create DOCX file: {e}")
-        return None
-
 
 # Go back
 async def go_back(update: Update, context: CallbackContext): 
@@ -253,7 +624,7 @@ async def go_back(update: Update, context: CallbackContext):
 ### chats
 async def chat_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
-    response = generate_response(text)
+    response = await generate_response(text, update.effective_chat.id)
     if response:
         await update.message.reply_text("🤖: " + response)
     else:
@@ -265,11 +636,46 @@ async def handle_messages(update: Update, context: CallbackContext):
     text = update.message.text
     logger.debug(f"Received message: {text}")
     
-    if text.startswith("https://youtu.be/") or text.startswith("https://youtube.com/"):
+    batch = extract_batch_link(text)
+    if batch:
+        context.user_data['batch_link'] = batch
+        logger.info(f"New batch link stored in user_data: {text}")
+        await batch_buttons(update, context)
+        return
+
+    batch_button = BATCH_BUTTON_RE.match(text)
+    if batch_button:
+        spec = FormatSpec(resolution=int(batch_button.group(1))) if batch_button.group(1) else AUDIO_SPEC
+        await send_batch(update, context, spec)
+        return
+
+    clip = CLIP_RE.search(text)
+    link = text[:clip.start()] if clip else text
+    if extract_video_id(link):
+        if clip:
+            start, end = parse_clock(clip.group(1)), parse_clock(clip.group(2))
+            if start >= end:
+                await update.message.reply_text("❌ زمان پایان برش باید بعد از زمان شروع باشد، مثال: 1:30-2:45")
+                return
+            context.user_data['clip'] = [start, end]
+        else:
+            context.user_data.pop('clip', None)
         # Store the link in user_data
-        context.user_data['video_link'] = text 
+        context.user_data['video_link'] = link
         logger.info(f"New video link stored in user_data: {text}")
-        await link_buttons(update, context, text)
+        await link_buttons(update, context, link)
+        # Resolve sizes and captions and fetch cheap files while the user is choosing
+        prefetcher.start(update.effective_user.id, link, download=task_queue is None and 'clip' not in context.user_data)
+        return
+
+    quality = QUALITY_BUTTON_RE.match(text)
+    if quality:
+        await send_and_clean_file(update, context, with_clip(context, FormatSpec(resolution=int(quality.group(1)))))
+        return
+
+    subtitle_buttons = context.user_data.get('subtitle_buttons', {})
+    if text in subtitle_buttons:
+        await send_subtitles(update, context, [subtitle_buttons[text]])
         return
 
     match text:
@@ -280,40 +686,81 @@ async def handle_messages(update: Update, context: CallbackContext):
         case "🎥 Video":
             await video_q_buttons(update, context)
         case "🔊 Audio":
-            await send_and_clean_file(update, context, YoutubeVideo.download_audio, "Audio")
-        case "🎥 144 P":
-            await send_and_clean_file(update, context, YoutubeVideo.download_video_144, "Video 144p")
-        case "🎥 360 P":
-            await send_and_clean_file(update, context, YoutubeVideo.download_video_360, "Video 360p")
-        case "🎥 720 P":
-            await send_and_clean_file(update, context, YoutubeVideo.download_video_720, "Video 720p")
-        case "🎥 1080 P":
-            await send_and_clean_file(update, context, YoutubeVideo.download_video_1080, "Video 1080p")
-        case "🇺🇸 English":
-            # Call the new DOCX function
-            await send_subtitle_docx(update, context, 'en')
-        case "🇷🇺 Russia":
-            # Call the new DOCX function
-            await send_subtitle_docx(update, context, 'ru')
+            await send_and_clean_file(update, context, with_clip(context, AUDIO_SPEC))
+        case "🌐 All languages":
+            await send_subtitles(update, context)
+        case "📄 Word" | "⏱ SRT" | "⏱ VTT":
+            await set_subtitle_format(update, context, SUBTITLE_FORMAT_BUTTONS[text])
         case _:
             await chat_handler(update, context)
 
 
 async def export_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export [db|csv|jsonl] [since YYYY-MM-DD] sends a compressed snapshot of the users table to the admin."""
     ADMIN_USERNAME = os.getenv("ADMIN_USERNAME")
     
     if update.effective_user.username != ADMIN_USERNAME:
         logger.info("Not Admin...!")
         return
+
+    args = context.args or []
+    fmt = args[0].lower() if args else 'db'
+    since = args[1] if len(args) > 1 else None
+    if fmt not in EXPORT_FORMATS:
+        await update.message.reply_text(f"Usage: /export [{'|'.join(EXPORT_FORMATS)}] [since YYYY-MM-DD]")
+        return
+    if since:
+        try:
+            since = datetime.fromisoformat(since).isoformat()
+        except ValueError:
+            await update.message.reply_text("Invalid date, use YYYY-MM-DD.")
+            return
+
+    path = None
     try:
-        await update.message.reply_document(
-            document=open('bot_users.db', 'rb'),
-            filename='users_backup.db',
-            caption="Here is the latest user database. 📂"
-        )
+        path = await job_engine.run_network(export_users_file, fmt, since)
+        with open(path, 'rb') as export_file:
+            await update.message.reply_document(
+                document=export_file,
+                filename=os.path.basename(path),
+                caption="Here is the latest user database. 📂"
+            )
         logger.info("Exported users...!")
     except Exception as e:
         await update.message.reply_text(f"Error sending database: {e}")
+    finally:
+        if path:
+            remove_export(path)
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats sends the admin a summary of the metrics also served on the Prometheus endpoint."""
+    ADMIN_USERNAME = os.getenv("ADMIN_USERNAME")
+
+    if update.effective_user.username != ADMIN_USERNAME:
+        logger.info("Not Admin...!")
+        return
+
+    lines = ["📊 Bot stats", f"Jobs: {job_engine.active} active, {job_engine.queued} queued", "", "Stages (count, p50 / p95 seconds):"]
+    for (stage,) in sorted(STAGE_SECONDS.label_values()):
+        lines.append(f"  {stage}: {STAGE_SECONDS.count(stage=stage)}, "
+                     f"{STAGE_SECONDS.quantile(0.5, stage=stage):.2f} / {STAGE_SECONDS.quantile(0.95, stage=stage):.2f}")
+
+    lines += ["", "Caches (hit rate, hits / misses):"]
+    for name, stats in registry.cache_stats().items():
+        total = stats['hits'] + stats['misses']
+        rate = stats['hits'] / total if total else 0.0
+        lines.append(f"  {name}: {rate:.0%}, {stats['hits']} / {stats['misses']}")
+
+    gemini_calls = sum(GEMINI_SECONDS.count(outcome=outcome) for (outcome,) in GEMINI_SECONDS.label_values())
+    lines += ["", f"Gemini: {gemini_calls} calls, {GEMINI_RETRIES.value():.0f} retries"]
+    for (outcome,) in sorted(GEMINI_SECONDS.label_values()):
+        lines.append(f"  {outcome}: {GEMINI_SECONDS.count(outcome=outcome)}, p95 {GEMINI_SECONDS.quantile(0.95, outcome=outcome):.2f}s")
+
+    mb = 1024 * 1024
+    lines += ["", f"Transfer: {TRANSFER_BYTES.value(direction='download') / mb:.1f} MB down, "
+                  f"{TRANSFER_BYTES.value(direction='upload') / mb:.1f} MB up"]
+    await update.message.reply_text("\n".join(lines))
 
 
 # Errors
@@ -0,0 +1,231 @@
+import os
+import heapq
+import asyncio
+import logging
+import itertools
+from contextlib import asynccontextmanager
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+# Import Files
+from metrics import registry, Counter, Gauge
+from ratelimit import KeyedRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+NETWORK_WORKERS = int(os.getenv("JOB_NETWORK_WORKERS", "8"))
+MUX_WORKERS = int(os.getenv("JOB_MUX_WORKERS", str(os.cpu_count() or 2)))
+MUX_PROCESSES = os.getenv("JOB_MUX_PROCESSES", "1") == "1"
+MAX_GLOBAL_JOBS = int(os.getenv("JOB_MAX_GLOBAL", "4"))
+MAX_USER_JOBS = int(os.getenv("JOB_MAX_PER_USER", "2"))
+# Downloads a user may start per minute, and how many of those they may start back to back
+USER_JOBS_PER_MINUTE = float(os.getenv("JOB_USER_RATE", "6"))
+USER_JOB_BURST = float(os.getenv("JOB_USER_BURST", "3"))
+# Queued jobs are ordered by size: a job waits up to size / JOB_AGING_MBPS seconds longer than it would
+# in arrival order, so small requests overtake big merges but big ones still get their turn. 0 = FIFO.
+AGING_BYTES_PER_SECOND = float(os.getenv("JOB_AGING_MBPS", "5")) * 1024 * 1024
+
+
+class JobLimitError(Exception):
+    """Raised when a user already has the maximum number of jobs running or queued."""
+
+
+class JobRateError(JobLimitError):
+    """Raised when a user started too many jobs recently; retry_after is the number of seconds to wait."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _PoolExecutor:
+    """Runs blocking callables on a pool without blocking the event loop."""
+
+    def __init__(self, pool: Executor):
+        self._pool = pool
+
+    async def run(self, func: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, func, *args)
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+
+
+class NetworkExecutor(_PoolExecutor):
+    """Thread pool for I/O bound work: manifest fetches and stream downloads."""
+
+    def __init__(self, max_workers: int = NETWORK_WORKERS):
+        super().__init__(ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="net"))
+
+
+class MuxExecutor(_PoolExecutor):
+    """Thread or process pool for ffmpeg muxing so merges can use every core."""
+
+    def __init__(self, max_workers: int = MUX_WORKERS, use_processes: bool = MUX_PROCESSES):
+        if use_processes:
+            pool = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mux")
+        super().__init__(pool)
+
+
+class JobEngine:
+    """
+    Bounded background job engine.
+
+    A job holds one global slot for its whole lifetime (download, merge and upload).
+    Users are admitted by a per-user token bucket and beyond their own cap are rejected.
+    Jobs beyond the global cap wait ordered by arrival time plus cost / aging_rate, so cheap jobs go first
+    without starving expensive ones.
+    """
+
+    def __init__(self, max_global: int = MAX_GLOBAL_JOBS, max_per_user: int = MAX_USER_JOBS,
+                 network: Optional[NetworkExecutor] = None, mux: Optional[MuxExecutor] = None,
+                 user_rate: float = USER_JOBS_PER_MINUTE, user_burst: float = USER_JOB_BURST,
+                 aging_rate: float = AGING_BYTES_PER_SECOND):
+        self.max_global = max_global
+        self.max_per_user = max_per_user
+        self.aging_rate = aging_rate
+        self.network = network or NetworkExecutor()
+        self.mux = mux or MuxExecutor()
+        self._active = 0
+        # Heap of (start deadline, arrival number, waiter)
+        self._waiting: list = []
+        self._arrivals = itertools.count()
+        self._user_jobs: dict[int, int] = {}
+        self._user_rate = KeyedRateLimiter(user_rate / 60, user_burst) if user_rate > 0 else None
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiting)
+
+    def admit(self, user_id: int):
+        """Takes one of user_id's job tokens, raising JobRateError if they started too many jobs recently."""
+        if self._user_rate is None:
+            return
+        retry_after = self._user_rate.try_acquire(user_id)
+        if retry_after:
+            JOBS_REJECTED.inc(reason='rate')
+            raise JobRateError(f"User {user_id} is over the job rate limit.", retry_after)
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, cost: int = 0, on_queued: Optional[Callable[[int], Awaitable]] = None):
+        """
+        Acquire a job slot for user_id, calling on_queued(position) if the job has to wait.
+        cost is the job's estimated size in bytes and decides its place in the queue.
+        """
+        async with self.user_job(user_id), self.global_slot(cost, on_queued):
+            yield
+
+    @asynccontextmanager
+    async def user_job(self, user_id: int):
+        """Counts one job against user_id's cap while it runs, raising JobLimitError beyond the cap."""
+        if self._user_jobs.get(user_id, 0) >= self.max_per_user:
+            JOBS_REJECTED.inc(reason='user_limit')
+            raise JobLimitError(f"User {user_id} already has {self.max_per_user} jobs.")
+
+        self._user_jobs[user_id] = self._user_jobs.get(user_id, 0) + 1
+        try:
+            yield
+        finally:
+            self._user_jobs[user_id] -= 1
+            if not self._user_jobs[user_id]:
+                del self._user_jobs[user_id]
+
+    @asynccontextmanager
+    async def global_slot(self, cost: int = 0, on_queued: Optional[Callable[[int], Awaitable]] = None):
+        """One of the max_global slots, without user accounting (batch items run under their batch's user_job)."""
+        await self._acquire(cost, on_queued)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, cost: int, on_queued):
+        if self._active < self.max_global and not self._waiting:
+            self._active += 1
+            return
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        deadline = loop.time() + (cost / self.aging_rate if self.aging_rate > 0 else 0)
+        entry = (deadline, next(self._arrivals), waiter)
+        heapq.heappush(self._waiting, entry)
+        position = sum(1 for other in self._waiting if other[:2] <= entry[:2])
+        logger.info(f"Job of {cost / 1024 ** 2:.0f} MB queued at position {position} ({self._active} active).")
+        try:
+            if on_queued:
+                await on_queued(position)
+            await waiter
+        except asyncio.CancelledError:
+            # The slot may have been handed over right before the cancellation landed
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            # _release() may already have popped and skipped our cancelled waiter
+            elif entry in self._waiting:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+            raise
+
+    def _release(self):
+        # Hand the slot directly to the waiter with the earliest deadline
+        while self._waiting:
+            _, _, waiter = heapq.heappop(self._waiting)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    async def run_network(self, func: Callable, *args):
+        return await self.network.run(func, *args)
+
+    async def run_mux(self, func: Callable, *args):
+        return await self.mux.run(func, *args)
+
+    def shutdown(self, wait: bool = True):
+        self.network.shutdown(wait=wait)
+        self.mux.shutdown(wait=wait)
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent work: the first caller for a key starts it,
+    callers arriving while it runs await the same result instead of repeating it.
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Task] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]) -> tuple[Any, bool]:
+        """Returns (result, shared) where shared is True when the result came from another caller's run."""
+        task = self._calls.get(key)
+        shared = task is not None
+        if not shared:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+
+        # Shield so one impatient waiter being cancelled doesn't abort the work for the others
+        return await asyncio.shield(task), shared
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+
+JOBS_REJECTED = registry.register(Counter('bot_jobs_rejected_total', "Download requests turned away", ('reason',)))
+
+job_engine = JobEngine()
+download_flights = SingleFlight()
+
+registry.register(Gauge('bot_jobs_active', "Jobs holding a slot", callback=lambda: job_engine.active))
+registry.register(Gauge('bot_jobs_queued', "Jobs waiting for a slot", callback=lambda: job_engine.queued))
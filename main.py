@@ -1,12 +1,25 @@
 import os
 import logging
+from typing import Optional
+from telegram import Update
 from telegram.error import NetworkError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 from dotenv import load_dotenv
 
+# Load .env before importing modules that read their configuration at import time
+load_dotenv()
+
 # Import Files
-from handler import start_command, help_command, creator_command, handle_messages, error_handler, export_users
-from database import init_db
+from handler import start_command, help_command, creator_command, subs_command, handle_messages, error_handler, export_users, stats_command
+from database import init_db, close_db
+from media_cache import init_media_cache
+from storage import storage
+from jobs import job_engine
+from prefetch import prefetcher
+from chat_agent import close_client
+from metrics import start_metrics_server
+from update_processor import ChatOrderedUpdateProcessor
+from session_store import open_session_persistence
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -14,9 +27,31 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# --- Update delivery ---
+# "webhook": Telegram pushes updates to our listener, "polling": we fetch them (also the fallback)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Public base URL Telegram sends updates to, e.g. https://bot.example.com
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# Telegram echoes this in a header so the listener can reject forged updates
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+# Certificate and key for serving HTTPS directly (leave empty behind a TLS reverse proxy)
+WEBHOOK_CERT = os.getenv("WEBHOOK_CERT") or None
+WEBHOOK_KEY = os.getenv("WEBHOOK_KEY") or None
+# Long polling: Telegram holds getUpdates open until an update arrives or this many seconds pass
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))
+# Another Bot API server, e.g. a local telegram-bot-api or the stand-in in benchmarks/fakes.py
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL") or None
+
 
 def main():
     init_db()
+    init_media_cache()
+    # Remove scratch files of jobs a previous run didn't finish
+    storage.sweep()
+    start_metrics_server()
     configure()
     API_KEY = os.getenv("API_KEY")
     if not API_KEY:
@@ -24,24 +59,86 @@ def main():
         return
 
     # --- Initialize bot application ---
-    app = Application.builder().token(API_KEY).build()
-    
+    app = build_application(API_KEY, base_url=BOT_API_BASE_URL)
+
+    # Both run until SIGINT/SIGTERM, then stop fetching, finish running updates and call shutdown()
+    try:
+        if BOT_MODE == "webhook" and webhook_available():
+            run_webhook(app)
+        else:
+            logger.info("Bot starts polling...")
+            app.run_polling(poll_interval=0, timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES)
+    except NetworkError as e:
+        logger.error(f"Network Error during polling: {e}")
+    except Exception as e:
+        logger.error(f"General Error: {e}")
+
+
+def webhook_available() -> bool:
+    if not WEBHOOK_URL:
+        logger.warning("BOT_MODE=webhook but WEBHOOK_URL is not set, falling back to polling.")
+        return False
+    try:
+        import tornado  # noqa: F401
+    except ImportError:
+        logger.warning("Webhooks need python-telegram-bot[webhooks], falling back to polling.")
+        return False
+    return True
+
+
+def run_webhook(app: Application):
+    path = WEBHOOK_PATH.strip('/')
+    logger.info(f"Bot starts listening for webhooks on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{path}...")
+    app.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=path,
+        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{path}",
+        secret_token=WEBHOOK_SECRET,
+        cert=WEBHOOK_CERT,
+        key=WEBHOOK_KEY,
+        allowed_updates=Update.ALL_TYPES,
+    )
+
+
+def build_application(token: str, base_url: Optional[str] = None) -> Application:
+    """Creates the bot application with all handlers registered. base_url points the bot at another Bot API server."""
+    # Chats are served concurrently, but each chat's updates start in the order they were sent
+    builder = Application.builder().token(token).concurrent_updates(ChatOrderedUpdateProcessor())
+    builder = builder.post_init(startup).post_shutdown(shutdown)
+    if base_url:
+        builder = builder.base_url(base_url).base_file_url(base_url.replace('/bot', '/file/bot'))
+    # user_data shared with the other front-ends (SESSION_BACKEND)
+    persistence = open_session_persistence()
+    if persistence:
+        builder = builder.persistence(persistence)
+    app = builder.build()
+
     # Add handlers
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("creator", creator_command))
+    app.add_handler(CommandHandler("subs", subs_command))
     app.add_handler(CommandHandler("export", export_users))
+    app.add_handler(CommandHandler("stats", stats_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_messages))
     app.add_error_handler(error_handler)
+    return app
 
-    # Polling...
-    try:
-        logger.info("Bot starts polling...")
-        app.run_polling(poll_interval=3)
-    except NetworkError as e:
-        logger.error(f"Network Error during polling: {e}")
-    except Exception as e:
-        logger.error(f"General Error: {e}")
+
+async def startup(app: Application):
+    # Delete prefetched files nobody claimed, even while no new links arrive
+    prefetcher.start_expiry()
+
+
+async def shutdown(app: Application):
+    # Abort downloads nobody asked for yet and delete their files
+    await prefetcher.close()
+    # Stop background download/merge workers
+    job_engine.shutdown(wait=False)
+    await close_client()
+    # Write out queued user records
+    close_db()
 
 
 def configure():
@@ -0,0 +1,158 @@
+import os
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Optional
+
+# Import Files
+from database import get_connection
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Telegram file_ids stay valid for a long time, but drop entries nobody asked for in a while
+MEDIA_CACHE_MAX_AGE_DAYS = int(os.getenv("MEDIA_CACHE_MAX_AGE_DAYS", "30"))
+MEDIA_CACHE_MAX_ENTRIES = int(os.getenv("MEDIA_CACHE_MAX_ENTRIES", "20000"))
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'invalidations': 0, 'evictions': 0}
+
+
+def _count(name: str, amount: int = 1):
+    with _stats_lock:
+        _stats[name] += amount
+
+
+def init_media_cache():
+    """Creates the delivered_media table that maps (video_id, format) to a Telegram file_id."""
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS delivered_media (
+                video_id TEXT NOT NULL,
+                format TEXT NOT NULL,
+                media_type TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                file_size INTEGER,
+                created_time TEXT,
+                last_used_time TEXT,
+                hits INTEGER DEFAULT 0,
+                PRIMARY KEY (video_id, format)
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_delivered_media_last_used ON delivered_media (last_used_time)")
+        conn.commit()
+        logger.info("Media cache table ensured.")
+    except sqlite3.Error as e:
+        logger.error(f"SQLite error during media cache initialization: {e}")
+
+
+def get_cached_media(video_id: str, fmt: str) -> Optional[tuple[str, str]]:
+    """Returns (media_type, file_id) for an already delivered file, or None on a miss."""
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT media_type, file_id FROM delivered_media WHERE video_id = ? AND format = ?", (video_id, fmt))
+        row = cursor.fetchone()
+        if row:
+            cursor.execute("""
+                UPDATE delivered_media SET last_used_time = ?, hits = hits + 1
+                WHERE video_id = ? AND format = ?
+            """, (datetime.now().isoformat(), video_id, fmt))
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"SQLite error during media cache lookup for {video_id} {fmt}: {e}")
+        row = None
+
+    _count('hits' if row else 'misses')
+    return (row[0], row[1]) if row else None
+
+
+def is_media_cached(video_id: str, fmt: str) -> bool:
+    """Whether a file_id is stored for (video_id, fmt), without counting a hit or touching its LRU time."""
+    try:
+        cursor = get_connection().cursor()
+        cursor.execute("SELECT 1 FROM delivered_media WHERE video_id = ? AND format = ?", (video_id, fmt))
+        return cursor.fetchone() is not None
+    except sqlite3.Error as e:
+        logger.error(f"SQLite error during media cache check for {video_id} {fmt}: {e}")
+        return False
+
+
+def store_media(video_id: str, fmt: str, media_type: str, file_id: str, file_size: Optional[int] = None):
+    """Remembers the file_id Telegram returned for an upload, then applies the eviction policy."""
+    now = datetime.now().isoformat()
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO delivered_media (video_id, format, media_type, file_id, file_size, created_time, last_used_time, hits)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+            ON CONFLICT (video_id, format) DO UPDATE SET
+                media_type = excluded.media_type,
+                file_id = excluded.file_id,
+                file_size = excluded.file_size,
+                created_time = excluded.created_time,
+                last_used_time = excluded.last_used_time
+        """, (video_id, fmt, media_type, file_id, file_size, now, now))
+        conn.commit()
+        _count('stores')
+        logger.info(f"Cached file_id for {video_id} {fmt}.")
+    except sqlite3.Error as e:
+        logger.error(f"SQLite error while caching file_id for {video_id} {fmt}: {e}")
+        return
+
+    evict_media()
+
+
+def invalidate_media(video_id: str, fmt: Optional[str] = None):
+    """Drops cached file_ids for a video (all formats when fmt is None), e.g. after Telegram rejects one."""
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        if fmt is None:
+            cursor.execute("DELETE FROM delivered_media WHERE video_id = ?", (video_id,))
+        else:
+            cursor.execute("DELETE FROM delivered_media WHERE video_id = ? AND format = ?", (video_id, fmt))
+        removed = cursor.rowcount
+        conn.commit()
+        _count('invalidations', removed)
+        logger.info(f"Invalidated {removed} cached file_id(s) for {video_id}.")
+    except sqlite3.Error as e:
+        logger.error(f"SQLite error while invalidating cache for {video_id}: {e}")
+
+
+def evict_media():
+    """Removes entries unused for MEDIA_CACHE_MAX_AGE_DAYS and trims the table to MEDIA_CACHE_MAX_ENTRIES (least recently used first)."""
+    cutoff = (datetime.now() - timedelta(days=MEDIA_CACHE_MAX_AGE_DAYS)).isoformat()
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM delivered_media WHERE last_used_time < ?", (cutoff,))
+        removed = cursor.rowcount
+        cursor.execute("""
+            DELETE FROM delivered_media WHERE rowid IN (
+                SELECT rowid FROM delivered_media ORDER BY last_used_time DESC LIMIT -1 OFFSET ?
+            )
+        """, (MEDIA_CACHE_MAX_ENTRIES,))
+        removed += cursor.rowcount
+        conn.commit()
+        if removed:
+            _count('evictions', removed)
+            logger.info(f"Evicted {removed} cached file_id(s).")
+    except sqlite3.Error as e:
+        logger.error(f"SQLite error during media cache eviction: {e}")
+
+
+def media_cache_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    total = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / total, 3) if total else 0.0
+    return stats
+
+
+registry.register_cache('media', media_cache_stats)
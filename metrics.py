@@ -0,0 +1,246 @@
+import os
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Port of the Prometheus /metrics endpoint, 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Seconds, from a cached manifest lookup up to a long 1080p merge
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+GEMINI_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, _format_labels(self.labelnames, key), value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {value:g}" for name, labels, value in self._samples()]
+        return lines
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. bytes downloaded."""
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        if not self.labelnames:
+            # Export an unlabelled counter as 0 before its first increment
+            self._values[()] = 0.0
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down. With a callback the value is read when the metrics are scraped."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), callback: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def value(self, **labels) -> float:
+        if self.callback:
+            return self.callback()
+        return super().value(**labels)
+
+    def _samples(self):
+        if self.callback:
+            yield self.name, '', self.callback()
+        else:
+            yield from super()._samples()
+
+
+class Histogram(_Metric):
+    """Counts observations into cumulative buckets, plus their sum and count."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = STAGE_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), then sum and count
+                series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes how long the with block took."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        series = self._values.get(self._key(labels))
+        return series[-1] if series else 0
+
+    def quantile(self, q: float, **labels) -> float:
+        """Estimates the q-quantile (0..1) by interpolating inside the bucket it falls into."""
+        with self._lock:
+            series = list(self._values.get(self._key(labels)) or ())
+        if not series or not series[-1]:
+            return 0.0
+        rank = q * series[-1]
+        cumulative, lower = 0, 0.0
+        for index, upper in enumerate(self.buckets):
+            if cumulative + series[index] >= rank:
+                return lower + (upper - lower) * ((rank - cumulative) / series[index] if series[index] else 0)
+            cumulative += series[index]
+            lower = upper
+        return self.buckets[-1]
+
+    def label_values(self) -> list[tuple]:
+        with self._lock:
+            return list(self._values)
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._values.items()]
+        for key, series in items:
+            cumulative = 0
+            for upper, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                le = '+Inf' if upper == float('inf') else f"{upper:g}"
+                yield f"{self.name}_bucket", _format_labels(self.labelnames, key, f'le="{le}"'), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labelnames, key), series[-2]
+            yield f"{self.name}_count", _format_labels(self.labelnames, key), series[-1]
+
+
+class Registry:
+    """Holds every metric and the caches whose hit/miss counters are exported."""
+
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+        self._caches: dict[str, Callable[[], dict]] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def register_cache(self, name: str, stats: Callable[[], dict]):
+        """stats() returns a dict with at least 'hits' and 'misses' (TTLCache.stats or media_cache_stats)."""
+        with self._lock:
+            self._caches[name] = stats
+
+    def cache_stats(self) -> dict[str, dict]:
+        with self._lock:
+            caches = dict(self._caches)
+        return {name: stats() for name, stats in caches.items()}
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+
+        caches = self.cache_stats()
+        for field, kind in (('hits', 'counter'), ('misses', 'counter'), ('size', 'gauge')):
+            name = f"bot_cache_{field}" + ('_total' if kind == 'counter' else '')
+            lines += [f"# HELP {name} Cache {field} per cache", f"# TYPE {name} {kind}"]
+            lines += [f'{name}{{cache="{cache}"}} {stats[field]:g}' for cache, stats in caches.items() if field in stats]
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# --- Bot metrics ---
+STAGE_SECONDS = registry.register(Histogram(
+    'bot_stage_seconds', "Seconds spent per job stage (manifest, download, mux, upload, captions)", ('stage',)))
+TRANSFER_BYTES = registry.register(Counter(
+    'bot_transfer_bytes_total', "Bytes downloaded from YouTube and uploaded to Telegram", ('direction',)))
+GEMINI_SECONDS = registry.register(Histogram(
+    'bot_gemini_request_seconds', "Latency of single Gemini API calls", ('outcome',), GEMINI_BUCKETS))
+GEMINI_RETRIES = registry.register(Counter(
+    'bot_gemini_retries_total', "Gemini calls retried after a transient error"))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> Optional[ThreadingHTTPServer]:
+    """Serves GET /metrics from a background thread. Does nothing when port is 0."""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"Could not start metrics endpoint on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving Prometheus metrics on http://{host}:{port}/metrics")
+    return server
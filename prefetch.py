@@ -0,0 +1,294 @@
+import os
+import time
+import asyncio
+import concurrent.futures
+import logging
+from typing import Callable, Optional
+
+# Import Files
+from youtube_extraction import FormatSpec, AUDIO_SPEC, MUX_JOBS, mux, load_video
+from cache import extract_video_id
+from jobs import job_engine
+from storage import storage, remove_job_file, StorageFullError
+from media_cache import is_media_cached
+from metrics import registry, Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# 1 = download cheap files while the user is choosing, 0 = only resolve the manifest, sizes and captions
+PREFETCH_FILES = os.getenv("PREFETCH_FILES", "1") == "1"
+# Only files at most this big are downloaded ahead
+PREFETCH_MAX_FILE_BYTES = int(float(os.getenv("PREFETCH_MAX_FILE_MB", "15")) * 1024 * 1024)
+# Bytes of prefetched files (running or waiting to be claimed) in total and per user
+PREFETCH_CACHE_BYTES = int(float(os.getenv("PREFETCH_CACHE_MB", "200")) * 1024 * 1024)
+PREFETCH_USER_BYTES = int(float(os.getenv("PREFETCH_USER_MB", "30")) * 1024 * 1024)
+# Prefetch downloads running at the same time
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "2"))
+# Seconds a prefetched file waits for its user before it is deleted
+PREFETCH_TTL = float(os.getenv("PREFETCH_TTL", "600"))
+
+# What is worth fetching ahead: the audio and the smallest video
+PREFETCH_SPECS = (AUDIO_SPEC, FormatSpec(resolution=144))
+
+PREFETCH_RESULTS = registry.register(Counter(
+    'bot_prefetch_total', "Prefetched files by outcome (hit, miss, wasted, evicted, cancelled, skipped)", ('result',)))
+
+
+class PrefetchCancelled(Exception):
+    """Raised from the download progress callback to stop a prefetch nobody wants anymore."""
+
+
+class _Prefetch:
+    """One file being (or already) downloaded ahead for a user."""
+
+    def __init__(self, user_id: int, size: int):
+        self.user_id = user_id
+        self.size = size
+        self.task: Optional[asyncio.Task] = None
+        self.finished_at: Optional[float] = None
+        self.cancelled = False
+        self.claimed = False
+        self.listener: Optional[Callable[[int, int], None]] = None
+
+    def report(self, done: int, total: int):
+        # Called from the download threads
+        if self.cancelled:
+            raise PrefetchCancelled()
+        listener = self.listener
+        if listener:
+            listener(done, total)
+
+
+class Prefetcher:
+    """
+    Works ahead while the user is looking at the keyboard.
+
+    start() is called when a link arrives: it resolves the manifest, the size of every quality and the
+    caption list, and downloads the cheap formats (PREFETCH_SPECS under PREFETCH_MAX_FILE_BYTES) into
+    scratch directories. take() hands such a file to the download that asks for it, waiting for a prefetch
+    that is still running. Downloads only start while the job engine has free slots, within a global and a
+    per-user byte budget; a user's next link cancels what was fetched for the previous one, files
+    nobody claims are deleted after PREFETCH_TTL, and the oldest of them go first when storage runs short (checked on every start() and by the loop of start_expiry()).
+    """
+
+    def __init__(self, download_files: bool = PREFETCH_FILES, max_file_bytes: int = PREFETCH_MAX_FILE_BYTES,
+                 cache_bytes: int = PREFETCH_CACHE_BYTES, user_bytes: int = PREFETCH_USER_BYTES,
+                 concurrency: int = PREFETCH_CONCURRENCY, ttl: float = PREFETCH_TTL):
+        self.download_files = download_files
+        self.max_file_bytes = max_file_bytes
+        self.cache_bytes = cache_bytes
+        self.user_bytes = user_bytes
+        self.concurrency = concurrency
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Keyed by (video_id, spec label)
+        self._entries: dict[tuple[str, str], _Prefetch] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._running = 0
+        self._expiry: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self, user_id: int, link: str, download: bool = True):
+        """Starts working ahead on link in the background."""
+        video_id = extract_video_id(link)
+        if video_id is None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._expire()
+        # The user moved on to another video
+        self.cancel_user(user_id, keep=video_id)
+        self._spawn(self._run(user_id, video_id, link, download and self.download_files))
+
+    def _spawn(self, coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def sizes(self, link: str, specs: list[FormatSpec]) -> dict[str, int]:
+        """Bytes each spec would download (by label), 0 for specs the video doesn't have."""
+        video = await job_engine.run_network(load_video, link)
+        return await job_engine.run_network(lambda: {spec.label: video.estimate_size(spec) for spec in specs})
+
+    async def _run(self, user_id: int, video_id: str, link: str, download: bool):
+        try:
+            video = await job_engine.run_network(load_video, link)
+            # Keyed by the labels the handler looks up, where audio carries this video's bitrate
+            prefetch_specs = await job_engine.run_network(lambda: [video.delivered_spec(spec) for spec in PREFETCH_SPECS])
+            specs = prefetch_specs + [FormatSpec(resolution=height) for height in video.available_resolutions()]
+            sizes = await self.sizes(link, specs)
+            await job_engine.run_network(video.caption_tracks)
+        except Exception as e:
+            logger.warning(f"Prefetch of {video_id} failed: {e}")
+            return
+
+        if not download:
+            return
+        for spec in prefetch_specs:
+            key = (video_id, spec.label)
+            size = sizes.get(spec.label, 0)
+            if key in self._entries or not size:
+                continue
+            if not self._within_budget(user_id, size):
+                PREFETCH_RESULTS.inc(result='skipped')
+                continue
+            # Files already on Telegram are re-sent by file_id, there is nothing to gain
+            if await job_engine.run_network(is_media_cached, video_id, spec.label):
+                continue
+            # The engine may have got busy while we checked
+            if key in self._entries or not self._within_budget(user_id, size):
+                continue
+            entry = _Prefetch(user_id, size)
+            self._entries[key] = entry
+            self._running += 1
+            entry.task = self._spawn(self._download(key, entry, link, spec))
+
+    def _within_budget(self, user_id: int, size: int) -> bool:
+        # Real downloads come first
+        if job_engine.queued or job_engine.active >= job_engine.max_global:
+            return False
+        if self._running >= self.concurrency or size > self.max_file_bytes:
+            return False
+        entries = list(self._entries.values())
+        if sum(e.size for e in entries) + size > self.cache_bytes:
+            return False
+        return sum(e.size for e in entries if e.user_id == user_id) + size <= self.user_bytes
+
+    async def _download(self, key: tuple[str, str], entry: _Prefetch, link: str, spec: FormatSpec) -> Optional[str]:
+        path = None
+        try:
+            video = await job_engine.run_network(load_video, link)
+            path = await job_engine.run_network(video.fetch, spec, entry.report)
+            if isinstance(path, MUX_JOBS):
+                path = await job_engine.run_mux(mux, path)
+        except StorageFullError as e:
+            logger.info(f"Skipped prefetch of {key}: {e}")
+            path = None
+        except Exception as e:
+            logger.warning(f"Prefetch of {key} failed: {e}")
+            path = None
+        finally:
+            self._running -= 1
+            entry.finished_at = time.monotonic()
+
+        if path and entry.cancelled and not entry.claimed:
+            remove_job_file(path)
+            return None
+        if not path and self._entries.get(key) is entry:
+            del self._entries[key]
+        return path
+
+    async def take(self, video_id: str, spec: FormatSpec, on_progress: Optional[Callable[[int, int], None]] = None) -> Optional[str]:
+        """
+        Claims the prefetched file for spec, waiting for its download if it is still running (reporting
+        through on_progress meanwhile). Returns None on a miss; otherwise the caller owns the file.
+        """
+        entry = self._entries.pop((video_id, spec.label), None)
+        if entry is None or entry.cancelled:
+            self.misses += 1
+            PREFETCH_RESULTS.inc(result='miss')
+            return None
+
+        entry.claimed = True
+        entry.listener = on_progress
+        # Shielded: the download carries on (and is cleaned up) even if the waiting job is cancelled
+        path = await asyncio.shield(entry.task)
+        if not path or not os.path.exists(path):
+            self.misses += 1
+            PREFETCH_RESULTS.inc(result='miss')
+            return None
+        self.hits += 1
+        PREFETCH_RESULTS.inc(result='hit')
+        logger.info(f"Served {video_id} {spec.label} from the prefetch.")
+        return path
+
+    def cancel_user(self, user_id: int, keep: Optional[str] = None):
+        """Drops everything prefetched for user_id except files of video `keep`."""
+        for key, entry in list(self._entries.items()):
+            if entry.user_id == user_id and key[0] != keep:
+                self._drop(key, 'cancelled')
+
+    def start_expiry(self):
+        """Starts deleting expired files in the background, so they don't wait for the next link on an idle bot."""
+        if self._expiry is None:
+            self._expiry = asyncio.create_task(self._expire_loop())
+
+    async def _expire_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl / 10)
+            self._expire()
+
+    def _expire(self):
+        now = time.monotonic()
+        for key, entry in list(self._entries.items()):
+            if entry.finished_at is not None and now - entry.finished_at > self.ttl:
+                self._drop(key, 'wasted')
+
+    def evict(self, need: int) -> int:
+        """
+        Storage evictor: deletes finished, unclaimed files (least recently finished first) until `need` bytes
+        are freed. Returns the bytes freed. Called from the download threads, so the work runs on the event loop.
+        """
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return 0
+        try:
+            if asyncio.get_running_loop() is loop:
+                return self._evict(need)
+        except RuntimeError:
+            pass
+
+        async def evict_on_loop() -> int:
+            return self._evict(need)
+        try:
+            return asyncio.run_coroutine_threadsafe(evict_on_loop(), loop).result(timeout=5)
+        except (concurrent.futures.TimeoutError, RuntimeError):
+            return 0
+
+    def _evict(self, need: int) -> int:
+        finished = [(entry.finished_at, key) for key, entry in self._entries.items()
+                    if entry.finished_at is not None and entry.task.done() and not entry.task.cancelled() and entry.task.result()]
+        freed = 0
+        for _, key in sorted(finished):
+            if freed >= need:
+                break
+            freed += self._entries[key].size
+            self._drop(key, 'evicted')
+        if freed:
+            logger.info(f"Evicted {freed / 1024 ** 2:.1f} MB of prefetched files to make room.")
+        return freed
+
+    def _drop(self, key: tuple[str, str], reason: str):
+        entry = self._entries.pop(key)
+        entry.cancelled = True
+        PREFETCH_RESULTS.inc(result=reason)
+        # A running download is aborted by its next progress callback and _download removes what was written
+        if entry.task.done() and not entry.task.cancelled() and entry.task.result():
+            remove_job_file(entry.task.result())
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0}
+
+    async def close(self):
+        """Cancels running prefetches and deletes unclaimed files."""
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+        for key in list(self._entries):
+            self._drop(key, 'cancelled')
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+prefetcher = Prefetcher()
+storage.add_evictor(prefetcher.evict)
+registry.register_cache('prefetch', prefetcher.stats)
+registry.register(Gauge('bot_prefetch_running', "Prefetch downloads running", callback=lambda: prefetcher.running))
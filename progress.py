@@ -0,0 +1,151 @@
+import os
+import asyncio
+import logging
+import threading
+from typing import Callable, Optional
+from telegram import Bot
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Minimum seconds between two edits of a progress message (Telegram allows about one message per second per chat)
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "3"))
+
+STAGE_TEXT = {
+    'preparing': "⏳ کیفیت {label} لطفا منتظر بمانید، در حال آماده سازی...",
+    'queued': "🕒 سرور شلوغ است، کیفیت {label} (حدود {total_mb} مگابایت) در صف قرار گرفت. جایگاه شما: {position}",
+    'download': "⬇️ کیفیت {label} در حال دانلود... {percent}% ({done_mb} از {total_mb} مگابایت)",
+    'mux': "⚙️ کیفیت {label} در حال ادغام صدا و تصویر...",
+    'transcode': "⚙️ کیفیت {label} در حال تبدیل فایل صوتی...",
+    'clip': "✂️ کیفیت {label} در حال برش...",
+    'upload': "⬆️ کیفیت {label} در حال ارسال ({total_mb} مگابایت)...",
+    'batch': "📚 {label}\n{done} از {total} ویدیو ارسال شد، بقیه در حال آماده سازی...",
+    'retrying': "🔁 کیفیت {label} با خطا مواجه شد، به زودی دوباره تلاش میشود (تلاش {done} از {total})...",
+}
+
+
+class ProgressMessage:
+    """
+    One status message per job that is edited in place as the job moves through its stages.
+
+    update() only records the latest state, so it can be called from download threads as often as they like.
+    A task on the event loop turns the state into text and edits the message at most every `interval`
+    seconds, skipping edits that wouldn't change the text. Other chats waiting for the same job attach()
+    and get their own message that follows along. close() deletes the messages once the job is done
+    (or keeps them, e.g. to tell the user a failed job is retried).
+    """
+
+    def __init__(self, bot: Bot, label: str, interval: float = PROGRESS_EDIT_INTERVAL):
+        self.bot = bot
+        self.label = label
+        self.interval = interval
+        self._messages: list[tuple[int, int]] = []
+        self._state = {'stage': 'preparing', 'done': 0, 'total': 0, 'position': 0}
+        self._lock = threading.Lock()
+        self._wake_pending = False
+        self._shown: Optional[str] = None
+        self._changed = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._task: Optional[asyncio.Task] = None
+        self._chats: set[int] = set()
+        self._closed = False
+
+    def text(self) -> str:
+        with self._lock:
+            state = dict(self._state)
+        done, total = state['done'], state['total']
+        return STAGE_TEXT[state['stage']].format(
+            label=self.label,
+            position=state['position'],
+            done=done,
+            total=total,
+            percent=int(done * 100 / total) if total else 0,
+            done_mb=f"{done / 1024 ** 2:.1f}",
+            total_mb=f"{total / 1024 ** 2:.1f}",
+        )
+
+    def update(self, stage: str, done: int = 0, total: int = 0, position: int = 0):
+        """Records the job's current stage. Safe to call from any thread, never talks to Telegram itself."""
+        with self._lock:
+            self._state = {'stage': stage, 'done': done, 'total': total, 'position': position}
+            if self._wake_pending:
+                return
+            self._wake_pending = True
+        try:
+            self._loop.call_soon_threadsafe(self._changed.set)
+        except RuntimeError:
+            # The event loop is already closed, nobody is left to show the progress to
+            pass
+
+    def download_callback(self) -> Callable[[int, int], None]:
+        """on_progress(done_bytes, total_bytes) for the downloader."""
+        return lambda done, total: self.update('download', done, total)
+
+    async def attach(self, chat_id: int, reply_to: Optional[int] = None) -> bool:
+        """Shows the progress in chat_id too. Returns False if that chat already follows this job."""
+        # Claimed before sending, so a second press while the message is on its way doesn't get a message too
+        if chat_id in self._chats:
+            return False
+        self._chats.add(chat_id)
+        text = self.text()
+        message = await self.bot.send_message(chat_id, text, reply_to_message_id=reply_to)
+        if self._closed:
+            # The job finished while the message was being sent
+            await self._delete(chat_id, message.message_id)
+            return True
+        self._messages.append((chat_id, message.message_id))
+        if self._task is None:
+            self._shown = text
+            self._task = asyncio.create_task(self._run())
+        return True
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            with self._lock:
+                self._wake_pending = False
+            await self._flush()
+            # Everything reported while we sleep is coalesced into the next edit
+            await asyncio.sleep(self.interval)
+
+    async def _flush(self):
+        text = self.text()
+        if text == self._shown:
+            return
+        self._shown = text
+        for chat_id, message_id in list(self._messages):
+            try:
+                await self.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+            except RetryAfter as e:
+                logger.warning(f"Progress edits in chat {chat_id} throttled for {e.retry_after}s.")
+                await asyncio.sleep(e.retry_after)
+            except BadRequest:
+                # "message is not modified" or the user deleted the message
+                pass
+            except TelegramError as e:
+                logger.warning(f"Could not update progress in chat {chat_id}: {e}")
+
+    async def close(self, keep: bool = False):
+        """Stops editing and deletes the progress messages, or with keep leaves them showing the last update()."""
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if keep:
+            await self._flush()
+            self._messages = []
+            return
+        messages, self._messages = self._messages, []
+        for chat_id, message_id in messages:
+            await self._delete(chat_id, message_id)
+
+    async def _delete(self, chat_id: int, message_id: int):
+        try:
+            await self.bot.delete_message(chat_id, message_id)
+        except TelegramError:
+            pass
@@ -0,0 +1,97 @@
+import time
+import asyncio
+import threading
+from typing import Hashable
+
+
+class TokenBucket:
+    """
+    Async token bucket: refills `rate` tokens per second up to `capacity`.
+    acquire() sleeps on the event loop (never blocks it) until enough tokens are available.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """Takes tokens without waiting. Returns False if the bucket doesn't hold enough."""
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def retry_after(self, tokens: float = 1.0) -> float:
+        """Seconds until the bucket holds enough tokens (0 if it already does)."""
+        self._refill()
+        return max(0.0, (tokens - self._tokens) / self.rate)
+
+    async def acquire(self, tokens: float = 1.0):
+        # The lock keeps waiters in FIFO order instead of racing for each refill
+        async with self._lock:
+            while not self.try_acquire(tokens):
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class KeyedRateLimiter:
+    """
+    One TokenBucket per key, e.g. per user. Buckets that refilled completely are forgotten once more than
+    max_keys keys are tracked, since a fresh bucket behaves the same.
+    """
+
+    def __init__(self, rate: float, capacity: float, max_keys: int = 10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets: dict[Hashable, TokenBucket] = {}
+
+    def try_acquire(self, key: Hashable, tokens: float = 1.0) -> float:
+        """Takes tokens from key's bucket. Returns 0 on success, otherwise the seconds until it would succeed."""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._prune()
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+        if bucket.try_acquire(tokens):
+            return 0.0
+        return bucket.retry_after(tokens)
+
+    def _prune(self):
+        for key, bucket in list(self._buckets.items()):
+            bucket._refill()
+            if bucket._tokens >= bucket.capacity:
+                del self._buckets[key]
+
+
+class BandwidthShaper:
+    """
+    Thread-safe byte rate limit shared by all download threads. consume() lets a chunk through right away
+    and then sleeps the calling thread until the average rate is back under bytes_per_second.
+    """
+
+    def __init__(self, bytes_per_second: float, burst: float = 0):
+        self.rate = bytes_per_second
+        self.capacity = burst or bytes_per_second
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate) - amount
+            self._updated = now
+            deficit = -self._tokens
+        if deficit > 0:
+            time.sleep(deficit / self.rate)
@@ -0,0 +1,222 @@
+import os
+import json
+import asyncio
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Optional
+from telegram.ext import BasePersistence, PersistenceInput
+
+# Import Files
+from task_queue import SHARED_DB, REDIS_URL
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# "" = user_data stays in this process, "sqlite" / "redis" = shared by every bot front-end
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "").lower()
+# Seconds between writes of changed user_data to the shared store
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "1"))
+# Sessions untouched for this many seconds are dropped (Redis expires them, SQLite on startup)
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(7 * 86400)))
+
+
+class SessionStore(ABC):
+    """
+    Key/value store for JSON-serializable dicts, grouped in namespaces ('user', 'chat').
+    Every set() bumps the entry's version, so readers can tell whether someone else wrote it since.
+    """
+
+    @abstractmethod
+    def get(self, namespace: str, key: int) -> Optional[tuple[dict, int]]:
+        """(data, version) of an entry, or None."""
+        ...
+
+    @abstractmethod
+    def set(self, namespace: str, key: int, data: dict) -> int:
+        """Stores data and returns its new version."""
+        ...
+
+    @abstractmethod
+    def delete(self, namespace: str, key: int):
+        ...
+
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, path: str = SHARED_DB, ttl: int = SESSION_TTL):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                namespace TEXT NOT NULL,
+                key INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                updated_time REAL NOT NULL,
+                version INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (namespace, key)
+            )
+        """)
+        # Tables created before entries had versions
+        if 'version' not in {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}:
+            conn.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        conn.execute("DELETE FROM sessions WHERE updated_time < strftime('%s', 'now') - ?", (ttl,))
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace: str, key: int) -> Optional[tuple[dict, int]]:
+        row = self._conn().execute("SELECT data, version FROM sessions WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def set(self, namespace: str, key: int, data: dict) -> int:
+        conn = self._conn()
+        conn.execute("""
+            INSERT INTO sessions (namespace, key, data, updated_time, version) VALUES (?, ?, ?, strftime('%s', 'now'), 1)
+            ON CONFLICT (namespace, key) DO UPDATE SET
+                data = excluded.data, updated_time = excluded.updated_time, version = sessions.version + 1
+        """, (namespace, key, json.dumps(data, ensure_ascii=False)))
+        # Still inside the write transaction, so this is the version we just wrote
+        version = conn.execute("SELECT version FROM sessions WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()[0]
+        conn.commit()
+        return version
+
+    def delete(self, namespace: str, key: int):
+        conn = self._conn()
+        conn.execute("DELETE FROM sessions WHERE namespace = ? AND key = ?", (namespace, key))
+        conn.commit()
+
+
+class RedisSessionStore(SessionStore):
+    def __init__(self, url: str = REDIS_URL, prefix: str = "aurora:session", ttl: int = SESSION_TTL):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("SESSION_BACKEND=redis needs the redis package (pip install redis).") from e
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._prefix = prefix
+        self._ttl = ttl
+
+    def _key(self, namespace: str, key: int) -> str:
+        return f"{self._prefix}:{namespace}:{key}"
+
+    def get(self, namespace: str, key: int) -> Optional[tuple[dict, int]]:
+        name = self._key(namespace, key)
+        data, version = self._redis.mget(name, f"{name}:version")
+        return (json.loads(data), int(version or 0)) if data else None
+
+    def set(self, namespace: str, key: int, data: dict) -> int:
+        name = self._key(namespace, key)
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.set(name, json.dumps(data, ensure_ascii=False), ex=self._ttl)
+        pipe.incr(f"{name}:version")
+        pipe.expire(f"{name}:version", self._ttl)
+        return pipe.execute()[1]
+
+    def delete(self, namespace: str, key: int):
+        name = self._key(namespace, key)
+        self._redis.delete(name, f"{name}:version")
+
+
+class SharedPersistence(BasePersistence):
+    """
+    PTB persistence backed by a SessionStore, so several bot processes see the same user_data/chat_data.
+
+    Nothing is loaded at startup: before every update PTB calls refresh_user_data/refresh_chat_data,
+    which replace the in-memory dict with the stored one when another process wrote a newer version.
+    Otherwise the local dict is kept, since it may hold changes not written yet: they are written back
+    every SESSION_FLUSH_INTERVAL seconds. bot_data, callback data and conversations are not stored.
+    """
+
+    def __init__(self, store: SessionStore, update_interval: float = SESSION_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+        # Version of every entry as this process last loaded or wrote it
+        self._versions: dict[tuple[str, int], int] = {}
+
+    async def _refresh(self, namespace: str, key: int, data: dict):
+        stored = await asyncio.to_thread(self.store.get, namespace, key)
+        if stored is None:
+            return
+        stored_data, version = stored
+        if version > self._versions.get((namespace, key), -1):
+            data.clear()
+            data.update(stored_data)
+            self._versions[(namespace, key)] = version
+
+    async def _update(self, namespace: str, key: int, data: dict):
+        self._versions[(namespace, key)] = await asyncio.to_thread(self.store.set, namespace, key, data)
+
+    async def _drop(self, namespace: str, key: int):
+        self._versions.pop((namespace, key), None)
+        await asyncio.to_thread(self.store.delete, namespace, key)
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        await self._refresh('user', user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        await self._refresh('chat', chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def update_user_data(self, user_id: int, data: dict):
+        await self._update('user', user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        await self._update('chat', chat_id, data)
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name: str, key, new_state):
+        pass
+
+    async def drop_user_data(self, user_id: int):
+        await self._drop('user', user_id)
+
+    async def drop_chat_data(self, chat_id: int):
+        await self._drop('chat', chat_id)
+
+    async def flush(self):
+        pass
+
+
+def open_session_persistence(backend: str = SESSION_BACKEND) -> Optional[SharedPersistence]:
+    """Persistence for the configured shared session store, or None to keep sessions in memory."""
+    if not backend:
+        return None
+    if backend == 'sqlite':
+        return SharedPersistence(SQLiteSessionStore(SHARED_DB))
+    if backend == 'redis':
+        return SharedPersistence(RedisSessionStore(REDIS_URL))
+    raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
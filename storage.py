@@ -0,0 +1,278 @@
+import os
+import time
+import shutil
+import tempfile
+import logging
+import threading
+from typing import Callable, Optional
+
+# Import Files
+from metrics import registry, Gauge
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Bytes the bot's scratch files may take on disk in total, 0 = no quota
+STORAGE_QUOTA_BYTES = int(float(os.getenv("STORAGE_QUOTA_MB", "0")) * 1024 * 1024)
+# Free disk space that must remain after a job got the space it needs
+STORAGE_MIN_FREE_BYTES = int(float(os.getenv("STORAGE_MIN_FREE_MB", "500")) * 1024 * 1024)
+# Scratch directories older than this are removed by the startup sweep even if their process still runs
+STORAGE_SWEEP_MAX_AGE = float(os.getenv("STORAGE_SWEEP_MAX_AGE_HOURS", "24")) * 3600
+
+SCRATCH_AREAS = ('videos', 'audios')
+# Every download gets its own directory so concurrent jobs never share file names
+SCRATCH_PREFIX = "job_"
+# Directories of failed downloads kept for resuming, named after their resume key
+PARTIAL_PREFIX = "partial_"
+OWNER_FILE = ".owner"
+RESUME_FILE = ".resume"
+# Loose files the old code left directly in videos/ and audios/ are swept after this many seconds
+LOOSE_FILE_MAX_AGE = 3600
+
+
+class StorageFullError(Exception):
+    """Raised when a job would exceed the byte quota or leave too little free disk space."""
+
+
+def _tree_size(path: str) -> int:
+    total = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        total += _tree_size(entry.path)
+                    else:
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return total
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class StorageManager:
+    """
+    Owns the bot's files on disk.
+
+    new_job_dir() hands every job its own scratch directory after checking that the job's expected size
+    fits the free space and the quota; the expected size stays reserved until the directory is removed
+    (whichever process removes it). When a job doesn't fit, the evictors registered with add_evictor()
+    (the prefetcher's unclaimed files) are asked to free the missing bytes, then kept partial downloads are
+    dropped, before StorageFullError is raised. keep_partial() keeps what a failed job downloaded so the next
+    new_job_dir() with the same resume key continues from there. sweep() removes scratch directories left
+    behind by a crash.
+    """
+
+    def __init__(self, root: str = '.', quota_bytes: int = STORAGE_QUOTA_BYTES, min_free_bytes: int = STORAGE_MIN_FREE_BYTES):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self._reservations: dict[str, int] = {}
+        self._evictors: list[Callable[[int], int]] = []
+        self._lock = threading.Lock()
+
+    def _area(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    # --- Scratch directories ---
+
+    def new_job_dir(self, area: str, expected_bytes: int = 0, resume_key: Optional[str] = None) -> str:
+        """
+        Creates a scratch directory for one job in area (videos/audios) with expected_bytes reserved for it.
+        If a failed job with the same resume_key kept its partial downloads, the directory starts with them.
+        """
+        # Outside the lock: evictors may wait for the event loop, which may be waiting for the lock
+        with self._lock:
+            shortfall = self._shortfall(expected_bytes)
+        if shortfall > 0:
+            self._evict(shortfall)
+        with self._lock:
+            self._make_room(expected_bytes)
+            base = self._area(area)
+            os.makedirs(base, exist_ok=True)
+            job_dir = tempfile.mkdtemp(prefix=SCRATCH_PREFIX, dir=base)
+            if resume_key:
+                self._resume(os.path.join(base, PARTIAL_PREFIX + resume_key), job_dir)
+            with open(os.path.join(job_dir, OWNER_FILE), 'w') as f:
+                f.write(str(os.getpid()))
+            if resume_key:
+                # Lets the startup sweep keep this job's downloads if the process dies
+                with open(os.path.join(job_dir, RESUME_FILE), 'w') as f:
+                    f.write(resume_key)
+            self._reservations[job_dir] = expected_bytes
+        return job_dir
+
+    def remove_job_dir(self, job_dir: str):
+        shutil.rmtree(job_dir, ignore_errors=True)
+        with self._lock:
+            self._reservations.pop(job_dir, None)
+
+    def keep_partial(self, job_dir: str, resume_key: str):
+        """Keeps the files of a failed job for the next new_job_dir() with resume_key, or removes them if one is kept already."""
+        partial_dir = os.path.join(os.path.dirname(job_dir), PARTIAL_PREFIX + resume_key)
+        try:
+            # Fails if another failed job already kept its files under this key
+            os.rename(job_dir, partial_dir)
+            os.utime(partial_dir)
+        except OSError:
+            self.remove_job_dir(job_dir)
+            return
+        with self._lock:
+            self._reservations.pop(job_dir, None)
+        logger.info(f"Kept partial download {partial_dir} ({_tree_size(partial_dir) / 1024 ** 2:.1f} MB) for resuming.")
+
+    @staticmethod
+    def _resume(partial_dir: str, job_dir: str):
+        try:
+            # Replaces the empty job_dir; whoever renames first gets the files if two jobs resume at once
+            os.rename(partial_dir, job_dir)
+        except OSError:
+            return
+        logger.info(f"Resuming the partial download {partial_dir}.")
+
+    def remove_job_file(self, path: str):
+        """Removes a downloaded file together with the scratch directory it was created in."""
+        parent = os.path.dirname(path)
+        if os.path.basename(parent).startswith(SCRATCH_PREFIX):
+            self.remove_job_dir(parent)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _pending_bytes(self) -> int:
+        # Reserved space jobs haven't written yet; directories removed by another process drop out here
+        pending = 0
+        for job_dir, expected in list(self._reservations.items()):
+            if not os.path.isdir(job_dir):
+                del self._reservations[job_dir]
+                continue
+            pending += max(0, expected - _tree_size(job_dir))
+        return pending
+
+    def usage(self) -> int:
+        """Bytes currently on disk in the scratch areas."""
+        return sum(_tree_size(self._area(area)) for area in SCRATCH_AREAS)
+
+    def _shortfall(self, need: int) -> int:
+        pending = self._pending_bytes()
+        free = shutil.disk_usage(self.root).free - pending
+        shortfall = self.min_free_bytes + need - free
+        if self.quota_bytes:
+            shortfall = max(shortfall, self.usage() + pending + need - self.quota_bytes)
+        return shortfall
+
+    def add_evictor(self, evictor: Callable[[int], int]):
+        """Registers evictor(bytes_needed) -> bytes_freed, which deletes files that can be downloaded again."""
+        self._evictors.append(evictor)
+
+    def _evict(self, need: int):
+        for evictor in self._evictors:
+            try:
+                need -= evictor(need)
+            except Exception as e:
+                logger.warning(f"Storage evictor {evictor} failed: {e}")
+            if need <= 0:
+                return
+        # Then partial downloads, oldest first
+        for partial_dir in self._partial_dirs():
+            size = _tree_size(partial_dir)
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            logger.info(f"Dropped partial download {partial_dir} ({size / 1024 ** 2:.1f} MB) to make room.")
+            need -= size
+            if need <= 0:
+                return
+
+    def _partial_dirs(self) -> list[str]:
+        found = []
+        for area in SCRATCH_AREAS:
+            try:
+                with os.scandir(self._area(area)) as entries:
+                    found += [(entry.stat().st_mtime, entry.path) for entry in entries
+                              if entry.name.startswith(PARTIAL_PREFIX) and entry.is_dir(follow_symlinks=False)]
+            except OSError:
+                pass
+        return [path for _, path in sorted(found)]
+
+    def _make_room(self, need: int):
+        shortfall = self._shortfall(need)
+        if shortfall > 0:
+            raise StorageFullError(f"Need {need / 1024 ** 2:.0f} MB more disk space than allowed ({shortfall / 1024 ** 2:.0f} MB short).")
+
+    # --- Startup ---
+
+    def sweep(self) -> int:
+        """
+        Removes what crashed jobs left behind: scratch directories whose owning process is gone (or that are
+        older than STORAGE_SWEEP_MAX_AGE), partial downloads kept longer than that and loose files (except
+        dotfiles) in videos/ and audios/. Recent directories of dead processes that have a resume key are
+        kept as partial downloads instead. Returns the bytes freed.
+        """
+        freed, now = 0, time.time()
+        for area in SCRATCH_AREAS:
+            base = self._area(area)
+            if not os.path.isdir(base):
+                continue
+            for entry in os.scandir(base):
+                # Dotfiles such as .gitkeep belong to the checkout, not to a job
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    age = now - entry.stat(follow_symlinks=False).st_mtime
+                    if entry.is_dir(follow_symlinks=False) and entry.name.startswith(SCRATCH_PREFIX):
+                        if age < STORAGE_SWEEP_MAX_AGE and self._owner_alive(entry.path):
+                            continue
+                        resume_key = self._resume_key(entry.path)
+                        if resume_key and age < STORAGE_SWEEP_MAX_AGE:
+                            self.keep_partial(entry.path, resume_key)
+                            continue
+                        size = _tree_size(entry.path)
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    elif entry.is_dir(follow_symlinks=False) and entry.name.startswith(PARTIAL_PREFIX) and age > STORAGE_SWEEP_MAX_AGE:
+                        size = _tree_size(entry.path)
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    elif entry.is_file(follow_symlinks=False) and age > LOOSE_FILE_MAX_AGE:
+                        size = entry.stat().st_size
+                        os.remove(entry.path)
+                    else:
+                        continue
+                    freed += size
+                    logger.info(f"Swept stale {entry.path} ({size / 1024 ** 2:.1f} MB).")
+                except OSError as e:
+                    logger.warning(f"Could not sweep {entry.path}: {e}")
+        return freed
+
+    @staticmethod
+    def _resume_key(job_dir: str) -> Optional[str]:
+        try:
+            with open(os.path.join(job_dir, RESUME_FILE)) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    @staticmethod
+    def _owner_alive(job_dir: str) -> bool:
+        try:
+            with open(os.path.join(job_dir, OWNER_FILE)) as f:
+                pid = int(f.read().strip())
+        except (OSError, ValueError):
+            return False
+        return pid != os.getpid() and _pid_alive(pid)
+
+
+storage = StorageManager()
+registry.register(Gauge('bot_storage_bytes', "Bytes in scratch directories", callback=storage.usage))
+registry.register(Gauge('bot_storage_free_bytes', "Free bytes on the storage disk", callback=lambda: shutil.disk_usage(storage.root).free))
+
+
+def remove_job_file(path: str):
+    storage.remove_job_file(path)
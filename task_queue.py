@@ -0,0 +1,332 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# "" = downloads run inside the bot process, "sqlite" = a queue file shared by processes on one machine,
+# "redis" = a Redis (or compatible) server shared by any number of machines
+QUEUE_BACKEND = os.getenv("QUEUE_BACKEND", "").lower()
+SHARED_DB = os.getenv("SHARED_DB", "bot_shared.db")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Seconds a worker owns a leased task; a task whose lease runs out without a heartbeat is handed to another worker
+QUEUE_VISIBILITY_TIMEOUT = float(os.getenv("QUEUE_VISIBILITY_TIMEOUT", "120"))
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "3"))
+# Seconds before a failed task is retried, doubled on every further attempt
+QUEUE_RETRY_DELAY = float(os.getenv("QUEUE_RETRY_DELAY", "10"))
+
+TASK_STATES = ('queued', 'leased', 'done', 'failed')
+
+
+class Task(NamedTuple):
+    id: str
+    kind: str
+    payload: dict
+    attempts: int
+    max_attempts: int
+
+
+class TaskQueue(ABC):
+    """
+    At-least-once work queue shared between bot front-ends and workers.
+
+    lease() hands a task to one worker for `visibility_timeout` seconds. The worker calls extend() while it
+    works and complete() or fail() at the end. A task whose lease runs out (crashed worker) becomes
+    available again; after max_attempts it is marked failed.
+    """
+
+    @abstractmethod
+    def enqueue(self, kind: str, payload: dict, max_attempts: int = QUEUE_MAX_ATTEMPTS, dedupe_key: Optional[str] = None) -> Optional[str]:
+        """Queues a task and returns its id, or None if an unfinished task with the same dedupe_key is already queued or running."""
+        ...
+
+    @abstractmethod
+    def lease(self, owner: str, visibility_timeout: float = QUEUE_VISIBILITY_TIMEOUT) -> Optional[Task]:
+        ...
+
+    @abstractmethod
+    def extend(self, task_id: str, owner: str, visibility_timeout: float = QUEUE_VISIBILITY_TIMEOUT) -> bool:
+        """Renews the lease. Returns False if the task is no longer ours (it expired and was handed out again)."""
+        ...
+
+    @abstractmethod
+    def complete(self, task_id: str, owner: str, result: Optional[dict] = None):
+        ...
+
+    @abstractmethod
+    def fail(self, task_id: str, owner: str, error: str, retry: bool = True):
+        """Puts the task back after a backoff delay, or marks it failed when it is out of attempts or retry is False."""
+        ...
+
+    @abstractmethod
+    def stats(self) -> dict:
+        ...
+
+    @staticmethod
+    def retry_delay(attempts: int) -> float:
+        return QUEUE_RETRY_DELAY * (2 ** max(0, attempts - 1))
+
+
+class SQLiteTaskQueue(TaskQueue):
+    """Task queue in a SQLite file. Every process on the machine that opens the same file shares the queue."""
+
+    def __init__(self, path: str = SHARED_DB):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                available_at REAL NOT NULL,
+                lease_owner TEXT,
+                lease_expires REAL,
+                error TEXT,
+                result TEXT,
+                created_time REAL,
+                updated_time REAL,
+                dedupe_key TEXT
+            )
+        """)
+        # Queue files created before tasks had a dedupe key
+        if 'dedupe_key' not in {row[1] for row in conn.execute("PRAGMA table_info(tasks)")}:
+            conn.execute("ALTER TABLE tasks ADD COLUMN dedupe_key TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status_available ON tasks (status, available_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_dedupe_key ON tasks (dedupe_key)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None: transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, kind: str, payload: dict, max_attempts: int = QUEUE_MAX_ATTEMPTS, dedupe_key: Optional[str] = None) -> Optional[str]:
+        task_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._conn()
+        # The check and the insert share one write transaction, so two front-ends can't both queue the task
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if dedupe_key is not None and conn.execute(
+                    "SELECT 1 FROM tasks WHERE dedupe_key = ? AND status IN ('queued', 'leased')", (dedupe_key,)).fetchone():
+                conn.execute("COMMIT")
+                return None
+            conn.execute("""
+                INSERT INTO tasks (id, kind, payload, status, max_attempts, available_at, created_time, updated_time, dedupe_key)
+                VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?)
+            """, (task_id, kind, json.dumps(payload), max_attempts, now, now, now, dedupe_key))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return task_id
+
+    def lease(self, owner: str, visibility_timeout: float = QUEUE_VISIBILITY_TIMEOUT) -> Optional[Task]:
+        conn = self._conn()
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can never lease the same row
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("""
+                UPDATE tasks SET status = 'failed', error = 'lease expired too often', updated_time = ?
+                WHERE status = 'leased' AND lease_expires < ? AND attempts >= max_attempts
+            """, (now, now))
+            row = conn.execute("""
+                SELECT id, kind, payload, attempts, max_attempts FROM tasks
+                WHERE (status = 'queued' AND available_at <= ?) OR (status = 'leased' AND lease_expires < ?)
+                ORDER BY available_at LIMIT 1
+            """, (now, now)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute("""
+                UPDATE tasks SET status = 'leased', lease_owner = ?, lease_expires = ?, attempts = attempts + 1, updated_time = ?
+                WHERE id = ?
+            """, (owner, now + visibility_timeout, now, row[0]))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return Task(row[0], row[1], json.loads(row[2]), row[3] + 1, row[4])
+
+    def extend(self, task_id: str, owner: str, visibility_timeout: float = QUEUE_VISIBILITY_TIMEOUT) -> bool:
+        now = time.time()
+        cursor = self._conn().execute("""
+            UPDATE tasks SET lease_expires = ?, updated_time = ?
+            WHERE id = ? AND lease_owner = ? AND status = 'leased'
+        """, (now + visibility_timeout, now, task_id, owner))
+        return cursor.rowcount == 1
+
+    def complete(self, task_id: str, owner: str, result: Optional[dict] = None):
+        self._conn().execute("""
+            UPDATE tasks SET status = 'done', result = ?, lease_owner = NULL, updated_time = ?
+            WHERE id = ? AND lease_owner = ?
+        """, (json.dumps(result) if result is not None else None, time.time(), task_id, owner))
+
+    def fail(self, task_id: str, owner: str, error: str, retry: bool = True):
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute("SELECT attempts, max_attempts FROM tasks WHERE id = ? AND lease_owner = ?", (task_id, owner)).fetchone()
+        if row is None:
+            return
+        attempts, max_attempts = row
+        if retry and attempts < max_attempts:
+            conn.execute("""
+                UPDATE tasks SET status = 'queued', error = ?, lease_owner = NULL, available_at = ?, updated_time = ?
+                WHERE id = ? AND lease_owner = ?
+            """, (error, now + self.retry_delay(attempts), now, task_id, owner))
+        else:
+            conn.execute("""
+                UPDATE tasks SET status = 'failed', error = ?, lease_owner = NULL, updated_time = ?
+                WHERE id = ? AND lease_owner = ?
+            """, (error, now, task_id, owner))
+
+    def purge(self, older_than: float = 86400):
+        """Deletes finished tasks older than `older_than` seconds."""
+        self._conn().execute("DELETE FROM tasks WHERE status IN ('done', 'failed') AND updated_time < ?", (time.time() - older_than,))
+
+    def stats(self) -> dict:
+        counts = dict(self._conn().execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+        return {state: counts.get(state, 0) for state in TASK_STATES}
+
+
+# Moves expired leases back to the ready set, then pops the first ready task and leases it, all atomically
+_REDIS_LEASE = """
+local now = tonumber(ARGV[1])
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)) do
+    redis.call('ZREM', KEYS[2], id)
+    redis.call('ZADD', KEYS[1], now, id)
+end
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, 1)
+if #ids == 0 then return false end
+local id = ids[1]
+redis.call('ZREM', KEYS[1], id)
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), id)
+local key = ARGV[4] .. id
+redis.call('HSET', key, 'status', 'leased', 'owner', ARGV[3])
+redis.call('HINCRBY', key, 'attempts', 1)
+return id
+"""
+
+
+class RedisTaskQueue(TaskQueue):
+    """
+    Task queue on a Redis-compatible server. Ready tasks live in a sorted set scored by the time they
+    become available, leased tasks in a sorted set scored by lease expiry, task data in one hash per task.
+    """
+
+    def __init__(self, url: str = REDIS_URL, prefix: str = "aurora:queue"):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("QUEUE_BACKEND=redis needs the redis package (pip install redis).") from e
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._ready = f"{prefix}:ready"
+        self._leased = f"{prefix}:leased"
+        self._task_prefix = f"{prefix}:task:"
+        # Holds the id of the unfinished task for each dedupe key
+        self._pending_prefix = f"{prefix}:pending:"
+        self._lease_script = self._redis.register_script(_REDIS_LEASE)
+
+    def enqueue(self, kind: str, payload: dict, max_attempts: int = QUEUE_MAX_ATTEMPTS, dedupe_key: Optional[str] = None) -> Optional[str]:
+        task_id = uuid.uuid4().hex
+        now = time.time()
+        # The day-long expiry only matters if a task hash disappears without _finish()
+        if dedupe_key is not None and not self._redis.set(self._pending_prefix + dedupe_key, task_id, nx=True, ex=86400):
+            return None
+        pipe = self._redis.pipeline()
+        pipe.hset(self._task_prefix + task_id, mapping={
+            'kind': kind, 'payload': json.dumps(payload), 'status': 'queued',
+            'attempts': 0, 'max_attempts': max_attempts, 'created_time': now, 'dedupe_key': dedupe_key or '',
+        })
+        pipe.zadd(self._ready, {task_id: now})
+        pipe.execute()
+        return task_id
+
+    def lease(self, owner: str, visibility_timeout: float = QUEUE_VISIBILITY_TIMEOUT) -> Optional[Task]:
+        while True:
+            task_id = self._lease_script(keys=[self._ready, self._leased], args=[time.time(), visibility_timeout, owner, self._task_prefix])
+            if not task_id:
+                return None
+            data = self._redis.hgetall(self._task_prefix + task_id)
+            if not data:
+                self._redis.zrem(self._leased, task_id)
+                continue
+            attempts, max_attempts = int(data['attempts']), int(data['max_attempts'])
+            if attempts > max_attempts:
+                # Came back from an expired lease once too often
+                self._finish(task_id, 'failed', error='lease expired too often')
+                continue
+            return Task(task_id, data['kind'], json.loads(data['payload']), attempts, max_attempts)
+
+    def _owns(self, task_id: str, owner: str) -> bool:
+        return self._redis.hget(self._task_prefix + task_id, 'owner') == owner
+
+    def extend(self, task_id: str, owner: str, visibility_timeout: float = QUEUE_VISIBILITY_TIMEOUT) -> bool:
+        if not self._owns(task_id, owner):
+            return False
+        # xx: only renew a lease that still exists, ch: count the changed score
+        return self._redis.zadd(self._leased, {task_id: time.time() + visibility_timeout}, xx=True, ch=True) == 1
+
+    def _finish(self, task_id: str, status: str, **fields):
+        dedupe_key = self._redis.hget(self._task_prefix + task_id, 'dedupe_key')
+        pipe = self._redis.pipeline()
+        if dedupe_key:
+            pipe.delete(self._pending_prefix + dedupe_key)
+        pipe.zrem(self._leased, task_id)
+        pipe.hset(self._task_prefix + task_id, mapping={'status': status, 'owner': '', **fields})
+        # Finished tasks are kept for a day for inspection
+        pipe.expire(self._task_prefix + task_id, 86400)
+        pipe.execute()
+
+    def complete(self, task_id: str, owner: str, result: Optional[dict] = None):
+        if self._owns(task_id, owner):
+            self._finish(task_id, 'done', result=json.dumps(result))
+
+    def fail(self, task_id: str, owner: str, error: str, retry: bool = True):
+        if not self._owns(task_id, owner):
+            return
+        data = self._redis.hmget(self._task_prefix + task_id, 'attempts', 'max_attempts')
+        attempts, max_attempts = int(data[0] or 0), int(data[1] or 0)
+        if retry and attempts < max_attempts:
+            pipe = self._redis.pipeline()
+            pipe.zrem(self._leased, task_id)
+            pipe.hset(self._task_prefix + task_id, mapping={'status': 'queued', 'owner': '', 'error': error})
+            pipe.zadd(self._ready, {task_id: time.time() + self.retry_delay(attempts)})
+            pipe.execute()
+        else:
+            self._finish(task_id, 'failed', error=error)
+
+    def stats(self) -> dict:
+        return {'queued': self._redis.zcard(self._ready), 'leased': self._redis.zcard(self._leased)}
+
+
+def open_task_queue(backend: str = QUEUE_BACKEND) -> Optional[TaskQueue]:
+    """The configured shared queue, or None when downloads run inside the bot process."""
+    if not backend:
+        return None
+    if backend == 'sqlite':
+        return SQLiteTaskQueue(SHARED_DB)
+    if backend == 'redis':
+        return RedisTaskQueue(REDIS_URL)
+    raise ValueError(f"Unknown QUEUE_BACKEND: {backend}")
+
+
+def new_worker_id() -> str:
+    return f"{os.uname().nodename}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
@@ -0,0 +1,79 @@
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Hashable, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Updates handled at the same time across all chats
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "256"))
+# Seconds an update waits for the previous update of its chat before it starts anyway, 0 = wait until it is done.
+# Keeps link -> button -> reply in order without making a chat wait for a whole 1080p download, so ordering
+# is best effort: an update that runs longer than this no longer holds back the chat's next ones.
+CHAT_ORDER_TIMEOUT = float(os.getenv("CHAT_ORDER_TIMEOUT", "10"))
+# Seconds shutdown waits for running updates to send their replies
+SHUTDOWN_GRACE = float(os.getenv("SHUTDOWN_GRACE", "30"))
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different chats concurrently while updates of the same chat start in the order
+    they arrived. Each update waits until the previous update of its chat has finished, or for at most
+    order_timeout seconds (0 = no limit), so a long download doesn't block that chat's later messages
+    forever. Past the timeout the order is no longer guaranteed.
+    A chat that is waiting doesn't take one of the max_concurrent_updates slots.
+    """
+
+    def __init__(self, max_concurrent_updates: int = UPDATE_CONCURRENCY, order_timeout: float = CHAT_ORDER_TIMEOUT):
+        super().__init__(max_concurrent_updates)
+        self.order_timeout = order_timeout
+        # Per chat: a future that completes when the chat's most recent update is done
+        self._tails: dict[Hashable, asyncio.Future] = {}
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[Hashable]:
+        if isinstance(update, Update) and update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._chat_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        previous = self._tails.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self._tails[key] = done
+        try:
+            if previous is not None and not previous.done():
+                try:
+                    await asyncio.wait_for(asyncio.shield(previous), timeout=self.order_timeout or None)
+                except asyncio.TimeoutError:
+                    logger.info(f"Previous update of chat {key} still running after {self.order_timeout}s, starting the next one.")
+            await super().process_update(update, coroutine)
+        except asyncio.CancelledError:
+            # Never started: close the coroutine so it isn't reported as never awaited
+            if asyncio.iscoroutine(coroutine):
+                coroutine.close()
+            raise
+        finally:
+            done.set_result(None)
+            if self._tails.get(key) is done:
+                del self._tails[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        # Let updates that are still running finish their replies
+        pending = [tail for tail in self._tails.values() if not tail.done()]
+        if pending:
+            logger.info(f"Waiting up to {SHUTDOWN_GRACE}s for {len(pending)} chat(s) to finish their updates...")
+            await asyncio.wait(pending, timeout=SHUTDOWN_GRACE)
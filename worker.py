@@ -0,0 +1,216 @@
+"""
+Worker process for the shared job queue: leases download tasks queued by the bot front-ends,
+downloads/merges the file and uploads it to the user's chat through the Bot API.
+
+    QUEUE_BACKEND=sqlite python worker.py
+
+Run as many workers as the machine (or several machines with QUEUE_BACKEND=redis) can handle.
+"""
+import os
+import signal
+import asyncio
+import logging
+from typing import Optional
+from telegram import Bot
+from telegram.error import BadRequest
+from dotenv import load_dotenv
+
+# Load .env before importing modules that read their configuration at import time
+load_dotenv()
+
+# Import Files
+from handler import CAPTION, MEDIA_TASK, build_media_file, delivered_spec, send_media, remember_media
+from youtube_extraction import FormatSpec
+from storage import storage, remove_job_file
+from progress import ProgressMessage
+from task_queue import Task, TaskQueue, open_task_queue, new_worker_id, QUEUE_VISIBILITY_TIMEOUT
+from database import init_db, close_db
+from media_cache import init_media_cache, get_cached_media, invalidate_media
+from jobs import job_engine
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+# Tasks one worker process runs at the same time
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "2"))
+# Seconds between queue polls while the queue is empty
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "1"))
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL") or "https://api.telegram.org/bot"
+
+
+class TaskLost(Exception):
+    """Raised when the lease ran out and another worker may already be working on the task."""
+
+
+async def deliver_media(bot: Bot, payload: dict, attempt: int = 1, max_attempts: int = 1):
+    """
+    Sends the requested file to the chat: from the media cache when possible, otherwise downloaded fresh.
+    If this attempt fails and the queue will retry it, the progress message stays and says so.
+    """
+    chat_id, reply_to = payload['chat_id'], payload.get('reply_to')
+    video_id = payload.get('video_id')
+    # Batch tasks are queued before their video is resolved
+    spec = await delivered_spec(payload['link'], FormatSpec.from_dict(payload['spec']))
+    file_type = spec.label
+    media_type = "audio" if spec.audio_only else "video"
+
+    # Another worker may have delivered the same file while this task waited
+    cached = await job_engine.run_network(get_cached_media, video_id, file_type) if video_id else None
+    if cached:
+        try:
+            await send_media(bot, chat_id, cached[0], cached[1], CAPTION, reply_to_message_id=reply_to)
+            await bot.send_message(chat_id, f"کیفیت {file_type} با موفقت ارسال شد!")
+            return
+        except BadRequest as e:
+            logger.warning(f"Cached file_id for {video_id} {file_type} rejected: {e}")
+            await job_engine.run_network(invalidate_media, video_id, file_type)
+
+    path = None
+    progress = ProgressMessage(bot, file_type)
+    retrying = False
+    try:
+        await progress.attach(chat_id, reply_to)
+        path = await build_media_file(payload['link'], spec, progress)
+        if not path:
+            await bot.send_message(chat_id, f"کیفیت {file_type} برای این ویدیو پیدا نشد...")
+            return
+        progress.update('upload', total=os.path.getsize(path))
+        message = await send_media(bot, chat_id, media_type, path, CAPTION, reply_to_message_id=reply_to)
+        if video_id:
+            await remember_media(video_id, file_type, media_type, message)
+        await bot.send_message(chat_id, f"کیفیت {file_type} با موفقت ارسال شد!")
+    except Exception:
+        # Otherwise the user hears nothing until the last attempt fails
+        if attempt < max_attempts:
+            progress.update('retrying', attempt, max_attempts)
+            retrying = True
+        raise
+    finally:
+        await progress.close(keep=retrying)
+        if path and os.path.exists(path):
+            remove_job_file(path)
+
+
+class Worker:
+    """Leases tasks while it has free slots, keeps their leases alive and reports the outcome to the queue."""
+
+    def __init__(self, queue: TaskQueue, bot: Bot, concurrency: int = WORKER_CONCURRENCY):
+        self.queue = queue
+        self.bot = bot
+        self.id = new_worker_id()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._running: set[asyncio.Task] = set()
+        self._stopping = asyncio.Event()
+
+    def stop(self):
+        logger.info("Worker stopping, finishing running tasks...")
+        self._stopping.set()
+
+    async def run(self):
+        logger.info(f"Worker {self.id} started.")
+        while not self._stopping.is_set():
+            await self._slots.acquire()
+            task = None
+            try:
+                task = await job_engine.run_network(self.queue.lease, self.id)
+            except Exception as e:
+                logger.error(f"Could not lease a task: {e}")
+            if task is None:
+                self._slots.release()
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=WORKER_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            running = asyncio.create_task(self._run_task(task))
+            self._running.add(running)
+            running.add_done_callback(self._running.discard)
+
+        # Graceful stop: unleased work stays queued, leased work is finished
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+    async def _heartbeat(self, task: Task, work: asyncio.Task):
+        while True:
+            await asyncio.sleep(QUEUE_VISIBILITY_TIMEOUT / 3)
+            if not await job_engine.run_network(self.queue.extend, task.id, self.id):
+                logger.warning(f"Lost the lease on task {task.id}, abandoning it.")
+                work.cancel()
+                return
+
+    async def _run_task(self, task: Task):
+        logger.info(f"Running task {task.id} ({task.kind}, attempt {task.attempts}/{task.max_attempts}).")
+        try:
+            if task.kind != MEDIA_TASK:
+                await job_engine.run_network(self.queue.fail, task.id, self.id, f"Unknown task kind {task.kind}", False)
+                return
+
+            work = asyncio.create_task(deliver_media(self.bot, task.payload, task.attempts, task.max_attempts))
+            heartbeat = asyncio.create_task(self._heartbeat(task, work))
+            try:
+                await work
+            except asyncio.CancelledError:
+                if not self._stopping.is_set() and work.cancelled():
+                    raise TaskLost(task.id)
+                raise
+            finally:
+                heartbeat.cancel()
+            await job_engine.run_network(self.queue.complete, task.id, self.id, None)
+            logger.info(f"Task {task.id} done.")
+
+        except TaskLost:
+            pass
+        except Exception as e:
+            logger.error(f"Task {task.id} failed: {e}", exc_info=True)
+            await job_engine.run_network(self.queue.fail, task.id, self.id, str(e), True)
+            if task.attempts >= task.max_attempts:
+                await self._notify_failure(task)
+        finally:
+            self._slots.release()
+
+    async def _notify_failure(self, task: Task):
+        try:
+            await self.bot.send_message(task.payload['chat_id'], "خطایی هنگام پردازش رخ داد، دوباره تلاش کنید.")
+        except Exception as e:
+            logger.error(f"Could not tell chat {task.payload['chat_id']} about failed task {task.id}: {e}")
+
+
+async def run_worker(queue: TaskQueue, token: str):
+    bot = Bot(token, base_url=BOT_API_BASE_URL)
+    worker = Worker(queue, bot)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+
+    async with bot:
+        await worker.run()
+
+
+def main():
+    queue: Optional[TaskQueue] = open_task_queue()
+    if queue is None:
+        logger.error("QUEUE_BACKEND is not set. Set it to sqlite or redis, the same as for the bot.")
+        return
+    API_KEY = os.getenv("API_KEY")
+    if not API_KEY:
+        logger.error("API_KEY not found. Ensure you have a .env file with API_KEY=<YOUR_BOT_TOKEN>")
+        return
+
+    init_db()
+    init_media_cache()
+    # Remove scratch files of jobs a previous run didn't finish
+    storage.sweep()
+    try:
+        asyncio.run(run_worker(queue, API_KEY))
+    finally:
+        job_engine.shutdown(wait=False)
+        close_db()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,415 @@
 import os
 import re
-from pytubefix import YouTube
-from typing import Optional
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from pytubefix import YouTube, Playlist, Channel
+from typing import Callable, Iterator, NamedTuple, Optional, Union
 import ffmpeg
 import logging 
 
+# Import Files
+from cache import TTLCache, extract_video_id, canonical_url
+from downloader import download_stream, download_segmented, iter_segments, USER_AGENT
+from subtitles import Cue, iter_cues, render
+from metrics import registry, STAGE_SECONDS
+from storage import storage, remove_job_file, StorageFullError
+
 logger = logging.getLogger(__name__)
 
+# Resolved YoutubeVideo objects keyed by video ID (stream URLs expire after a few hours)
+VIDEO_CACHE_SIZE = int(os.getenv("VIDEO_CACHE_SIZE", "256"))
+VIDEO_CACHE_TTL = float(os.getenv("VIDEO_CACHE_TTL", "1800"))
+video_cache = TTLCache(maxsize=VIDEO_CACHE_SIZE, ttl=VIDEO_CACHE_TTL)
+# Parsed caption cues keyed by (video_id, caption code)
+caption_cache = TTLCache(maxsize=int(os.getenv("CAPTION_CACHE_SIZE", "128")), ttl=VIDEO_CACHE_TTL)
+registry.register_cache('video', video_cache.stats)
+registry.register_cache('caption', caption_cache.stats)
+
+# Feed adaptive streams straight into FFmpeg through FIFOs instead of temp files (POSIX only)
+STREAMING_MUX = os.getenv("STREAMING_MUX", "0") == "1" and hasattr(os, 'mkfifo')
+# Output containers FFmpeg can write progressively while its inputs are still arriving
+STREAMABLE_CONTAINERS = ('mp4',)
+
+# Audio sent to users: "aac" (.m4a) or "mp3" transcoded to AUDIO_BITRATE kbit/s, or "copy" to send YouTube's stream as is
+AUDIO_CODEC = os.getenv("AUDIO_CODEC", "aac").lower()
+AUDIO_BITRATE = int(os.getenv("AUDIO_BITRATE", "96"))
+# Long videos get a lower bitrate so the file stays below this size (Telegram bots can upload up to 50 MB)
+AUDIO_MAX_SIZE = int(float(os.getenv("AUDIO_MAX_MB", "49")) * 1024 * 1024)
+AUDIO_MIN_BITRATE = 32
+# FFmpeg encoder and file extension per codec; both containers can carry cover art
+AUDIO_CODECS = {
+    'aac': ('aac', 'm4a'),
+    'mp3': ('libmp3lame', 'mp3'),
+}
+# Codec family of YouTube's audio streams, to tell when a stream can be kept without re-encoding
+SOURCE_CODECS = {'mp4a': 'aac', 'opus': 'opus', 'mp3': 'mp3'}
+
+
+# The mux jobs below and the functions finishing them are plain module-level values and functions,
+# so the job engine can run them inside a process pool.
+class MuxJob(NamedTuple):
+    """Separately downloaded video/audio files waiting to be merged into output_path."""
+    video_path: str
+    audio_path: str
+    output_path: str
+
+
+def merge_av(job: MuxJob) -> Optional[str]:
+    """Merges a MuxJob with FFmpeg and removes its temporary inputs."""
+    try:
+        (
+            ffmpeg
+            .input(job.video_path)
+            .output(ffmpeg.input(job.audio_path), job.output_path, vcodec='copy', acodec='copy')
+            .run(overwrite_output=True, quiet=True)
+        )
+        return job.output_path
+
+    except ffmpeg.Error as e:
+        logger.error(f"FFmpeg error during merge: {e.stderr.decode('utf8')}")
+        remove_job_file(job.output_path)
+        return None
+    finally:
+        # Clean up temporary files
+        for path in (job.video_path, job.audio_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class StreamMuxJob(NamedTuple):
+    """Adaptive video/audio stream URLs to be merged into output_path while they download."""
+    video_url: str
+    video_size: int
+    audio_url: str
+    audio_size: int
+    output_path: str
+
+
+def _feed_fifo(fifo_path: str, url: str, size: int, errors: list):
+    try:
+        # Opening blocks until FFmpeg opens the other end for reading
+        with open(fifo_path, 'wb') as fifo:
+            for chunk in iter_segments(url, size):
+                fifo.write(chunk)
+    except Exception as e:
+        errors.append(e)
+
+
+def stream_merge_av(job: StreamMuxJob) -> Optional[str]:
+    """
+    Downloads and merges a StreamMuxJob in one pass: both streams are piped into FFmpeg through FIFOs
+    and only the final fragmented MP4 touches the disk. Falls back to temp files + merge_av on failure.
+    """
+    output_dir = os.path.dirname(job.output_path)
+    video_fifo = os.path.join(output_dir, 'video.fifo')
+    audio_fifo = os.path.join(output_dir, 'audio.fifo')
+    errors = []
+    try:
+        os.mkfifo(video_fifo)
+        os.mkfifo(audio_fifo)
+        process = (
+            ffmpeg
+            .input(video_fifo)
+            .output(ffmpeg.input(audio_fifo), job.output_path, vcodec='copy', acodec='copy',
+                    movflags='frag_keyframe+empty_moov+default_base_moof')
+            .global_args('-loglevel', 'error')
+            .run_async(overwrite_output=True, quiet=True)
+        )
+        feeders = [
+            threading.Thread(target=_feed_fifo, args=(video_fifo, job.video_url, job.video_size, errors), daemon=True),
+            threading.Thread(target=_feed_fifo, args=(audio_fifo, job.audio_url, job.audio_size, errors), daemon=True),
+        ]
+        for feeder in feeders:
+            feeder.start()
+        _, stderr = process.communicate()
+        # If FFmpeg exited without opening a FIFO, open it ourselves so its feeder stops waiting
+        for fifo in (video_fifo, audio_fifo):
+            try:
+                os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+        for feeder in feeders:
+            feeder.join()
+
+        # A broken download only shows up as an early EOF to FFmpeg, so check the feeders too
+        if process.returncode == 0 and not errors:
+            return job.output_path
+        logger.warning(f"Streaming merge failed ({errors[0] if errors else stderr.decode('utf8').strip()}), falling back to temp files.")
+
+    except (OSError, ffmpeg.Error) as e:
+        logger.warning(f"Streaming merge unavailable ({e}), falling back to temp files.")
+    finally:
+        for fifo in (video_fifo, audio_fifo):
+            if os.path.exists(fifo):
+                os.remove(fifo)
+
+    # Fallback: the original temp-file path
+    try:
+        video_path = download_segmented(job.video_url, os.path.join(output_dir, 'temp_video'), job.video_size)
+        audio_path = download_segmented(job.audio_url, os.path.join(output_dir, 'temp_audio'), job.audio_size)
+    except Exception as e:
+        logger.error(f"Fallback download failed for {job.output_path}: {e}")
+        remove_job_file(job.output_path)
+        return None
+    return merge_av(MuxJob(video_path, audio_path, job.output_path))
+
+
+class TranscodeJob(NamedTuple):
+    """A downloaded audio stream to be converted into output_path, tagged with metadata and cover art."""
+    input_path: str
+    output_path: str
+    encoder: str
+    bitrate: int
+    duration: int
+    metadata: dict
+    cover_path: Optional[str]
+
+
+def _metadata_options(metadata: dict) -> dict:
+    """Output options writing each non-empty tag; ffmpeg-python needs a distinct key per -metadata flag."""
+    tags = [f"{key}={value}" for key, value in metadata.items() if value]
+    return {f"metadata:g:{i}": tag for i, tag in enumerate(tags)}
+
+
+def transcode_audio(job: TranscodeJob) -> Optional[str]:
+    """Converts a TranscodeJob with FFmpeg (encoder "copy" only rewraps the stream) and removes its source file."""
+    try:
+        streams = [ffmpeg.input(job.input_path).audio]
+        options = {'acodec': job.encoder, 'map_metadata': -1, **_metadata_options(job.metadata)}
+        if job.encoder != 'copy':
+            options['audio_bitrate'] = f"{job.bitrate}k"
+        if job.cover_path:
+            streams.append(ffmpeg.input(job.cover_path).video)
+            options.update({'vcodec': 'copy', 'disposition:v': 'attached_pic'})
+        if job.output_path.endswith('.mp3'):
+            options['id3v2_version'] = 3
+        ffmpeg.output(*streams, job.output_path, **options).run(overwrite_output=True, quiet=True)
+        return job.output_path
+
+    except ffmpeg.Error as e:
+        logger.error(f"FFmpeg error during audio transcode: {e.stderr.decode('utf8')}")
+        remove_job_file(job.output_path)
+        return None
+    finally:
+        for path in (job.input_path, job.cover_path):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+
+class ClipJob(NamedTuple):
+    """Stream URLs of which only `duration` seconds from `start` are fetched and cut into output_path."""
+    video_url: Optional[str]
+    audio_url: Optional[str]
+    start: float
+    duration: float
+    output_path: str
+    audio_encoder: str = 'copy'
+    audio_bitrate: int = 0
+    metadata: Optional[dict] = None
+
+
+def clip_av(job: ClipJob) -> Optional[str]:
+    """
+    Cuts a ClipJob straight from the stream URLs. FFmpeg seeks on the HTTP inputs itself (using the MP4/WebM
+    index to find the byte offset of `start`), so only the ranges covering the window are downloaded.
+    Video is copied and starts at the keyframe before `start`; audio-only clips are encoded like full audio.
+    """
+    seek = {'ss': f"{job.start:.3f}", 't': f"{job.duration:.3f}", 'user_agent': USER_AGENT}
+    options = {'acodec': job.audio_encoder}
+    if job.audio_encoder != 'copy':
+        options['audio_bitrate'] = f"{job.audio_bitrate}k"
+    if job.metadata:
+        options.update(map_metadata=-1, **_metadata_options(job.metadata))
+    finished = False
+    try:
+        if job.video_url and job.audio_url:
+            streams = [ffmpeg.input(job.video_url, **seek).video, ffmpeg.input(job.audio_url, **seek).audio]
+            options['vcodec'] = 'copy'
+        elif job.video_url:
+            # Progressive stream: one input with both tracks
+            streams = [ffmpeg.input(job.video_url, **seek)]
+            options['vcodec'] = 'copy'
+        else:
+            streams = [ffmpeg.input(job.audio_url, **seek).audio]
+        ffmpeg.output(*streams, job.output_path, **options).run(overwrite_output=True, quiet=True)
+        finished = True
+        return job.output_path
+
+    except ffmpeg.Error as e:
+        logger.error(f"FFmpeg error while cutting a clip: {e.stderr.decode('utf8')}")
+        return None
+    finally:
+        # Any failure (also a missing ffmpeg binary or a broken pool) drops the partial clip and its job directory
+        if not finished:
+            remove_job_file(job.output_path)
+
+
+MUX_JOBS = (MuxJob, StreamMuxJob, TranscodeJob, ClipJob)
+
+
+def mux(job: Union[MuxJob, StreamMuxJob, TranscodeJob, ClipJob]) -> Optional[str]:
+    """Finishes any mux job returned by YoutubeVideo.fetch."""
+    if isinstance(job, ClipJob):
+        return clip_av(job)
+    if isinstance(job, TranscodeJob):
+        return transcode_audio(job)
+    if isinstance(job, StreamMuxJob):
+        return stream_merge_av(job)
+    return merge_av(job)
+
+
+def parse_clock(value: str) -> float:
+    """Seconds of a time written as SS, MM:SS or HH:MM:SS (fractions allowed)."""
+    seconds = 0.0
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def format_clock(seconds: float) -> str:
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}" if hours else f"{minutes}:{secs:02d}"
+
+
+@dataclass(frozen=True)
+class FormatSpec:
+    """
+    Describes the file a user asked for. YoutubeVideo.select_streams picks the best matching
+    progressive stream or adaptive video/audio pair from the manifest.
+    """
+    resolution: Optional[int] = None
+    container: str = 'mp4'
+    codec_preference: tuple = ('avc1', 'av01', 'vp9')
+    max_size: Optional[int] = None
+    audio_only: bool = False
+    # Audio only: transcode to this AUDIO_CODECS codec and bitrate (kbit/s), shrinking long files to target_size bytes
+    audio_codec: Optional[str] = None
+    audio_bitrate: Optional[int] = None
+    target_size: Optional[int] = None
+    # Only this window of the video, in seconds
+    clip_start: Optional[float] = None
+    clip_end: Optional[float] = None
+
+    @property
+    def is_clip(self) -> bool:
+        return self.clip_start is not None and self.clip_end is not None
+
+    @property
+    def label(self) -> str:
+        # Also the media cache key, so it names everything that changes the delivered file;
+        # audio shows the right bitrate once YoutubeVideo.delivered_spec() pinned it for the video
+        if not self.audio_only:
+            label = f"Video {self.resolution}p"
+        elif self.audio_codec:
+            label = f"Audio {self.audio_codec.upper()} {self.audio_bitrate or AUDIO_BITRATE}k"
+        else:
+            label = "Audio"
+        if self.is_clip:
+            label += f" {format_clock(self.clip_start)}-{format_clock(self.clip_end)}"
+        return label
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'FormatSpec':
+        """Rebuilds a spec from dataclasses.asdict() output that went through JSON (lists back to tuples)."""
+        return cls(**{**data, 'codec_preference': tuple(data.get('codec_preference', cls.codec_preference))})
+
+
+AUDIO_SPEC = FormatSpec(
+    audio_only=True,
+    audio_codec=AUDIO_CODEC if AUDIO_CODEC in AUDIO_CODECS else None,
+    audio_bitrate=AUDIO_BITRATE,
+    target_size=AUDIO_MAX_SIZE,
+)
+
+
+def _height(stream) -> Optional[int]:
+    match = re.match(r'(\d+)p', stream.resolution or '')
+    return int(match.group(1)) if match else None
+
+
+def _codec_rank(stream, spec: FormatSpec) -> int:
+    codec = (stream.video_codec or '').lower()
+    for rank, prefix in enumerate(spec.codec_preference):
+        if codec.startswith(prefix):
+            return rank
+    return len(spec.codec_preference)
+
+
+def _abr(stream) -> int:
+    return int(re.sub(r'\D', '', stream.abr or '') or 0)
+
+
+def _source_codec(stream) -> str:
+    codec = (stream.audio_codec or '').lower()
+    return next((family for prefix, family in SOURCE_CODECS.items() if codec.startswith(prefix)), codec)
+
+
+def _best_audio(streams, container: str):
+    # Prefer audio in the output container (AAC for mp4), then the highest bitrate
+    audios = list(streams.filter(only_audio=True))
+    audios.sort(key=lambda s: (s.subtype != container, -_abr(s)))
+    return audios[0] if audios else None
+
+
+def _best_audio_source(streams):
+    # Transcoding: the container doesn't matter, take the highest bitrate and Opus over AAC at equal bitrates
+    audios = list(streams.filter(only_audio=True))
+    audios.sort(key=lambda s: (-_abr(s), _source_codec(s) != 'opus'))
+    return audios[0] if audios else None
+
+
+def _audio_bitrate(spec: FormatSpec, source_kbps: int, duration: int) -> int:
+    """Bitrate for spec: the requested one, lowered to fit target_size, never above the source."""
+    bitrate = spec.audio_bitrate or AUDIO_BITRATE
+    if spec.target_size and duration:
+        # Leave ~3% for the container, tags and cover art
+        bitrate = min(bitrate, int(spec.target_size * 8 * 0.97 / duration / 1000))
+    if source_kbps:
+        bitrate = min(bitrate, source_kbps)
+    return max(AUDIO_MIN_BITRATE, bitrate)
+
+
+def _clip_bitrate(spec: FormatSpec, stream) -> int:
+    return min(spec.audio_bitrate or AUDIO_BITRATE, _abr(stream) or AUDIO_BITRATE)
+
+
+def _fetch_cover(url: str, dest_path: str) -> Optional[str]:
+    """Downloads the video thumbnail for embedding; the audio is still sent without it if this fails."""
+    try:
+        request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+        with urllib.request.urlopen(request, timeout=10) as response, open(dest_path, 'wb') as f:
+            f.write(response.read())
+        return dest_path
+    except Exception as e:
+        logger.warning(f"No cover art from {url}: {e}")
+        return None
+
+
+def _fits(spec: FormatSpec, *streams) -> bool:
+    return spec.max_size is None or sum(s.filesize for s in streams) <= spec.max_size
+
+
+def _combined_progress(on_progress: Optional[Callable[[int, int], None]], sizes: list[int]) -> list:
+    """One on_progress callback per stream, each reporting the progress of all streams together."""
+    if on_progress is None:
+        return [None] * len(sizes)
+    done = [0] * len(sizes)
+    lock = threading.Lock()
+
+    def callback(index: int):
+        def report(stream_done: int, _total: int):
+            with lock:
+                done[index] = stream_done
+                total_done = sum(done)
+            on_progress(total_done, sum(sizes))
+        return report
+
+    return [callback(i) for i in range(len(sizes))]
+
+
 class YoutubeVideo():
     """
     A utility class for interacting with YouTube videos via pytubefix.
@@ -15,159 +418,231 @@ class YoutubeVideo():
     def __init__(self, link):
         self.yt = YouTube(link)
 
-    def _extract_text_from_xml(self, xml_caption: str) -> str:
-        # 1. Remove XML tags
-        text = re.sub(r'<[^>]+>', '', xml_caption)
-        
-        # 2. Decode common HTML entities 
-        text = text.replace('&amp;', '&').replace('&#39;', "'")
-        
-        # 3. Clean up whitespace and newlines from XML structure
-        text = re.sub(r'\s*\n\s*', '\n', text)
-        text = text.strip()
-        
-        return text
+    def resolve(self):
+        """Fetches the watch page, stream manifest and caption tracks once so later calls are served from memory."""
+        _ = self.yt.title
+        _ = self.yt.streams
+        _ = self.yt.captions
 
-    def get_pure_subtitles_text(self, lang_code: str) -> Optional[str]:
+    def caption_tracks(self) -> list[tuple[str, str]]:
+        """(code, name) of every caption track on the video, e.g. ('a.en', 'English (auto-generated)')."""
+        return [(caption.code, caption.name) for caption in self.yt.captions]
+
+    def get_cues(self, lang_code: str) -> Optional[list[Cue]]:
+        """
+        Parsed caption cues for lang_code, cached per (video_id, language). pytubefix hands over the whole
+        XML document and every format and bundle renders from the cached list, so the cues are materialized.
+        """
         # Try finding the exact match first, then the auto-generated version
         caption = self.yt.captions.get_by_language_code(lang_code) or \
                   self.yt.captions.get_by_language_code(f'a.{lang_code}')
                   
         if caption is None:
             return None
-        
-        # 1. Get raw XML captions
-        raw_xml = caption.xml_captions
-        
-        # 2. Extract and return pure text
-        return self._extract_text_from_xml(raw_xml)
-
-    def download_video_144(self) -> Optional[str]:
-        try:
-            stream = self.yt.streams.get_by_resolution("144p") or self.yt.streams.filter(res="144p").first()
-            if stream is not None:
-                # Use the 'videos' subdirectory
-                file_path = stream.download(output_path='videos')
-                return file_path
-            return None
-        except Exception as e:
-            logger.error(f"Failed to download 144p video for {self.yt.title}: {e}")
-            return None
-    
-    def download_video_360(self) -> Optional[str]:
-        try:
-            stream = self.yt.streams.get_by_resolution("360p") or self.yt.streams.filter(res="360p").first()
-            if stream is not None:
-                # Use the 'videos' subdirectory
-                file_path = stream.download(output_path='videos')
-                return file_path
-            return None
-        except Exception as e:
-            logger.error(f"Failed to download 360p video for {self.yt.title}: {e}")
-            return None
-        
-    def download_video_720(self) -> Optional[str]:
-        video_res = "720p"
-        output_dir = 'videos'
-        
-        try:
-            # 1. Download Video-only stream 
-            video_stream = self.yt.streams.filter(res=video_res, progressive=False, file_extension='mp4').first()
-            if not video_stream:
-                logger.error(f"No {video_res} video-only stream found for {self.yt.title}.")
-                return None
-            
-            # 2. Download Audio-only stream
-            audio_stream = self.yt.streams.filter(only_audio=True, file_extension='mp4').order_by('abr').desc().first()
-            if not audio_stream:
-                logger.error(f"No suitable audio stream found for {self.yt.title}.")
-                return None
-            
-            # Define temporary file paths
-            # Note: We append resolution to ensure unique temp file names if multiple resolutions are run concurrently
-            video_filepath = video_stream.download(output_path=output_dir, filename=f'temp_video_{video_res}')
-            audio_filepath = audio_stream.download(output_path=output_dir, filename=f'temp_audio_{video_res}')
 
-            # Define final merged file path
-            safe_title = "".join(c for c in self.yt.title if c.isalnum() or c in (' ', '_')).rstrip()
-            final_filepath = os.path.join(output_dir, f"{safe_title}_{video_res}.mp4")
-
-            # 3. Merge video and audio using FFmpeg
-            (
-                ffmpeg
-                .input(video_filepath)
-                .output(ffmpeg.input(audio_filepath), final_filepath, vcodec='copy', acodec='copy')
-                .run(overwrite_output=True, quiet=True)
-            )
-
-            # 4. Clean up temporary files
-            os.remove(video_filepath)
-            os.remove(audio_filepath)
-            
-            return final_filepath
-            
-        except ffmpeg.Error as e:
-            logger.error(f"FFmpeg error during merge: {e.stderr.decode('utf8')}")
-            return None
-        except Exception as e:
-            logger.error(f"Failed to download/merge {video_res} video for {self.yt.title}: {e}")
+        key = (self.yt.video_id, caption.code)
+        cues = caption_cache.get(key)
+        if cues is None:
+            cues = list(iter_cues(caption.xml_captions))
+            caption_cache.set(key, cues)
+        return cues
+
+    def get_subtitles(self, lang_code: str, fmt: str = 'txt') -> Optional[str]:
+        """Subtitles for lang_code as plain text, SRT or WebVTT."""
+        cues = self.get_cues(lang_code)
+        return render(cues, fmt) if cues else None
+
+    def get_pure_subtitles_text(self, lang_code: str) -> Optional[str]:
+        return self.get_subtitles(lang_code, 'txt')
+
+    def available_resolutions(self) -> list[int]:
+        """Every video height the manifest offers, lowest first."""
+        heights = {_height(stream) for stream in self.yt.streams.filter(type='video')}
+        return sorted(h for h in heights if h)
+
+    def select_streams(self, spec: FormatSpec) -> Optional[tuple]:
+        """
+        Picks the streams that best match spec from the manifest.
+        Returns (stream, None) for a single progressive/audio stream, (video, audio) for an adaptive pair, or None.
+        """
+        streams = self.yt.streams
+
+        if spec.audio_only:
+            audio = _best_audio_source(streams) if spec.audio_codec else _best_audio(streams, spec.container)
+            return (audio, None) if audio and _fits(spec, audio) else None
+
+        # A progressive stream needs no merge, so it wins whenever it matches
+        progressive = [s for s in streams.filter(progressive=True, file_extension=spec.container) if _height(s) == spec.resolution]
+        progressive.sort(key=lambda s: _codec_rank(s, spec))
+        for stream in progressive:
+            if _fits(spec, stream):
+                return stream, None
+
+        videos = [s for s in streams.filter(adaptive=True, only_video=True) if _height(s) == spec.resolution]
+        videos.sort(key=lambda s: (s.subtype != spec.container, _codec_rank(s, spec), -(s.fps or 0)))
+        audio = _best_audio(streams, spec.container)
+        if not audio:
             return None
-        
-    def download_video_1080(self) -> Optional[str]:
-        video_res = "1080p"
-        output_dir = 'videos'
-        
+        for video in videos:
+            if _fits(spec, video, audio):
+                return video, audio
+        return None
+
+    def estimate_size(self, spec: FormatSpec) -> int:
+        """Bytes fetch(spec) would download according to the manifest, 0 if no stream matches."""
+        selected = self.select_streams(spec)
+        if not selected:
+            return 0
+        return self._clip_share(spec, sum(s.filesize or 0 for s in selected if s is not None))
+
+    def _clip_share(self, spec: FormatSpec, size: int) -> int:
+        """The part of size a clip of spec covers (all of it when spec isn't a clip or the length is unknown)."""
+        length = self.yt.length or 0
+        if not spec.is_clip or not length:
+            return size
+        return int(size * min(1.0, (spec.clip_end - spec.clip_start) / length))
+
+    def delivered_spec(self, spec: FormatSpec) -> FormatSpec:
+        """
+        spec with audio_bitrate set to what transcoding this video really produces (lowered for target_size
+        and the source, or the source's own when the stream is only rewrapped), so its label names the file.
+        """
+        stream = _best_audio_source(self.yt.streams) if spec.audio_only and spec.audio_codec else None
+        if stream is None:
+            return spec
+        if spec.is_clip:
+            return replace(spec, audio_bitrate=_clip_bitrate(spec, stream))
+        bitrate = _audio_bitrate(spec, _abr(stream), self.yt.length or 0)
+        if _source_codec(stream) == spec.audio_codec and _abr(stream) <= bitrate:
+            bitrate = _abr(stream) or bitrate
+        # Pinning is idempotent: _transcode_job() arrives at the same bitrate and encoder for the result
+        return replace(spec, audio_bitrate=bitrate)
+
+    @property
+    def safe_title(self) -> str:
+        return "".join(c for c in self.yt.title if c.isalnum() or c in (' ', '_')).rstrip()
+
+    def _transcode_job(self, spec: FormatSpec, stream, output_dir: str, on_progress=None) -> TranscodeJob:
+        """Downloads the audio source and cover art and describes the conversion to spec.audio_codec."""
+        encoder, extension = AUDIO_CODECS[spec.audio_codec]
+        duration = self.yt.length or 0
+        bitrate = _audio_bitrate(spec, _abr(stream), duration)
+        if spec.target_size and duration * bitrate * 1000 / 8 > spec.target_size:
+            logger.warning(f"{self.yt.title} is too long for {spec.target_size / 1024 ** 2:.0f} MB even at {bitrate} kbit/s.")
+        # The stream already has the wanted codec and no more bits than asked for: keep it and only add the tags
+        if _source_codec(stream) == spec.audio_codec and _abr(stream) <= bitrate:
+            encoder = 'copy'
+
+        source_path = download_stream(stream, output_dir, f'source.{stream.subtype}', on_progress=on_progress)
+        cover_path = _fetch_cover(self.yt.thumbnail_url, os.path.join(output_dir, 'cover.jpg')) if self.yt.thumbnail_url else None
+        metadata = {'title': self.yt.title, 'artist': self.yt.author, 'comment': self.yt.watch_url}
+        output_path = os.path.join(output_dir, f"{self.safe_title or 'audio'}.{extension}")
+        return TranscodeJob(source_path, output_path, encoder, bitrate, duration, metadata, cover_path)
+
+    def _clip_job(self, spec: FormatSpec, stream, audio_stream, output_dir: str) -> ClipJob:
+        """Describes the cut of spec's window; nothing is downloaded here, FFmpeg fetches the window itself."""
+        start = spec.clip_start
+        end = min(spec.clip_end, self.yt.length) if self.yt.length else spec.clip_end
+        name = f"{self.safe_title or 'clip'}_{format_clock(start)}-{format_clock(end)}".replace(':', '.')
+        if not spec.audio_only:
+            output_path = os.path.join(output_dir, f"{name}_{spec.resolution}p.{spec.container}")
+            return ClipJob(stream.url, audio_stream.url if audio_stream else None, start, end - start, output_path)
+
+        if spec.audio_codec:
+            encoder, extension = AUDIO_CODECS[spec.audio_codec]
+            bitrate = _clip_bitrate(spec, stream)
+        else:
+            encoder, extension, bitrate = 'copy', 'm4a' if stream.subtype == 'mp4' else stream.subtype, 0
+        metadata = {'title': f"{self.yt.title} ({format_clock(start)}-{format_clock(end)})", 'artist': self.yt.author, 'comment': self.yt.watch_url}
+        return ClipJob(None, stream.url, start, end - start, os.path.join(output_dir, f"{name}.{extension}"), encoder, bitrate, metadata)
+
+    def fetch(self, spec: FormatSpec, on_progress: Optional[Callable[[int, int], None]] = None) -> Optional[Union[str, MuxJob, StreamMuxJob, TranscodeJob, ClipJob]]:
+        """
+        Downloads the streams chosen for spec into a fresh scratch directory. When the download fails its
+        partial files are kept, and the next fetch of the same streams (a retry, also after a restart) resumes them.
+        Returns the file path for a single stream, or a MuxJob/StreamMuxJob/TranscodeJob/ClipJob still to be finished with mux().
+        Raises StorageFullError when the streams don't fit on disk. on_progress(done_bytes, total_bytes) covers
+        all streams of the job and is called from the download threads (not for a StreamMuxJob).
+        """
+        output_dir = None
         try:
-            # 1. Download Video-only stream 
-            video_stream = self.yt.streams.filter(res=video_res, progressive=False, file_extension='mp4').first()
-            if not video_stream:
-                logger.error(f"No {video_res} video-only stream found for {self.yt.title}.")
-                return None
-            
-            # 2. Download Audio-only stream 
-            audio_stream = self.yt.streams.filter(only_audio=True, file_extension='mp4').order_by('abr').desc().first()
-            if not audio_stream:
-                logger.error(f"No suitable audio stream found for {self.yt.title}.")
+            selected = self.select_streams(spec)
+            if not selected:
+                logger.error(f"No stream matching {spec.label} found for {self.yt.title}.")
                 return None
-            
-            # Define temporary file paths
-            # Note: We append resolution to ensure unique temp file names if multiple resolutions are run concurrently
-            video_filepath = video_stream.download(output_path=output_dir, filename=f'temp_video_{video_res}')
-            audio_filepath = audio_stream.download(output_path=output_dir, filename=f'temp_audio_{video_res}')
+
+            stream, audio_stream = selected
+            # Check the disk before downloading: merges and transcodes write a second file of about the same size
+            expected_bytes = stream.filesize + (audio_stream.filesize if audio_stream else 0)
+            if spec.is_clip:
+                # FFmpeg writes nothing but the clip
+                expected_bytes = self._clip_share(spec, expected_bytes)
+            elif spec.audio_codec or (audio_stream is not None and not (STREAMING_MUX and spec.container in STREAMABLE_CONTAINERS)):
+                expected_bytes *= 2
+            # Partial downloads of a failed attempt at the same streams are picked up again
+            resume_key = '_'.join([self.yt.video_id, str(stream.itag)] + ([str(audio_stream.itag)] if audio_stream else []))
+            output_dir = storage.new_job_dir('audios' if spec.audio_only else 'videos', expected_bytes, resume_key)
+            if spec.is_clip:
+                return self._clip_job(spec, stream, audio_stream, output_dir)
+            if spec.audio_codec:
+                return self._transcode_job(spec, stream, output_dir, on_progress)
+            if audio_stream is None:
+                return download_stream(stream, output_dir, on_progress=on_progress)
 
             # Define final merged file path
-            safe_title = "".join(c for c in self.yt.title if c.isalnum() or c in (' ', '_')).rstrip()
-            final_filepath = os.path.join(output_dir, f"{safe_title}_{video_res}.mp4")
-
-            # 3. Merge video and audio using FFmpeg
-            (
-                ffmpeg
-                .input(video_filepath)
-                .output(ffmpeg.input(audio_filepath), final_filepath, vcodec='copy', acodec='copy')
-                .run(overwrite_output=True, quiet=True)
-            )
-
-            # 4. Clean up temporary files
-            os.remove(video_filepath)
-            os.remove(audio_filepath)
-            
-            return final_filepath
-            
-        except ffmpeg.Error as e:
-            logger.error(f"FFmpeg error during merge: {e.stderr.decode('utf8')}")
-            return None
+            final_filepath = os.path.join(output_dir, f"{self.safe_title}_{spec.resolution}p.{spec.container}")
+
+            # Let the merge download the streams itself, so nothing but the final file is written
+            if STREAMING_MUX and spec.container in STREAMABLE_CONTAINERS:
+                return StreamMuxJob(stream.url, stream.filesize, audio_stream.url, audio_stream.filesize, final_filepath)
+
+            # Fetch video and audio at the same time, the merge can only start when both are done
+            video_progress, audio_progress = _combined_progress(on_progress, [stream.filesize, audio_stream.filesize])
+            with ThreadPoolExecutor(max_workers=2, thread_name_prefix="stream") as pool:
+                video_future = pool.submit(download_stream, stream, output_dir, f'temp_video.{stream.subtype}', on_progress=video_progress)
+                audio_future = pool.submit(download_stream, audio_stream, output_dir, f'temp_audio.{audio_stream.subtype}', on_progress=audio_progress)
+                video_filepath, audio_filepath = video_future.result(), audio_future.result()
+
+            return MuxJob(video_filepath, audio_filepath, final_filepath)
+
+        except StorageFullError:
+            raise
+
         except Exception as e:
-            logger.error(f"Failed to download/merge {video_res} video for {self.yt.title}: {e}")
+            logger.error(f"Failed to download {spec.label} for {self.yt.title}: {e}")
+            if output_dir:
+                storage.keep_partial(output_dir, resume_key)
             return None
 
-    def download_audio(self) -> Optional[str]:
-        try:
-            stream = self.yt.streams.filter(only_audio=True, file_extension='mp4').first()
-            if stream is not None:
-                # Use the dedicated 'audios' subdirectory
-                file_path = stream.download(output_path='audios')
-                return file_path
-            return None
-        except Exception as e:
-            logger.error(f"Failed to download audio for {self.yt.title}: {e}")
-            return None
\ No newline at end of file
+    def download(self, spec: FormatSpec) -> Optional[str]:
+        """Downloads (and merges if needed) the best streams for spec, returning the final file path."""
+        result = self.fetch(spec)
+        if isinstance(result, MUX_JOBS):
+            return mux(result)
+        return result
+
+
+def load_video(link: str) -> YoutubeVideo:
+    """Returns a resolved YoutubeVideo for link, reusing a cached one for the same video ID."""
+    video_id = extract_video_id(link)
+    if video_id is None:
+        return YoutubeVideo(link)
+
+    video = video_cache.get(video_id)
+    if video is None:
+        with STAGE_SECONDS.time(stage='manifest'):
+            video = YoutubeVideo(canonical_url(video_id))
+            video.resolve()
+        video_cache.set(video_id, video)
+        logger.info(f"Resolved and cached metadata for video {video_id}.")
+    return video
+
+
+def iter_batch_links(kind: str, url: str) -> tuple[str, Iterator[str]]:
+    """
+    Title and video URLs of a playlist or channel (kind as returned by extract_batch_link).
+    The URLs are produced lazily: pytubefix requests the next page only when the iterator gets there.
+    """
+    source = Playlist(url) if kind == 'playlist' else Channel(url)
+    title = source.channel_name if kind == 'channel' else source.title
+    return title, iter(source.video_urls)